@@ -6,6 +6,7 @@ from accounts.api.serializers import (
     UserSerializerWithProfile,
 )
 from accounts.models import UserProfile
+from accounts.services import UserService
 from django.contrib.auth import (
     login as django_login,
     logout as django_logout,
@@ -78,6 +79,7 @@ class AccountViewSet(viewsets.ViewSet):
             }, status=400)
 
         django_login(request, user)
+        UserService.mark_user_active(user.id)
         return Response({
             "success": True,
             "user": UserSerializer(user).data,
@@ -0,0 +1,9 @@
+from utils.time_constants import ONE_DAY
+
+# 超过这么长时间没有访问过的用户被认为是不活跃的用户
+# 发帖 fanout 的时候会跳过不活跃的粉丝，等他们回来的时候再重建 newsfeeds
+INACTIVE_USER_THRESHOLD = 30 * ONE_DAY
+# 同一个进程在这段时间之内不会重复记录同一个用户的访问时间
+# 相比 INACTIVE_USER_THRESHOLD 来说几分钟的误差可以忽略
+USER_ACTIVITY_UPDATE_INTERVAL = 5 * 60
+USER_ACTIVITY_LOCAL_CACHE_SIZE = 10000
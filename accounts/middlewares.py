@@ -0,0 +1,37 @@
+from accounts.constants import (
+    USER_ACTIVITY_LOCAL_CACHE_SIZE,
+    USER_ACTIVITY_UPDATE_INTERVAL,
+)
+
+import time
+
+
+class UserActivityMiddleware:
+    """
+    记录登录用户最后一次访问的时间，用于判断用户是否活跃
+    需要放在 AuthenticationMiddleware 之后，才能拿到 request.user
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # 每个进程自己记住最近标记过的用户，几分钟之内的重复请求不再去写 redis
+        self.last_marked_at = {}
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            self.mark_user_active(request.user.id)
+        return self.get_response(request)
+
+    def mark_user_active(self, user_id):
+        # import 写在里面避免循环依赖
+        from accounts.services import UserService
+
+        now = time.time()
+        last_marked_at = self.last_marked_at.get(user_id)
+        if last_marked_at is not None and last_marked_at >= now - USER_ACTIVITY_UPDATE_INTERVAL:
+            return
+        # 只是为了少写几次 redis，满了直接清空就好，不需要 LRU
+        if len(self.last_marked_at) >= USER_ACTIVITY_LOCAL_CACHE_SIZE:
+            self.last_marked_at.clear()
+        self.last_marked_at[user_id] = now
+        UserService.mark_user_active(user_id)
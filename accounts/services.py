@@ -1,9 +1,17 @@
+from accounts.constants import INACTIVE_USER_THRESHOLD
 from accounts.models import UserProfile
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import (
+    USER_DORMANT_SINCE_PATTERN,
+    USER_LAST_SEEN_KEY,
+    USER_PROFILE_PATTERN,
+)
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -29,7 +37,109 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        # 批量版本的 get_profile_through_cache，返回 {user_id: profile}
+        keys = {
+            USER_PROFILE_PATTERN.format(user_id=user_id): user_id
+            for user_id in set(user_ids)
+        }
+        profiles = {
+            keys[key]: profile
+            for key, profile in cache.get_many(keys).items()
+        }
+
+        missing_user_ids = [user_id for user_id in keys.values() if user_id not in profiles]
+        if not missing_user_ids:
+            return profiles
+        missing_profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=missing_user_ids)
+        }
+        # 老用户可能还没有 profile，和 get_profile_through_cache 一样 get_or_create 一个
+        for user_id in missing_user_ids:
+            if user_id not in missing_profiles:
+                missing_profiles[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+        cache.set_many({
+            USER_PROFILE_PATTERN.format(user_id=user_id): profile
+            for user_id, profile in missing_profiles.items()
+        })
+        profiles.update(missing_profiles)
+        return profiles
+
+    @classmethod
+    def prefetch_users(cls, objects):
+        """
+        列表页在渲染之前批量读取 objects 的 cached_user 和 user 的 profile
+        放在 _cached_user 和 _cached_user_profile 里，渲染的时候就不需要每个 object 单独访问 cache
+        """
+        objects = [obj for obj in objects if obj.user_id is not None]
+        users = MemcachedHelper.get_objects_through_cache(
+            User,
+            [obj.user_id for obj in objects],
+        )
+        profiles = cls.get_profiles_through_cache(users.keys())
+        for user_id, user in users.items():
+            user._cached_user_profile = profiles[user_id]
+        for obj in objects:
+            if obj.user_id in users:
+                obj._cached_user = users[obj.user_id]
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+
+    @classmethod
+    def mark_user_active(cls, user_id):
+        # 用一个 sorted set 记录每个用户最后一次访问的时间，score 是以秒为单位的时间戳
+        conn = RedisClient.get_connection()
+        now = int(time.time())
+        pipeline = conn.pipeline()
+        pipeline.zscore(USER_LAST_SEEN_KEY, user_id)
+        pipeline.zadd(USER_LAST_SEEN_KEY, {user_id: now})
+        last_seen, _ = pipeline.execute()
+
+        # 之前不活跃的用户错过了一些 fanout，记录下来，等打开 newsfeeds 的时候再重建
+        if last_seen is not None and not cls.is_active(last_seen, now):
+            key = USER_DORMANT_SINCE_PATTERN.format(user_id=user_id)
+            conn.setnx(key, int(last_seen))
+
+    @classmethod
+    def get_last_seen_list(cls, user_ids):
+        """
+        返回每个用户最后一次访问的时间戳（秒），没有访问记录的用户返回 None
+        用 pipeline 批量查询，只需要一次网络往返
+        """
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zscore(USER_LAST_SEEN_KEY, user_id)
+        return pipeline.execute()
+
+    @classmethod
+    def is_active(cls, last_seen, now=None):
+        # 没有访问记录的用户（比如上线这个功能之前就没有再访问过的用户）当作活跃用户处理
+        # 保证和之前的行为一致，不会有用户漏掉 newsfeeds
+        if last_seen is None:
+            return True
+        if now is None:
+            now = time.time()
+        return last_seen >= now - INACTIVE_USER_THRESHOLD
+
+    @classmethod
+    def get_dormant_since(cls, user_id):
+        """
+        如果用户刚刚从不活跃的状态回来，返回他最后一次访问的时间戳（秒），否则返回 None
+        重建完 newsfeeds 之后需要调用 clear_dormant_since 清除标记
+        """
+        conn = RedisClient.get_connection()
+        dormant_since = conn.get(USER_DORMANT_SINCE_PATTERN.format(user_id=user_id))
+        if dormant_since is None:
+            return None
+        return int(dormant_since)
+
+    @classmethod
+    def clear_dormant_since(cls, user_id):
+        conn = RedisClient.get_connection()
+        conn.delete(USER_DORMANT_SINCE_PATTERN.format(user_id=user_id))
@@ -1,5 +1,10 @@
+from accounts.middlewares import UserActivityMiddleware
 from accounts.models import UserProfile
+from accounts.services import UserService
+from django.test import RequestFactory
 from testing.testcases import TestCase
+from twitter.cache import USER_LAST_SEEN_KEY
+from utils.redis_client import RedisClient
 
 
 class UserProfileTests(TestCase):
@@ -12,4 +17,44 @@ class UserProfileTests(TestCase):
         self.assertEqual(UserProfile.objects.count(), 0)
         p = linghu.profile
         self.assertEqual(isinstance(p, UserProfile), True)
-        self.assertEqual(UserProfile.objects.count(), 1)
\ No newline at end of file
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_prefetch_users(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        UserProfile.objects.create(user=linghu)
+        UserProfile.objects.create(user=dongxie)
+        tweets = [self.create_tweet(linghu), self.create_tweet(dongxie), self.create_tweet(linghu)]
+        self.clear_cache()
+        # user 和 profile 都不在 cache 里，各用一次查询批量读取
+        with self.assertNumQueries(2):
+            UserService.prefetch_users(tweets)
+        self.assertEqual(tweets[0].cached_user, linghu)
+        self.assertEqual(tweets[1].cached_user.profile.user_id, dongxie.id)
+
+        # 都在 cache 里之后不再访问数据库
+        tweets = [self.create_tweet(linghu), self.create_tweet(dongxie)]
+        with self.assertNumQueries(0):
+            UserService.prefetch_users(tweets)
+            self.assertEqual(tweets[0].cached_user.profile.user_id, linghu.id)
+            self.assertEqual(tweets[1].cached_user.profile.user_id, dongxie.id)
+
+    def test_user_activity_middleware(self):
+        linghu = self.create_user('linghu')
+        middleware = UserActivityMiddleware(lambda request: None)
+        request = RequestFactory().get('/')
+        request.user = linghu
+        conn = RedisClient.get_connection()
+
+        middleware(request)
+        self.assertNotEqual(conn.zscore(USER_LAST_SEEN_KEY, linghu.id), None)
+
+        # 几分钟之内的重复请求不会再写 redis
+        conn.zadd(USER_LAST_SEEN_KEY, {linghu.id: 1})
+        middleware(request)
+        self.assertEqual(conn.zscore(USER_LAST_SEEN_KEY, linghu.id), 1)
+
+        # 超过时间间隔之后会重新记录
+        middleware.last_marked_at[linghu.id] = 0
+        middleware(request)
+        self.assertNotEqual(conn.zscore(USER_LAST_SEEN_KEY, linghu.id), 1)
@@ -1,9 +1,27 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
+from django.db.models import Manager
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+
+
+class CommentListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        comments = list(data.all() if isinstance(data, Manager) else data)
+        UserService.prefetch_users(comments)
+        # 用一次查询拿到当前用户点赞过的 comments，CommentSerializer.get_has_liked 直接从 context 里读取
+        self.context['liked_comment_ids'] = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Comment,
+            [comment.id for comment in comments],
+        )
+        self.context['comment_counts'] = RedisHelper.get_counts(comments, ['likes_count'])
+        return super(CommentListSerializer, self).to_representation(comments)
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -13,6 +31,7 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
+        list_serializer_class = CommentListSerializer
         fields = (
             'id',
             'tweet_id',
@@ -24,9 +43,15 @@ class CommentSerializer(serializers.ModelSerializer):
         )
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        counts = self.context.get('comment_counts')
+        if counts is not None and obj.id in counts:
+            return counts[obj.id]['likes_count']
+        return RedisHelper.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
+        liked_comment_ids = self.context.get('liked_comment_ids')
+        if liked_comment_ids is not None:
+            return obj.id in liked_comment_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
@@ -2,10 +2,13 @@ from comments.models import Comment
 from django.utils import timezone
 from testing.testcases import TestCase
 from rest_framework.test import APIClient
+from utils.paginations import EndlessPagination
+from utils.redis_helper import RedisHelper
 
 
 COMMENT_URL = '/api/comments/'
 COMMENT_DETAIL_URL = '/api/comments/{}/'
+TWEET_COMMENTS_URL = '/api/tweets/{}/comments/'
 TWEET_LIST_API = '/api/tweets/'
 TWEET_DETAIL_API = '/api/tweets/{}/'
 NEWSFEED_LIST_API = '/api/newsfeeds/'
@@ -141,6 +144,51 @@ class CommentApiTests(TestCase):
         })
         self.assertEqual(len(response.data['comments']), 2)
 
+    def test_list_pagination(self):
+        # 翻页的 comments 接口在 /api/tweets/<id>/comments/，按照时间倒序从 redis 里读取
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.dongxie, self.tweet, 'comment {}'.format(i))
+            for i in range(page_size * 2)
+        ][::-1]
+
+        # 第一页从 redis 里读取，请求次数和 comments 的数量无关
+        self.clear_cache()
+        response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id))
+        with self.assertNumQueries(0):
+            response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id))
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['results']],
+            [comment.id for comment in comments[:page_size]],
+        )
+
+        # 翻页
+        response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id), {
+            'created_at__lt': response.data['results'][-1]['created_at'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['results']],
+            [comment.id for comment in comments[page_size:]],
+        )
+
+        # 新的 comment 会加到 cache 里，修改和删除之后 cache 会重新 load
+        new_comment = self.create_comment(self.linghu, self.tweet, 'new comment')
+        response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id), {
+            'created_at__gt': comments[0].created_at,
+        })
+        self.assertEqual([comment['id'] for comment in response.data['results']], [new_comment.id])
+        new_comment.content = 'updated'
+        new_comment.save()
+        self.run_on_commit_callbacks()
+        response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id))
+        self.assertEqual(response.data['results'][0]['content'], 'updated')
+        new_comment.delete()
+        self.run_on_commit_callbacks()
+        response = self.linghu_client.get(TWEET_COMMENTS_URL.format(self.tweet.id))
+        self.assertEqual(response.data['results'][0]['id'], comments[0].id)
+
     def test_comments_count(self):
         # test tweet detail api
         tweet = self.create_tweet(self.linghu)
@@ -172,14 +220,18 @@ class CommentApiTests(TestCase):
         for i in range(2):
             _, client = self.create_user_and_client('user{}'.format(i))
             client.post(COMMENT_URL, data)
+            self.run_on_commit_callbacks()
             response =client.get(tweet_url)
             self.assertEqual(response.data['comments_count'], i + 1)
+            RedisHelper.flush_count_deltas()
             self.tweet.refresh_from_db()
             self.assertEqual(self.tweet.comments_count, i + 1)
 
         comment_data = self.dongxie_client.post(COMMENT_URL, data).data
+        self.run_on_commit_callbacks()
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        RedisHelper.flush_count_deltas()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
@@ -189,13 +241,16 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, 200)
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        RedisHelper.flush_count_deltas()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
         # delete a comment will update comments_count
         response = self.dongxie_client.delete(comment_url)
+        self.run_on_commit_callbacks()
         self.assertEqual(response.status_code, 200)
         response = self.linghu_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 2)
+        RedisHelper.flush_count_deltas()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 2)
\ No newline at end of file
@@ -69,11 +69,12 @@ class CommentViewSet(viewsets.GenericViewSet):
         # 所以用了以个 django_filters 的包
         # 去拿到 filter 完之后的 queryset
         # 好处是，如果有 多个筛选条件，可以直接在前面的 filterset_fields 里加
+        # 这个接口保持原来的返回格式，按照时间顺序返回所有的 comments
+        # 需要翻页的话用 /api/tweets/<id>/comments/，按照时间倒序从 redis 里读取每一页
         queryset = self.get_queryset() # 这个就是Comment.objects.all()
         # comments = self.filter_queryset(queryset).order_by('created_at') #这个就是 filter 后的
-        comments = self.filter_queryset(queryset)\
-            .prefetch_related('user')\
-            .order_by('created_at')
+        comments = self.filter_queryset(queryset).order_by('created_at')
+        # 用户信息，点赞数和 has_liked 都在 CommentListSerializer 里批量读取
         serializer = CommentSerializer(
             comments,
             context={'request': request},
@@ -1,22 +1,29 @@
+from django.db import transaction
 from utils.redis_helper import RedisHelper
 
 def incr_comments_count(sender, instance, created, **kwargs):
-    from tweets.models import Tweet
-    from django.db.models import F
-
     if not created:
         return
 
     # handle new comment
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') + 1)
-    RedisHelper.incr_count(instance.tweet, 'comments_count')
+    # 和 likes_count 一样先记在 redis 里，由 tweets.tasks.flush_count_deltas_task 批量写回数据库
+    # 事务回滚的话不能记，所以等到提交之后再记
+    tweet = instance.tweet
+    transaction.on_commit(lambda: RedisHelper.incr_count(tweet, 'comments_count'))
 
 def decr_comments_count(sender, instance, **kwargs):
-    from tweets.models import Tweet
-    from django.db.models import F
-
     # handle comment deletion
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') - 1)
-    RedisHelper.decr_count(instance.tweet, 'comments_count')
+    tweet = instance.tweet
+    transaction.on_commit(lambda: RedisHelper.decr_count(tweet, 'comments_count'))
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    # 事务提交之后再更新 cache，否则别的进程可能在提交之前从数据库 load 到旧的数据写回 cache
+    from comments.services import CommentService
+    if created:
+        transaction.on_commit(lambda: CommentService.push_comment_to_cache(instance))
+    else:
+        transaction.on_commit(lambda: CommentService.invalidate_cached_comments(instance.tweet_id))
+
+def invalidate_cached_comments(sender, instance, **kwargs):
+    from comments.services import CommentService
+    transaction.on_commit(lambda: CommentService.invalidate_cached_comments(instance.tweet_id))
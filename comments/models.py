@@ -1,8 +1,13 @@
-from comments.listeners import incr_comments_count, decr_comments_count
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    invalidate_cached_comments,
+    push_comment_to_cache,
+)
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from likes.models import Like
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
@@ -18,6 +23,9 @@ class Comment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # 和 Tweet 一样把点赞数存在 comment 上，避免每次都去 Like 表里 COUNT(*)
+    likes_count = models.IntegerField(default=0, null=True)
+
     class Meta:
         # 有在某个 tweet 下排序所有 comments 的需求
         index_together = (('tweet', 'created_at'),)
@@ -39,8 +47,13 @@ class Comment(models.Model):
 
     @property
     def cached_user(self):
+        # 列表页会用 UserService.prefetch_users 提前批量读取好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
 post_save.connect(incr_comments_count, sender=Comment)
-pre_delete.connect(decr_comments_count, sender=Comment)
\ No newline at end of file
+pre_delete.connect(decr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+post_delete.connect(invalidate_cached_comments, sender=Comment)
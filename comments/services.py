@@ -0,0 +1,43 @@
+from comments.models import Comment
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+def lazy_load_comments(tweet_id):
+    def _lazy_load(limit):
+        return Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at')[:limit]
+    return _lazy_load
+
+
+class CommentService(object):
+
+    @classmethod
+    def get_cached_comments_in_range(cls, tweet_id, created_at__lt=None, created_at__gt=None, limit=None):
+        # 和 user_tweets 一样，每个 tweet 最新的 comments 存在 redis 的 sorted set 里
+        # 返回 (comments, is_complete)
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects_in_range(
+            key,
+            lazy_load_comments(tweet_id),
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+        )
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        if comment.tweet_id is None:
+            return
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        RedisHelper.push_object(key, comment, lazy_load_comments(comment.tweet_id))
+
+    @classmethod
+    def invalidate_cached_comments(cls, tweet_id):
+        # sorted set 的 member 是序列化之后的 comment，修改过的 comment 没法在原地替换
+        # 删掉一个 comment 也会让 cache 里的长度和 is_complete 的判断对不上
+        # 修改和删除都比较少，直接删掉整个 key，下次读取的时候重新 load
+        if tweet_id is None:
+            return
+        conn = RedisClient.get_connection()
+        conn.delete(TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id))
@@ -1,4 +1,6 @@
+from comments.services import CommentService
 from testing.testcases import TestCase
+from utils.redis_helper import RedisHelper
 
 
 class CommentModelTests(TestCase):
@@ -21,4 +23,58 @@ class CommentModelTests(TestCase):
 
         dongxie = self.create_user('dongxie')
         self.create_like(dongxie, self.comment)
-        self.assertEqual(self.comment.like_set.count(), 2)
\ No newline at end of file
+        self.assertEqual(self.comment.like_set.count(), 2)
+
+    def test_likes_count(self):
+        dongxie = self.create_user('dongxie')
+        comment2 = self.create_comment(dongxie, self.tweet)
+        self.create_like(self.linghu, self.comment)
+        like = self.create_like(dongxie, self.comment)
+        self.create_like(dongxie, comment2)
+
+        # 还没有写回数据库的 deltas 也会被算进去
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts([self.comment, comment2], ['likes_count'])
+        self.assertEqual(counts, {
+            self.comment.id: {'likes_count': 2},
+            comment2.id: {'likes_count': 1},
+        })
+        RedisHelper.flush_count_deltas()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.likes_count, 2)
+
+        like.delete()
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            self.assertEqual(RedisHelper.get_count(self.comment, 'likes_count'), 1)
+        RedisHelper.flush_count_deltas()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.likes_count, 1)
+
+        # cache 里没有的时候用一次查询从数据库里 load
+        self.clear_cache()
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts([self.comment, comment2], ['likes_count'])
+        self.assertEqual(counts, {
+            self.comment.id: {'likes_count': 1},
+            comment2.id: {'likes_count': 1},
+        })
+
+    def test_empty_comments_cached(self):
+        # 没有评论的 tweet 也会被 cache，不会每次都去数据库里 load
+        tweet = self.create_tweet(self.linghu)
+        with self.assertNumQueries(1):
+            self.assertEqual(CommentService.get_cached_comments_in_range(tweet.id), ([], True))
+        with self.assertNumQueries(0):
+            self.assertEqual(CommentService.get_cached_comments_in_range(tweet.id), ([], True))
+            self.assertEqual(
+                CommentService.get_cached_comments_in_range(tweet.id, created_at__gt=self.comment.created_at),
+                ([], True),
+            )
+
+        # 有了新的评论之后占位的 member 被删掉
+        comment = self.create_comment(self.linghu, tweet)
+        with self.assertNumQueries(0):
+            comments, is_complete = CommentService.get_cached_comments_in_range(tweet.id)
+        self.assertEqual([c.id for c in comments], [comment.id])
+        self.assertEqual(is_complete, True)
@@ -0,0 +1,5 @@
+from django.apps import AppConfig
+
+
+class DjangoHbaseConfig(AppConfig):
+    name = 'django_hbase'
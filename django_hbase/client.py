@@ -1,14 +1,154 @@
+from contextlib import contextmanager
 from django.conf import settings
+from thriftpy2.thrift import TException
 
 import happybase
+import os
+import socket
+import threading
+import time
+
+# 连接断开或者超时的时候 thrift 会抛出的异常
+# happybase.ConnectionPool 遇到这些异常的时候会自动重建这个连接的 transport
+CONNECTION_ERRORS = (TException, socket.error)
 
 
 class HBaseClient:
-    conn = None
+    """
+    每个进程一个 happybase.ConnectionPool，每个线程（或者 greenlet）从 pool 里借一个连接使用
+    happybase.Connection 不是线程安全的，多个线程共享同一个全局连接会互相打乱 thrift 的请求
+    celery 的 prefork worker 是 fork 出来的，fork 之后要在子进程里重新建 pool，不能共用父进程的 socket
+    """
+    pool = None
+    pool_pid = None
+    lock = threading.Lock()
+
+    # 每个连接上一次检查的时间，很久没用过的连接可能已经被 thrift server 断开了
+    last_checked_at = {}
+
+    # {operation: {'count': 0, 'errors': 0, 'retries': 0, 'total_time': 0, 'max_time': 0}}
+    metrics = {}
+    metrics_lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        if cls.pool is not None and cls.pool_pid == os.getpid():
+            return cls.pool
+        with cls.lock:
+            if cls.pool is None or cls.pool_pid != os.getpid():
+                cls.pool = happybase.ConnectionPool(
+                    size=settings.HBASE_POOL_SIZE,
+                    host=settings.HBASE_HOST,
+                    timeout=settings.HBASE_TIMEOUT,
+                )
+                cls.pool_pid = os.getpid()
+                cls.last_checked_at = {}
+        return cls.pool
+
+    @classmethod
+    def _check_connection(cls, conn):
+        now = time.time()
+        last_checked_at = cls.last_checked_at.get(id(conn))
+        if last_checked_at is not None and now - last_checked_at < settings.HBASE_HEALTH_CHECK_INTERVAL:
+            return
+        try:
+            # 第一次使用的时候建立连接，之后定期用一个很轻的请求检查连接是否还可用
+            conn.open()
+            conn.tables()
+        except CONNECTION_ERRORS:
+            # 连接已经断开了，重新连接一次，还失败的话把异常抛给调用方
+            conn.close()
+            conn.open()
+        cls.last_checked_at[id(conn)] = now
+
+    @classmethod
+    @contextmanager
+    def connection(cls):
+        """
+        从 pool 里借一个连接，用完之后自动还回去
+        pool 里的连接都被占用的时候最多等 HBASE_POOL_TIMEOUT 秒，超时会抛出 NoConnectionsAvailable
+        """
+        with cls.get_pool().connection(timeout=settings.HBASE_POOL_TIMEOUT) as conn:
+            cls._check_connection(conn)
+            yield conn
+
+    @classmethod
+    def execute(cls, table_name, operation, func, retry=False):
+        """
+        借一个连接执行 func(table)，并记录每种操作的耗时
+        retry=True 只能用于幂等的读操作，连接断开的时候换一个连接重试
+        put 和 delete 虽然也是幂等的，但是重试可能会覆盖掉别的请求在这期间写入的新数据，所以不重试
+        """
+        retries = settings.HBASE_READ_RETRIES if retry else 0
+        for attempt in range(retries + 1):
+            started_at = time.perf_counter()
+            try:
+                with cls.connection() as conn:
+                    result = func(conn.table(table_name))
+            except CONNECTION_ERRORS:
+                cls.record(operation, time.perf_counter() - started_at, error=True, retry=attempt > 0)
+                if attempt == retries:
+                    raise
+                continue
+            cls.record(operation, time.perf_counter() - started_at, retry=attempt > 0)
+            return result
+
+    @classmethod
+    def scan(cls, table_name, **kwargs):
+        """
+        和 execute 一样，但是返回一个 generator，在读完所有 rows 之前一直占用着这个连接
+        还没有读到任何 row 的时候连接断开可以重试，读了一部分之后断开的话就直接抛出异常
+        否则重试会返回重复的 rows
+        记录的耗时包括了调用方处理每一行的时间
+        """
+        retries = settings.HBASE_READ_RETRIES
+        attempt = 0
+        started_at = time.perf_counter()
+        while True:
+            has_yielded = False
+            try:
+                with cls.connection() as conn:
+                    for row in conn.table(table_name).scan(**kwargs):
+                        has_yielded = True
+                        yield row
+                break
+            except CONNECTION_ERRORS:
+                cls.record('scan', time.perf_counter() - started_at, error=True, retry=attempt > 0)
+                if has_yielded or attempt == retries:
+                    raise
+                attempt += 1
+                started_at = time.perf_counter()
+        cls.record('scan', time.perf_counter() - started_at, retry=attempt > 0)
+
+    @classmethod
+    def record(cls, operation, elapsed, error=False, retry=False):
+        with cls.metrics_lock:
+            metric = cls.metrics.setdefault(operation, {
+                'count': 0,
+                'errors': 0,
+                'retries': 0,
+                'total_time': 0,
+                'max_time': 0,
+            })
+            metric['count'] += 1
+            metric['errors'] += int(error)
+            metric['retries'] += int(retry)
+            metric['total_time'] += elapsed
+            metric['max_time'] = max(metric['max_time'], elapsed)
+
+    @classmethod
+    def get_metrics(cls):
+        # 返回每种操作的次数，出错次数，重试次数，平均耗时和最大耗时（单位是秒）
+        with cls.metrics_lock:
+            return {
+                operation: dict(
+                    metric,
+                    avg_time=metric['total_time'] / metric['count'] if metric['count'] else 0,
+                )
+                for operation, metric in cls.metrics.items()
+            }
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
\ No newline at end of file
+    def reset_metrics(cls):
+        with cls.metrics_lock:
+            cls.metrics = {}
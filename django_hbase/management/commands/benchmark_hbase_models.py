@@ -0,0 +1,165 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from django_hbase.models import ROW_KEY_CODEC_BINARY, TimestampField
+
+import time
+import tracemalloc
+
+
+class Command(BaseCommand):
+    """
+    测试 HBaseModel 把 scan 返回的 rows 解码成 instance 的速度，也就是 filter() 里除了网络之外的开销
+    以及在内存里放 count 个 model instance 和 scan_rows 返回的 namedtuple 分别占用多少内存
+    还会对比 string 和 binary 两种 row key 编码的 key 长度，编码和解码的速度
+    默认在内存里生成和 hbase 返回格式一样的 rows，不需要连接 hbase
+    加上 --prefix 的时候会真的去 hbase 里 filter 以这个值开头的 rows（只读）
+    再加上 --binary-table（migrate_hbase_row_keys 复制出来的表）会用同样的 prefix 扫描两张表，对比两种编码的 scan 速度
+    用法:
+    python manage.py benchmark_hbase_models --count 1000 --repeat 20
+    python manage.py benchmark_hbase_models --model friendships.models.HBaseFollower \
+        --prefix 1 --binary-table twitter_followers_v2
+    """
+    help = 'Measure HBaseModel row decode throughput of filter()'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            action='append',
+            dest='models',
+            help='dotted path of the HBaseModel class, can be repeated',
+        )
+        parser.add_argument('--count', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument(
+            '--prefix',
+            type=int,
+            default=None,
+            help='also time filter() on the rows whose first row key field equals this value',
+        )
+        parser.add_argument(
+            '--binary-table',
+            default=None,
+            help='table copied by migrate_hbase_row_keys, scanned with the same --prefix',
+        )
+
+    def handle(self, *args, **options):
+        count, repeat = options['count'], options['repeat']
+        try:
+            model_classes = [
+                import_string(path)
+                for path in options['models'] or [
+                    'newsfeeds.models.HBaseNewsFeed',
+                    'friendships.models.HBaseFollower',
+                ]
+            ]
+        except ImportError as e:
+            raise CommandError(str(e))
+        if options['binary_table'] is not None:
+            if options['prefix'] is None or len(model_classes) != 1:
+                raise CommandError('--binary-table requires --prefix and exactly one --model')
+
+        for model_class in model_classes:
+            rows = []
+            for i in range(count):
+                instance = model_class(**self.build_data(model_class, i, 1))
+                row_data = {
+                    column_key.encode('utf-8'): value.encode('utf-8')
+                    for column_key, value in model_class.serialize_row_data(instance.__dict__).items()
+                }
+                rows.append((instance.row_key, row_data))
+            self.report(model_class.__name__, count, repeat, lambda: [
+                model_class.init_from_row(row_key, row_data)
+                for row_key, row_data in rows
+            ])
+            self.report(model_class.__name__ + ' rows', count, repeat, lambda: [
+                model_class.init_row_from_row(row_key, row_data)
+                for row_key, row_data in rows
+            ])
+            self.report_memory(model_class.__name__, count, lambda: [
+                model_class.init_from_row(row_key, row_data)
+                for row_key, row_data in rows
+            ])
+            self.report_memory(model_class.__name__ + ' rows', count, lambda: [
+                model_class.init_row_from_row(row_key, row_data)
+                for row_key, row_data in rows
+            ])
+
+        self.benchmark_row_key_codecs(model_classes[0], count, repeat)
+
+        if options['prefix'] is not None:
+            for model_class in model_classes:
+                self.benchmark_scan('scan ' + model_class.__name__, model_class, options['prefix'], repeat)
+        if options['binary_table'] is not None:
+            binary_class = model_classes[0].with_row_key_codec(
+                ROW_KEY_CODEC_BINARY,
+                options['binary_table'],
+            )
+            self.benchmark_scan('scan binary', binary_class, options['prefix'], repeat)
+
+    def build_data(self, model_class, i, prefix):
+        # row key 的第一个 field 是 prefix，timestamp 的 field 递增，其他的 field 用不同的 id
+        data = {}
+        for key, field in model_class.get_field_hash().items():
+            if key == model_class.Meta.row_key[0]:
+                data[key] = prefix
+            elif isinstance(field, TimestampField):
+                data[key] = 1666000000000000 + i
+            else:
+                data[key] = i + 1
+        return data
+
+    def benchmark_row_key_codecs(self, model_class, count, repeat):
+        for codec_class in [model_class, model_class.with_row_key_codec(ROW_KEY_CODEC_BINARY)]:
+            codec = 'binary' if codec_class._is_binary_row_key else 'string'
+            instances = [
+                codec_class(**self.build_data(codec_class, i, i % 100 + 1))
+                for i in range(count)
+            ]
+            row_keys = [instance.row_key for instance in instances]
+            # 编码之后的顺序和 row key 里 fields 的顺序对应，scan 的时候按照字节序读取
+            self.stdout.write('row key {:<7} {:>5.1f} bytes/key'.format(
+                codec,
+                sum(len(row_key) for row_key in row_keys) / count,
+            ))
+            self.report('encode ' + codec, count, repeat, lambda: [
+                codec_class.serialize_row_key(instance.__dict__)
+                for instance in instances
+            ])
+            self.report('decode ' + codec, count, repeat, lambda: [
+                codec_class.deserialize_row_key(row_key)
+                for row_key in row_keys
+            ])
+
+    def benchmark_scan(self, name, model_class, prefix, repeat):
+        # 包括网络和 hbase 的开销，两种编码扫描的数据相同，差别来自 row key 的长度和解码
+        self.report(
+            name,
+            len(model_class.filter(prefix=(prefix, None))),
+            repeat,
+            lambda: model_class.filter(prefix=(prefix, None)),
+        )
+
+    def report(self, name, count, repeat, decode):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decode()
+        elapsed = (time.perf_counter() - start) / repeat
+        self.stdout.write('{:<22} {:>7} rows  {:8.2f} ms  {:>10.0f} rows/s'.format(
+            name,
+            count,
+            elapsed * 1000,
+            count / elapsed if elapsed else 0,
+        ))
+
+    def report_memory(self, name, count, decode):
+        # 只统计解码出来的 objects 还被引用着的时候占用的内存，相当于 worker 里拿着一个很长的粉丝列表
+        tracemalloc.start()
+        objects = decode()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write('{:<22} {:>7} rows  {:8.2f} MB  {:>10.0f} bytes/row'.format(
+            name,
+            len(objects),
+            size / 1024 / 1024,
+            size / count,
+        ))
@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from django_hbase.models import ROW_KEY_CODEC_BINARY, ROW_KEY_CODEC_STRING
+
+
+class Command(BaseCommand):
+    """
+    把一个 HBaseModel 的表里所有的数据按照新的 row key 编码方式复制到另外一张表里
+    目标表需要提前在 hbase 里建好（column family 和原来的表一样），这个命令不会删除原来的表
+    put 是幂等的，可以重复执行。上线新的编码方式的步骤：
+    1. 建好目标表，执行这个命令做一次全量复制，这一步不需要停写
+    2. 停掉这个 model 的所有写入（包括删除），加上 --prune 再执行一次
+       补上第 1 步期间写入的数据，并且删掉目标表里在源表中已经被删除的 rows
+    3. 在 model 的 Meta 里把 table_name 改成目标表，row_key_codec 改成新的编码方式，上线之后再恢复写入
+    第 2 步必须停写：复制只会 put，不停写的话在扫描过去之后才写入或者删除的数据都会丢失或者残留在目标表里
+    用法:
+    python manage.py migrate_hbase_row_keys newsfeeds.models.HBaseNewsFeed twitter_newsfeeds_v2 --codec binary
+    """
+    help = 'Copy an HBaseModel table into another table with a different row key codec'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='dotted path of the HBaseModel class')
+        parser.add_argument('target_table', help='name of the already created target table')
+        parser.add_argument(
+            '--codec',
+            default=ROW_KEY_CODEC_BINARY,
+            choices=[ROW_KEY_CODEC_STRING, ROW_KEY_CODEC_BINARY],
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='delete rows of the target table that no longer exist in the source table',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='only count the rows that would be copied',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model_class = import_string(options['model'])
+        except ImportError as e:
+            raise CommandError(str(e))
+        source_table = model_class.get_table_name()
+        target_class = model_class.with_row_key_codec(options['codec'], options['target_table'])
+        if target_class.get_table_name() == source_table:
+            raise CommandError('target table must be different from {}'.format(source_table))
+
+        batch_size = options['batch_size']
+        total = 0
+        batch_params = []
+        for row in model_class.scan_rows(batch_size=batch_size):
+            batch_params.append(row._asdict())
+            if len(batch_params) == batch_size:
+                total += self.write(target_class, batch_params, options['dry_run'])
+                batch_params = []
+        if batch_params:
+            total += self.write(target_class, batch_params, options['dry_run'])
+
+        self.stdout.write('{} rows {} from {} to {} with {} row keys.'.format(
+            total,
+            'found' if options['dry_run'] else 'copied',
+            source_table,
+            target_class.get_table_name(),
+            options['codec'],
+        ))
+
+        if options['prune']:
+            self.prune(model_class, target_class, batch_size, options['dry_run'])
+
+    def write(self, target_class, batch_params, dry_run):
+        if not dry_run:
+            target_class.batch_create(batch_params)
+        return len(batch_params)
+
+    def prune(self, model_class, target_class, batch_size, dry_run):
+        # 扫描目标表，每个 batch 用一次 get_many 去源表里确认还在不在
+        row_key_names = model_class.Meta.row_key
+        total = 0
+        batch_params = []
+        for row in target_class.scan_rows(batch_size=batch_size):
+            batch_params.append({key: getattr(row, key) for key in row_key_names})
+            if len(batch_params) == batch_size:
+                total += self.delete_missing(model_class, target_class, batch_params, dry_run)
+                batch_params = []
+        if batch_params:
+            total += self.delete_missing(model_class, target_class, batch_params, dry_run)
+
+        self.stdout.write('{} rows {} from {} that no longer exist in {}.'.format(
+            total,
+            'found' if dry_run else 'deleted',
+            target_class.get_table_name(),
+            model_class.get_table_name(),
+        ))
+
+    def delete_missing(self, model_class, target_class, batch_params, dry_run):
+        instances = model_class.get_many(batch_params)
+        missing = [
+            params
+            for params, instance in zip(batch_params, instances)
+            if instance is None
+        ]
+        if not dry_run:
+            for params in missing:
+                target_class.delete(**params)
+        return len(missing)
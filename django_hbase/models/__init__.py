@@ -1,3 +1,4 @@
+from .codecs import ROW_KEY_CODEC_BINARY, ROW_KEY_CODEC_STRING
 from .fields import *
 from .hbase_models import *
 from .exceptions import *
\ No newline at end of file
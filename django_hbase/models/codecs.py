@@ -0,0 +1,37 @@
+from .fields import IntegerField, TimestampField
+
+import struct
+
+ROW_KEY_CODEC_STRING = 'string'
+ROW_KEY_CODEC_BINARY = 'binary'
+
+# binary codec 里每个 row key field 都是 8 个字节，不需要分隔符
+BINARY_FIELD_WIDTH = 8
+# binary codec 只支持这些类型的 row key field
+BINARY_ROW_KEY_FIELD_TYPES = (IntegerField, TimestampField)
+
+# 把有符号的 int 加上 2^63 变成无符号的 int，大端序存储之后字节序和数值的大小顺序一致
+SIGN_OFFSET = 1 << 63
+
+# 每个字节的 bit 反转之后的值，配合把字节顺序倒过来，就是整个 64 位 int 的 bit 反转
+BIT_REVERSE_TABLE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+_uint64 = struct.Struct('>Q')
+
+
+def build_binary_serializer(field):
+    """
+    int 和 timestamp 编码成 8 个字节的大端序无符号整数，可以直接按照字节序做 range scan
+    reverse=True 的 field 做 bit 反转，作用和 string codec 里把数字倒过来一样：
+    连续的 user id 会被打散到不同的 region，避免热点。反转之后只能做等值的前缀查询，不能做范围查询
+    其他类型的 field 在 HBaseModel._prepare_fields 里就会报错，不会走到这里
+    """
+    if field.reverse:
+        return lambda value: _uint64.pack(int(value) + SIGN_OFFSET)[::-1].translate(BIT_REVERSE_TABLE)
+    return lambda value: _uint64.pack(int(value) + SIGN_OFFSET)
+
+
+def build_binary_deserializer(field):
+    if field.reverse:
+        return lambda value: _uint64.unpack(value[::-1].translate(BIT_REVERSE_TABLE))[0] - SIGN_OFFSET
+    return lambda value: _uint64.unpack(value)[0] - SIGN_OFFSET
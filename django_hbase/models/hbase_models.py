@@ -1,6 +1,16 @@
+from .codecs import (
+    BINARY_FIELD_WIDTH,
+    BINARY_ROW_KEY_FIELD_TYPES,
+    ROW_KEY_CODEC_BINARY,
+    ROW_KEY_CODEC_STRING,
+    build_binary_deserializer,
+    build_binary_serializer,
+)
 from .exceptions import EmptyColumnError, BadRowKeyError
 from .fields import HBaseField, IntegerField, TimestampField
+from collections import namedtuple
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django_hbase.client import HBaseClient
 
 class HBaseModel:
@@ -8,11 +18,123 @@ class HBaseModel:
     class Meta:
         table_name = None
         row_key = () # None
+        # row key 的编码方式，默认是 ':' 分隔的字符串
+        # 设置成 ROW_KEY_CODEC_BINARY 之后每个 field 编码成 8 个字节的大端序整数，key 更短，编码更快
+        # 已有数据的表切换之前需要用 migrate_hbase_row_keys 把数据复制到新的表里
+        row_key_codec = ROW_KEY_CODEC_STRING
+
+    # 下面这些字段的元信息在定义 subclass 的时候由 __init_subclass__ 计算一次
+    # 之前每次 __init__ / serialize / deserialize 都要遍历一遍 cls.__dict__，扫描 1000 行要重复几千次
+    _field_hash = {}
+    # ((key, field, serialize, deserialize), ...) 按照 Meta.row_key 的顺序
+    _row_key_fields = ()
+    _is_binary_row_key = False
+    # ((key, column_key, serialize), ...)
+    _column_fields = ()
+    # {b'cf:key': (key, deserialize)}
+    _column_decoders = {}
+    # scan_rows 返回的只读 namedtuple 类型，字段顺序和 _field_hash 一致
+    _row_class = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._prepare_fields()
 
     @classmethod
-    def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+    def _prepare_fields(cls):
+        # 按照 MRO 从基类到子类收集 fields，子类可以继承或者覆盖基类的 field
+        field_hash = {}
+        for klass in reversed(cls.__mro__):
+            for key, field_obj in vars(klass).items():
+                if isinstance(field_obj, HBaseField):
+                    field_hash[key] = field_obj
+        cls._field_hash = field_hash
+
+        codec = getattr(cls.Meta, 'row_key_codec', ROW_KEY_CODEC_STRING)
+        if codec not in (ROW_KEY_CODEC_STRING, ROW_KEY_CODEC_BINARY):
+            raise ImproperlyConfigured('Unknown row_key_codec {} in {}'.format(codec, cls.__name__))
+        cls._is_binary_row_key = codec == ROW_KEY_CODEC_BINARY
+        if cls._is_binary_row_key:
+            build_serializer, build_deserializer = build_binary_serializer, build_binary_deserializer
+        else:
+            build_serializer, build_deserializer = cls._build_serializer, cls._build_deserializer
+
+        row_key_fields = []
+        for key in cls.Meta.row_key:
+            field = field_hash.get(key)
+            # 写错的名字之前会被直接跳过，生成的 row key 少了一段也不会报错，所以在定义的时候就检查
+            if field is None:
+                raise ImproperlyConfigured(
+                    'Unknown field {} in {}.Meta.row_key'.format(key, cls.__name__),
+                )
+            if field.column_family:
+                raise ImproperlyConfigured(
+                    'Field {} in {}.Meta.row_key should not have a column family'.format(
+                        key,
+                        cls.__name__,
+                    ),
+                )
+            if cls._is_binary_row_key and not isinstance(field, BINARY_ROW_KEY_FIELD_TYPES):
+                raise ImproperlyConfigured(
+                    'Field {} in {}.Meta.row_key is not supported by the binary row key codec'.format(
+                        key,
+                        cls.__name__,
+                    ),
+                )
+            row_key_fields.append((
+                key,
+                field,
+                build_serializer(field),
+                build_deserializer(field),
+            ))
+        cls._row_key_fields = tuple(row_key_fields)
+
+        column_fields = []
+        column_decoders = {}
+        for key, field in field_hash.items():
+            if not field.column_family:
+                continue
+            column_key = '{}:{}'.format(field.column_family, key)
+            column_fields.append((key, column_key, cls._build_serializer(field)))
+            column_decoders[column_key.encode('utf-8')] = (key, cls._build_deserializer(field))
+        cls._column_fields = tuple(column_fields)
+        cls._column_decoders = column_decoders
+        cls._row_class = namedtuple('{}Row'.format(cls.__name__), field_hash.keys())
+
+    @classmethod
+    def with_row_key_codec(cls, codec, table_name=None):
+        """
+        生成一个子类，fields 都从 cls 继承，只有 row key 的编码方式（和 table name）不同
+        用于迁移数据和对比不同编码方式的 benchmark
+        """
+        meta = type('Meta', (cls.Meta,), {
+            'table_name': table_name or cls.Meta.table_name,
+            'row_key_codec': codec,
+        })
+        return type(cls.__name__, (cls,), {'Meta': meta, '__module__': cls.__module__})
+
+    @classmethod
+    def _build_serializer(cls, field):
+        if isinstance(field, IntegerField):
+            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+            # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
+            if field.reverse:
+                return lambda value: str(value).rjust(16, '0')[::-1]
+            return lambda value: str(value).rjust(16, '0')
+        if field.reverse:
+            return lambda value: str(value)[::-1]
+        return str
+
+    @classmethod
+    def _build_deserializer(cls, field):
+        is_int = field.field_type in [IntegerField.field_type, TimestampField.field_type]
+        if field.reverse:
+            if is_int:
+                return lambda value: int(value[::-1])
+            return lambda value: value[::-1]
+        if is_int:
+            return int
+        return lambda value: value
 
     @property
     def row_key(self):
@@ -20,30 +142,34 @@ class HBaseModel:
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-        # 可以写成 for field, field_obj in cls.__dict__.items() 吗？
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        # 在 __init_subclass__ 里已经算好了，调用方不要修改返回的 dict
+        return cls._field_hash
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
-            value = kwargs.get(key)
-            setattr(self, key, value)
+        for key in self._field_hash:
+            setattr(self, key, kwargs.get(key))
+
+    @classmethod
+    def _decode_row(cls, row_key, row_data):
+        data = cls.deserialize_row_key(row_key)
+        column_decoders = cls._column_decoders
+        for column_key, column_value in row_data.items():
+            decoder = column_decoders.get(column_key)
+            if decoder is None:
+                # remove column family
+                column_key = column_key.decode('utf-8')
+                key = column_key[column_key.find(':') + 1:]
+                data[key] = cls.deserialize_field(key, column_value)
+                continue
+            key, deserialize = decoder
+            data[key] = deserialize(column_value.decode('utf-8'))
+        return data
 
     @classmethod
     def init_from_row(cls, row_key, row_data):
         if not row_data:
             return None
-        data = cls.deserialize_row_key(row_key)
-        for column_key, column_value in row_data.items():
-            # remove column family
-            column_key = column_key.decode('utf-8')
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
-        return cls(**data)
+        return cls(**cls._decode_row(row_key, row_data))
 
     @classmethod
     def serialize_row_key(cls, data, is_prefix=False):
@@ -52,24 +178,35 @@ class HBaseModel:
         {key1: val1} => b"val1"
         {key1: val1, key2: val2} => b"val1:val2"
         {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
+        binary codec 里直接把每个 field 的 8 个字节拼起来
         """
-        field_hash = cls.get_field_hash()
+        if cls._is_binary_row_key:
+            return cls._serialize_binary_row_key(data, is_prefix)
         values = []
-        for key in cls.Meta.row_key:
-            field = field_hash.get(key)
-            if field.column_family: # 也许这个不用了
-                continue
+        for key, field, serialize, _ in cls._row_key_fields:
             value = data.get(key)
             if value is None:
                 if not is_prefix:
                     raise BadRowKeyError(f"{key} is missing in row key")
                 break
-            value = cls.serialize_field(field, value)
+            value = serialize(value)
             if ':' in value:
                 raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
             values.append(value)
         return bytes(':'.join(values), encoding='utf-8')
 
+    @classmethod
+    def _serialize_binary_row_key(cls, data, is_prefix):
+        values = []
+        for key, field, serialize, _ in cls._row_key_fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            values.append(serialize(value))
+        return b''.join(values)
+
     @classmethod
     def deserialize_row_key(cls, row_key):
         """
@@ -77,73 +214,87 @@ class HBaseModel:
         "val1:val2" => {'key1': val1, 'key2': val2, 'key3': None}
         "val1:val2:val3" => {'key1': val1, 'key2': val2, 'key3': val3}
         """
-        data = {}
+        if cls._is_binary_row_key:
+            return {
+                key: deserialize(row_key[index:index + BINARY_FIELD_WIDTH])
+                for index, (key, _, _, deserialize) in zip(
+                    range(0, len(row_key), BINARY_FIELD_WIDTH),
+                    cls._row_key_fields,
+                )
+            }
         if isinstance(row_key, bytes):
             row_key = row_key.decode('utf-8')
-
-        # val1:val2 => val1:val2: 方便每次 find(':') 都能找到一个 val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
-        return data
+        return {
+            key: deserialize(value)
+            for (key, _, _, deserialize), value in zip(cls._row_key_fields, row_key.split(':'))
+        }
 
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return cls._build_serializer(field)(value)
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return cls._build_deserializer(cls._field_hash[key])(value)
 
     @classmethod
     def serialize_row_data(cls, data):
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            if not field.column_family:
-                continue
-            column_key = '{}:{}'.format(field.column_family, key)
+        for key, column_key, serialize in cls._column_fields:
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            row_data[column_key] = serialize(column_value)
         return row_data
 
     def save(self, batch=None):
         row_data = self.serialize_row_data(self.__dict__)
         if len(row_data) == 0:
             raise EmptyColumnError()
+        row_key = self.row_key
         if batch:
-            batch.put(self.row_key, row_data)
+            batch.put(row_key, row_data)
         else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            HBaseClient.execute(
+                self.get_table_name(),
+                'put',
+                lambda table: table.put(row_key, row_data),
+            )
 
     @classmethod
     def get(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row_data = table.row(row_key)
+        row_data = HBaseClient.execute(
+            cls.get_table_name(),
+            'get',
+            lambda table: table.row(row_key),
+            retry=True,
+        )
         return cls.init_from_row(row_key, row_data)
 
+    @classmethod
+    def get_many(cls, list_of_kwargs):
+        """
+        用一次 thrift 请求读取多个 row，按照传入的顺序返回 instances，不存在的 row 返回 None
+        [{key1: val1, key2: val2}, ...] => [instance1, None, ...]
+        """
+        if not list_of_kwargs:
+            return []
+        row_keys = [cls.serialize_row_key(kwargs) for kwargs in list_of_kwargs]
+        # table.rows 只返回存在的 rows，而且不保证和传入的顺序一致
+        rows = HBaseClient.execute(
+            cls.get_table_name(),
+            'get_many',
+            lambda table: dict(table.rows(row_keys)),
+            retry=True,
+        )
+        return [
+            cls.init_from_row(row_key, rows.get(row_key))
+            for row_key in row_keys
+        ]
+
     @classmethod
     def create(cls, batch=None, **kwargs):
         instance = cls(**kwargs)
@@ -152,13 +303,14 @@ class HBaseModel:
 
     @classmethod
     def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
-        results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
-        return results
+        def _batch_create(table):
+            batch = table.batch()
+            results = []
+            for data in batch_data:
+                results.append(cls.create(batch=batch, **data))
+            batch.send()
+            return results
+        return HBaseClient.execute(cls.get_table_name(), 'batch', _batch_create)
 
     @classmethod
     def get_table_name(cls):
@@ -173,24 +325,24 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        # convert table name from bytes to str
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            # convert table name from bytes to str
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                field.column_family: dict()
+                for key, field in cls.get_field_hash().items()
+                if field.column_family is not None
+            }
+            conn.create_table(cls.get_table_name(), column_families)
 
     # <HOMEWORK> 实现一个 get_or_create 的方法，返回 (instance, created)
 
@@ -205,25 +357,71 @@ class HBaseModel:
         return cls.serialize_row_key(data, is_prefix=True)
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+    def scan(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, batch_size=1000):
+        """
+        和 filter 的参数一样，但是返回的是一个 generator
+        每次从 hbase 里读取 batch_size 行，读到一行就 yield 一个 instance
+        不会把所有的 instance 都放在内存里，适合扫描很大的范围
+        """
         # serialize tuple to str
         row_start = cls.serialize_row_key_from_tuple(start)
         row_stop = cls.serialize_row_key_from_tuple(stop)
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
 
         # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
+        rows = HBaseClient.scan(
+            cls.get_table_name(),
+            row_start=row_start,
+            row_stop=row_stop,
+            row_prefix=row_prefix,
+            limit=limit,
+            reverse=reverse,
+            batch_size=batch_size,
+        )
+
+        # deserialize to instance
+        for row_key, row_data in rows:
+            yield cls.init_from_row(row_key, row_data)
+
+    @classmethod
+    def init_row_from_row(cls, row_key, row_data):
+        """
+        和 init_from_row 一样解码一行数据，但是返回的是一个只读的 namedtuple
+        namedtuple 没有 __dict__，只占一个 tuple 的内存，适合在内存里放大量的 rows
+        """
+        if not row_data:
+            return None
+        data = cls._decode_row(row_key, row_data)
+        return cls._row_class(*[data.get(key) for key in cls._field_hash])
 
-        # deserialize to instance list
-        results = []
+    @classmethod
+    def scan_rows(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, batch_size=1000):
+        """
+        和 scan 的参数一样，但是 yield 的是只读的 namedtuple 而不是 model instance
+        只需要读取 fields 的时候使用，比如扫描一个大V的所有粉丝
+        namedtuple 不能 save，也没有 row_key 等 model 上的方法
+        """
+        rows = HBaseClient.scan(
+            cls.get_table_name(),
+            row_start=cls.serialize_row_key_from_tuple(start),
+            row_stop=cls.serialize_row_key_from_tuple(stop),
+            row_prefix=cls.serialize_row_key_from_tuple(prefix),
+            limit=limit,
+            reverse=reverse,
+            batch_size=batch_size,
+        )
         for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+            yield cls.init_row_from_row(row_key, row_data)
+
+    @classmethod
+    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+        return list(cls.scan(start=start, stop=stop, prefix=prefix, limit=limit, reverse=reverse))
 
     @classmethod
     def delete(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
\ No newline at end of file
+        return HBaseClient.execute(
+            cls.get_table_name(),
+            'delete',
+            lambda table: table.delete(row_key),
+        )
\ No newline at end of file
@@ -7,11 +7,31 @@ from rest_framework.exceptions import ValidationError
 from accounts.services import UserService
 
 
+class FriendshipListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # 用一次 redis pipeline 检查当前用户有没有关注这一页里的每个人
+        # 不需要把当前用户关注的所有人都读出来
+        friendships = list(data)
+        user = self.context['request'].user
+        if user.is_anonymous:
+            self.context['followed_user_ids'] = set()
+        else:
+            self.context['followed_user_ids'] = FriendshipService.get_followed_user_ids(
+                user.id,
+                [self.child.get_user_id(friendship) for friendship in friendships],
+            )
+        return super(FriendshipListSerializer, self).to_representation(friendships)
+
+
 class BaseFriendshipSerializer(serializers.Serializer):
     user = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
     has_followed = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = FriendshipListSerializer
+
     def update(self, instance, validated_data):
         pass
 
@@ -21,19 +41,16 @@ class BaseFriendshipSerializer(serializers.Serializer):
     def get_user_id(self, obj):
         raise NotImplementedError # 继承的时候必须要写，否则报错
 
-    def _get_following_user_id_set(self):
+    def get_has_followed(self, obj):
+        followed_user_ids = self.context.get('followed_user_ids')
+        if followed_user_ids is not None:
+            return self.get_user_id(obj) in followed_user_ids
         if self.context['request'].user.is_anonymous:
-            return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
+            return False
+        return FriendshipService.has_followed(
             self.context['request'].user.id,
+            self.get_user_id(obj),
         )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
-
-    def get_has_followed(self, obj):
-        return self.get_user_id(obj) in self._get_following_user_id_set()
 
     def get_user(self, obj):
         user = UserService.get_user_by_id(self.get_user_id(obj))
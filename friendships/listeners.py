@@ -1,3 +1,21 @@
-def invalidate_following_cache(sender, instance, **kwargs):
+from django.db import transaction
+
+
+def add_following_to_cache(sender, instance, created, **kwargs):
+    if not created:
+        return
+
+    # 事务提交之后再更新 cache，否则别的进程在提交之前从数据库 load 的 set 里还没有这个人
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    transaction.on_commit(lambda: FriendshipService.add_following_to_cache(
+        instance.from_user_id,
+        instance.to_user_id,
+    ))
+
+
+def remove_following_from_cache(sender, instance, **kwargs):
+    from friendships.services import FriendshipService
+    transaction.on_commit(lambda: FriendshipService.remove_following_from_cache(
+        instance.from_user_id,
+        instance.to_user_id,
+    ))
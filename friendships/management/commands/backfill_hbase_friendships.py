@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from friendships.models import HBaseFollowing, HBaseFriendship
+
+
+class Command(BaseCommand):
+    """
+    扫描 HBaseFollowing 里已有的数据，写入 HBaseFriendship 这个 (from_user_id, to_user_id) 的索引
+    上线 HBaseFriendship 之前创建的关注关系在索引里没有记录，has_followed 和 unfollow 会找不到
+    重复执行是安全的，同一个 row_key 只会被覆盖
+    用法: python manage.py backfill_hbase_friendships --batch-size 1000
+    """
+    help = 'Backfill the HBaseFriendship index from HBaseFollowing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        batch_params = []
+        for following in HBaseFollowing.scan(batch_size=batch_size):
+            batch_params.append({
+                'from_user_id': following.from_user_id,
+                'to_user_id': following.to_user_id,
+                'created_at': following.created_at,
+            })
+            if len(batch_params) == batch_size:
+                HBaseFriendship.batch_create(batch_params)
+                total += len(batch_params)
+                batch_params = []
+        if batch_params:
+            HBaseFriendship.batch_create(batch_params)
+            total += len(batch_params)
+        self.stdout.write('{} friendships backfilled.'.format(total))
@@ -1,7 +1,7 @@
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save, pre_delete
-from friendships.listeners import invalidate_following_cache
+from django.db.models.signals import post_delete, post_save
+from friendships.listeners import add_following_to_cache, remove_following_from_cache
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -42,7 +42,7 @@ class Friendship(models.Model):
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
 
-# 我们在 save 之后，delete 之前，我要做这两个事件的监听
-# hook up with listeners to invalidate cache
-pre_delete.connect(invalidate_following_cache, sender=Friendship)
-post_save.connect(invalidate_following_cache, sender=Friendship)
\ No newline at end of file
+# 我们在 save 之后，delete 之后，我要做这两个事件的监听
+# hook up with listeners to update the followings set in redis
+post_delete.connect(remove_following_from_cache, sender=Friendship)
+post_save.connect(add_following_to_cache, sender=Friendship)
\ No newline at end of file
@@ -36,4 +36,22 @@ class HBaseFollower(models.HBaseModel):
 
     class Meta:
         row_key = ('to_user_id', 'created_at')
-        table_name = 'twitter_followers'
\ No newline at end of file
+        table_name = 'twitter_followers'
+
+
+class HBaseFriendship(models.HBaseModel):
+    """
+    HBaseFollowing 的二级索引，row_key 是 from_user_id + to_user_id
+    HBaseFollowing 的 row_key 里没有 to_user_id，查询 A 有没有关注 B 需要扫描 A 关注的所有人
+    有了这张表之后 has_followed 和 unfollow 都只需要一次 get
+    created_at 用来找到 HBaseFollowing 和 HBaseFollower 里对应的 row
+    """
+    # row key
+    from_user_id = models.IntegerField(reverse=True)
+    to_user_id = models.IntegerField()
+    # column key
+    created_at = models.TimestampField(column_family='cf')
+
+    class Meta:
+        row_key = ('from_user_id', 'to_user_id')
+        table_name = 'twitter_friendships'
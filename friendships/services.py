@@ -1,13 +1,20 @@
 from django.conf import settings
 from django.core.cache import caches
-from friendships.models import Friendship, HBaseFollowing, HBaseFollower
+from friendships.models import Friendship, HBaseFollowing, HBaseFollower, HBaseFriendship
 from gatekeeper.models import GateKeeper
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import FOLLOWINGS_PATTERN, FOLLOWER_COUNT_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
 
 import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# user id 都是正整数，用 0 作为占位符表示这个 set 已经 load 过了
+# 否则没有关注任何人的用户的 set 在 redis 里不存在，每次都会去 HBase 或者 MySQL 里 load
+FOLLOWING_SET_PLACEHOLDER = 0
+
 
 class FriendshipService(object):
 
@@ -16,27 +23,132 @@ class FriendshipService(object):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             friendships = Friendship.objects.filter(to_user_id=to_user_id)
         else:
-            friendships = HBaseFollower.filter(prefix=(to_user_id,))
+            friendships = HBaseFollower.scan_rows(prefix=(to_user_id,))
         return [friendship.from_user_id for friendship in friendships]
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
-        # <TODO> cache in redis set
+    def get_follower_id_batches(cls, to_user_id, batch_size):
+        """
+        按照 batch_size 一批一批地返回 follower ids，是一个 generator
+        粉丝很多的时候不需要先把所有的 follower 都读到内存里
+        """
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = Friendship.objects.filter(from_user_id=from_user_id)
+            follower_ids = Friendship.objects.filter(to_user_id=to_user_id)\
+                .values_list('from_user_id', flat=True)\
+                .iterator(chunk_size=batch_size)
         else:
-            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
+            follower_ids = (
+                follower.from_user_id
+                for follower in HBaseFollower.scan_rows(prefix=(to_user_id,), batch_size=batch_size)
+            )
 
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
-        ])
+        batch_ids = []
+        for follower_id in follower_ids:
+            batch_ids.append(follower_id)
+            if len(batch_ids) == batch_size:
+                yield batch_ids
+                batch_ids = []
+        if batch_ids:
+            yield batch_ids
+
+    @classmethod
+    def get_follower_count(cls, to_user_id, limit=None):
+        """
+        只用于判断是否是大V，不需要特别精确，所以 cache 一个小时
+        follow 和 unfollow 的时候不删除 cache，否则大V一直有人关注，cache 基本上总是 miss
+        每次 fanout 都要重新数一遍所有的粉丝
+        传了 limit 的话数到 limit 个就停下来，返回值最多是 limit，粉丝很多的时候不用扫描所有的 rows
+        """
+        key = FOLLOWER_COUNT_PATTERN.format(user_id=to_user_id, limit=limit)
+        count = cache.get(key)
+        if count is not None:
+            return count
+
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            count = Friendship.objects.filter(to_user_id=to_user_id)[:limit].count()
+        else:
+            count = sum(1 for _ in HBaseFollower.scan_rows(prefix=(to_user_id,), limit=limit))
+        cache.set(key, count, ONE_HOUR)
+        return count
+
+    @classmethod
+    def _load_following_user_id_set(cls, from_user_id):
+        # 读取数据库之前先拿到 version，load 期间有 follow 或者 unfollow 的话不写 cache
+        # 否则 cache 里会留下一个少了或者多了一个人的 set
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        version = RedisHelper.get_set_version(key)
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            user_id_set = set(Friendship.objects.filter(
+                from_user_id=from_user_id,
+            ).values_list('to_user_id', flat=True))
+        else:
+            user_id_set = set(
+                following.to_user_id
+                for following in HBaseFollowing.scan_rows(prefix=(from_user_id, None))
+            )
+
+        RedisHelper.load_set_if_unchanged(key, version, [FOLLOWING_SET_PLACEHOLDER, *user_id_set])
         return user_id_set
 
     @classmethod
-    def invalidate_following_cache(cls, from_user_id):
+    def get_following_user_id_set(cls, from_user_id):
+        """
+        关注的人的 user ids 存在 redis 的 set 里，follow 和 unfollow 的时候增量更新
+        只有 cache miss 的时候才需要扫描 HBase 或者 MySQL
+        """
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        members = conn.smembers(key)
+        if members:
+            user_id_set = set(int(member) for member in members)
+            user_id_set.discard(FOLLOWING_SET_PLACEHOLDER)
+            return user_id_set
+        return cls._load_following_user_id_set(from_user_id)
+
+    @classmethod
+    def get_followed_user_ids(cls, from_user_id, to_user_ids):
+        """
+        批量版本的 has_followed，返回 to_user_ids 里 from_user_id 关注了的那些 user ids
+        和 LikeService.get_liked_object_ids 一样，用一次 pipeline 发送 EXISTS 和多个 SISMEMBER
+        不需要把所有关注的人都读出来
+        """
+        if not to_user_ids:
+            return set()
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.exists(key)
+        for to_user_id in to_user_ids:
+            pipeline.sismember(key, to_user_id)
+        exists, *results = pipeline.execute()
+        if exists:
+            return {
+                to_user_id
+                for to_user_id, is_member in zip(to_user_ids, results)
+                if is_member
+            }
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return cls._load_following_user_id_set(from_user_id) & set(to_user_ids)
+
+        # 一页通常只有几十个 user，用 HBaseFriendship 索引一次 get_many 查出来
+        # 不需要扫描所有关注的人来 load 整个 set，和 has_followed 一样
+        instances = HBaseFriendship.get_many([
+            {'from_user_id': from_user_id, 'to_user_id': to_user_id}
+            for to_user_id in to_user_ids
+            if to_user_id != from_user_id
+        ])
+        return {instance.to_user_id for instance in instances if instance is not None}
+
+    @classmethod
+    def add_following_to_cache(cls, from_user_id, to_user_id):
+        # 不在 cache 里的话不用管，下次读取的时候会 load 完整的 set
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        RedisHelper.add_to_set_if_cached(key, to_user_id)
+
+    @classmethod
+    def remove_following_from_cache(cls, from_user_id, to_user_id):
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.remove_from_set(key, to_user_id)
 
     @classmethod
     def follow(cls, from_user_id, to_user_id):
@@ -57,11 +169,19 @@ class FriendshipService(object):
             to_user_id=to_user_id,
             created_at=now,
         )
-        return HBaseFollowing.create(
+        instance = HBaseFollowing.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=now,
+        )
+        HBaseFriendship.create(
             from_user_id=from_user_id,
             to_user_id=to_user_id,
             created_at=now,
         )
+        # MySQL 的 Friendship 由 friendships.listeners 更新 cache，HBase 没有 signal 需要在这里更新
+        cls.add_following_to_cache(from_user_id, to_user_id)
+        return instance
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -81,21 +201,31 @@ class FriendshipService(object):
 
         HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
         HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
+        HBaseFriendship.delete(from_user_id=from_user_id, to_user_id=to_user_id)
+        cls.remove_following_from_cache(from_user_id, to_user_id)
         return 1
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
-        return None
+        # 用 HBaseFriendship 这个二级索引一次 get 拿到关注的时间，不需要扫描所有的 followings
+        # 返回的 instance 里有 created_at，可以用来定位 HBaseFollowing 和 HBaseFollower 里的 row
+        return HBaseFriendship.get(from_user_id=from_user_id, to_user_id=to_user_id)
 
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
             return False
 
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.exists(key)
+        pipeline.sismember(key, to_user_id)
+        exists, is_member = pipeline.execute()
+        if exists:
+            return bool(is_member)
+
+        # 只查一个人的时候不需要 load 整个 set，直接去数据库里查
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(
                 from_user_id=from_user_id,
@@ -109,5 +239,4 @@ class FriendshipService(object):
     def get_following_count(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(from_user_id=from_user_id).count()
-        followings = HBaseFollowing.filter(prefix=(from_user_id,))
-        return len(followings)
\ No newline at end of file
+        return sum(1 for _ in HBaseFollowing.scan_rows(prefix=(from_user_id,)))
\ No newline at end of file
@@ -1,7 +1,17 @@
-from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import Friendship, HBaseFollowing, HBaseFollower
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django_hbase import models
+from django_hbase.client import HBaseClient
+from django_hbase.models import EmptyColumnError, BadRowKeyError, ROW_KEY_CODEC_BINARY
+from friendships.models import Friendship, HBaseFollowing, HBaseFollower, HBaseFriendship
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from io import StringIO
 from testing.testcases import TestCase
+from thriftpy2.transport import TTransportException
+from twitter.cache import FOLLOWINGS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 
 import time
 
@@ -26,6 +36,125 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(self.linghu.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
+    def test_following_set_in_redis(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        self.create_friendship(from_user=self.linghu, to_user=user1)
+        conn = RedisClient.get_connection()
+        key = FOLLOWINGS_PATTERN.format(user_id=self.linghu.id)
+
+        # 没有关注任何人的用户也会在 cache 里留下一个占位符
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.dongxie.id), set())
+        self.assertEqual(conn.exists(FOLLOWINGS_PATTERN.format(user_id=self.dongxie.id)), True)
+
+        # 不在 cache 里的时候 follow 不会写一个不完整的 set
+        # get_followed_user_ids 直接用 HBaseFriendship 索引查询，不 load 整个 set
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.linghu.id, [user1.id, user2.id]),
+            {user1.id},
+        )
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.linghu.id), {user1.id})
+        self.assertEqual(conn.exists(key), True)
+
+        # follow 和 unfollow 增量更新 cache，不需要重新 load
+        self.create_friendship(from_user=self.linghu, to_user=user2)
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+        FriendshipService.unfollow(self.linghu.id, user1.id)
+        self.assertEqual(conn.sismember(key, user2.id), True)
+        self.assertEqual(conn.sismember(key, user1.id), False)
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, self.dongxie.id), True)
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), False)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {user2.id, self.dongxie.id},
+        )
+
+        # MySQL 的 Friendship 通过 listener 在事务提交之后更新 cache
+        GateKeeper.set_kv('switch_friendship_to_hbase', 'percent', 0)
+        FriendshipService.follow(self.linghu.id, user1.id)
+        self.assertEqual(conn.sismember(key, user1.id), False)
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), True)
+        FriendshipService.unfollow(self.linghu.id, user1.id)
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.has_followed(self.linghu.id, user1.id), False)
+
+    def test_following_set_load_race(self):
+        user1 = self.create_user('user1')
+        key = FOLLOWINGS_PATTERN.format(user_id=self.linghu.id)
+        conn = RedisClient.get_connection()
+
+        # load 的期间有 follow，set 里少了这个人，不能写入 cache
+        version = RedisHelper.get_set_version(key)
+        FriendshipService.add_following_to_cache(self.linghu.id, user1.id)
+        self.assertEqual(RedisHelper.load_set_if_unchanged(key, version, [0]), False)
+        self.assertEqual(conn.exists(key), False)
+
+        # 没有修改的话正常写入，之后的 unfollow 也会让正在进行的 load 失效
+        version = RedisHelper.get_set_version(key)
+        self.assertEqual(RedisHelper.load_set_if_unchanged(key, version, [0, user1.id]), True)
+        FriendshipService.remove_following_from_cache(self.linghu.id, user1.id)
+        self.assertEqual(RedisHelper.load_set_if_unchanged(key, version, [0, user1.id]), False)
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.linghu.id), set())
+
+    def test_friendship_index(self):
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+        instance = HBaseFriendship.get(from_user_id=self.linghu.id, to_user_id=self.dongxie.id)
+        following = HBaseFollowing.filter(prefix=(self.linghu.id, None))[0]
+        self.assertEqual(instance.created_at, following.created_at)
+
+        # redis 里没有 followings 的时候 has_followed 直接用索引查询
+        self.clear_cache()
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, self.dongxie.id), True)
+        self.assertEqual(FriendshipService.has_followed(self.dongxie.id, self.linghu.id), False)
+
+        # unfollow 把三张表里的数据都删掉
+        self.assertEqual(FriendshipService.unfollow(self.linghu.id, self.dongxie.id), 1)
+        self.assertEqual(FriendshipService.unfollow(self.linghu.id, self.dongxie.id), 0)
+        self.assertEqual(HBaseFriendship.get(from_user_id=self.linghu.id, to_user_id=self.dongxie.id), None)
+        self.assertEqual(HBaseFollowing.filter(prefix=(self.linghu.id, None)), [])
+        self.assertEqual(HBaseFollower.filter(prefix=(self.dongxie.id, None)), [])
+
+    def test_backfill_hbase_friendships(self):
+        # 索引上线之前的关注关系只存在 HBaseFollowing 和 HBaseFollower 里
+        for to_user_id, created_at in [(2, 1000), (3, 2000), (4, 3000)]:
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=created_at)
+            HBaseFollower.create(from_user_id=1, to_user_id=to_user_id, created_at=created_at)
+        self.assertEqual(FriendshipService.has_followed(1, 3), False)
+
+        call_command('backfill_hbase_friendships', batch_size=2, stdout=StringIO())
+        instance = HBaseFriendship.get(from_user_id=1, to_user_id=3)
+        self.assertEqual(instance.created_at, 2000)
+        self.assertEqual(FriendshipService.has_followed(1, 3), True)
+        self.assertEqual(FriendshipService.unfollow(1, 3), 1)
+        self.assertEqual([f.to_user_id for f in HBaseFollowing.filter(prefix=(1, None))], [2, 4])
+
+    def test_get_follower_id_batches(self):
+        follower_ids = []
+        for i in range(5):
+            follower = self.create_user('follower{}'.format(i))
+            self.create_friendship(from_user=follower, to_user=self.linghu)
+            follower_ids.append(follower.id)
+
+        batches = list(FriendshipService.get_follower_id_batches(self.linghu.id, 2))
+        self.assertEqual([len(batch_ids) for batch_ids in batches], [2, 2, 1])
+        self.assertSetEqual(
+            set(follower_id for batch_ids in batches for follower_id in batch_ids),
+            set(follower_ids),
+        )
+
+        batches = list(FriendshipService.get_follower_id_batches(self.dongxie.id, 2))
+        self.assertEqual(batches, [])
+
+        # 数到 limit 个就停下来
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id, limit=3), 3)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 5)
+        self.assertEqual(FriendshipService.get_follower_count(self.dongxie.id, limit=3), 0)
+
 
 class HBaseTests(TestCase):
 
@@ -53,6 +182,31 @@ class HBaseTests(TestCase):
         instance = HBaseFollowing.get(from_user_id=123, created_at=self.ts_now)
         self.assertEqual(instance, None)
 
+    def test_get_many(self):
+        timestamp = self.ts_now
+        HBaseFollowing.create(from_user_id=123, to_user_id=34, created_at=timestamp)
+        HBaseFollowing.create(from_user_id=124, to_user_id=35, created_at=timestamp + 1)
+        HBaseClient.reset_metrics()
+
+        # 按照传入的顺序返回，不存在的 row 返回 None，只需要一次请求
+        instances = HBaseFollowing.get_many([
+            {'from_user_id': 124, 'created_at': timestamp + 1},
+            {'from_user_id': 123, 'created_at': timestamp + 1},
+            {'from_user_id': 123, 'created_at': timestamp},
+        ])
+        self.assertEqual(instances[0].to_user_id, 35)
+        self.assertEqual(instances[1], None)
+        self.assertEqual(instances[2].to_user_id, 34)
+        self.assertEqual(HBaseClient.get_metrics()['get_many']['count'], 1)
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+        try:
+            HBaseFollowing.get_many([{'from_user_id': 123}])
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
     def test_create_and_get(self):
         # missing column data, can not store in hbase
         try:
@@ -138,4 +292,199 @@ class HBaseTests(TestCase):
         results = HBaseFollowing.filter(start=(1, results[1].created_at), limit=2, reverse=True)
         self.assertEqual(len(results), 2)
         self.assertEqual(results[0].to_user_id, 3)
-        self.assertEqual(results[1].to_user_id, 2)
\ No newline at end of file
+        self.assertEqual(results[1].to_user_id, 2)
+
+    def test_scan(self):
+        for to_user_id in range(2, 7):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+
+        # scan 返回的是 generator，结果和 filter 一致
+        results = HBaseFollowing.scan(prefix=(1, None), batch_size=2)
+        self.assertEqual(isinstance(results, list), False)
+        self.assertEqual([r.to_user_id for r in results], [2, 3, 4, 5, 6])
+
+        results = HBaseFollowing.scan(prefix=(1, None), limit=3, reverse=True, batch_size=2)
+        self.assertEqual([r.to_user_id for r in results], [6, 5, 4])
+
+        # scan_rows 返回只读的 namedtuple，字段和 model instance 一致
+        rows = list(HBaseFollowing.scan_rows(prefix=(1, None), limit=2, batch_size=2))
+        instances = HBaseFollowing.filter(prefix=(1, None), limit=2)
+        self.assertEqual(isinstance(rows[0], tuple), True)
+        self.assertEqual(rows[0]._fields, ('from_user_id', 'created_at', 'to_user_id'))
+        self.assertEqual(
+            [(r.from_user_id, r.created_at, r.to_user_id) for r in rows],
+            [(i.from_user_id, i.created_at, i.to_user_id) for i in instances],
+        )
+
+    def test_field_metadata(self):
+        # field 的元信息在定义 class 的时候就算好了，子类会继承父类的 fields
+        class HBaseFollowingWithSource(HBaseFollowing):
+            source = models.IntegerField(column_family='cf')
+
+        self.assertEqual(
+            list(HBaseFollowing.get_field_hash()),
+            ['from_user_id', 'created_at', 'to_user_id'],
+        )
+        self.assertEqual(
+            list(HBaseFollowingWithSource.get_field_hash()),
+            ['from_user_id', 'created_at', 'to_user_id', 'source'],
+        )
+
+        ts = self.ts_now
+        instance = HBaseFollowingWithSource(from_user_id=12, created_at=ts, to_user_id=3, source=2)
+        self.assertEqual(instance.row_key, '2100000000000000:{}'.format(ts).encode('utf-8'))
+        self.assertEqual(
+            HBaseFollowingWithSource.serialize_row_data(instance.__dict__),
+            {'cf:to_user_id': '0000000000000003', 'cf:source': '0000000000000002'},
+        )
+        instance = HBaseFollowingWithSource.init_from_row(instance.row_key, {
+            b'cf:to_user_id': b'0000000000000003',
+            b'cf:source': b'0000000000000002',
+        })
+        self.assertEqual(
+            (instance.from_user_id, instance.created_at, instance.to_user_id, instance.source),
+            (12, ts, 3, 2),
+        )
+
+        # row key 里写错的名字和 column family 里的 field 在定义 class 的时候就报错
+        with self.assertRaises(ImproperlyConfigured):
+            class HBaseFollowingWithTypo(HBaseFollowing):
+                class Meta:
+                    table_name = 'twitter_followings'
+                    row_key = ('from_user_id', 'create_at')
+        with self.assertRaises(ImproperlyConfigured):
+            class HBaseFollowingWithColumnInRowKey(HBaseFollowing):
+                class Meta:
+                    table_name = 'twitter_followings'
+                    row_key = ('from_user_id', 'to_user_id')
+
+    def test_binary_row_key_codec(self):
+        binary_class = HBaseFollowing.with_row_key_codec(
+            ROW_KEY_CODEC_BINARY,
+            'twitter_followings_binary',
+        )
+        # binary codec 不支持的 field 类型和不认识的 codec 在定义 class 的时候就报错
+        class StringField(models.HBaseField):
+            field_type = 'string'
+
+        with self.assertRaises(ImproperlyConfigured):
+            class HBaseFollowingWithStringKey(models.HBaseModel):
+                name = StringField()
+
+                class Meta:
+                    table_name = 'twitter_followings'
+                    row_key = ('name',)
+                    row_key_codec = ROW_KEY_CODEC_BINARY
+        with self.assertRaises(ImproperlyConfigured):
+            HBaseFollowing.with_row_key_codec('base64')
+
+        # 不是直接定义在 models.py 里的 class，测试里需要自己建表
+        binary_class.create_table()
+        try:
+            ts = self.ts_now
+            instance = binary_class.create(from_user_id=12, created_at=ts, to_user_id=3)
+            self.assertEqual(len(instance.row_key), 16)
+            self.assertEqual(binary_class.deserialize_row_key(instance.row_key), {
+                'from_user_id': 12,
+                'created_at': ts,
+            })
+            instance = binary_class.get(from_user_id=12, created_at=ts)
+            self.assertEqual(instance.to_user_id, 3)
+
+            for i in range(1, 4):
+                binary_class.create(from_user_id=13, created_at=ts + i, to_user_id=i)
+            # 前缀查询和范围查询的顺序和 string codec 一样
+            instances = binary_class.filter(prefix=(13, None))
+            self.assertEqual([i.to_user_id for i in instances], [1, 2, 3])
+            instances = binary_class.filter(prefix=(13, None), reverse=True)
+            self.assertEqual([i.to_user_id for i in instances], [3, 2, 1])
+            instances = binary_class.filter(start=(13, ts + 2), stop=(13, ts + 4))
+            self.assertEqual([i.to_user_id for i in instances], [2, 3])
+            instances = binary_class.filter(prefix=(12, None))
+            self.assertEqual([i.to_user_id for i in instances], [3])
+
+            # 用 migrate_hbase_row_keys 把 string codec 的表复制到 binary codec 的表里
+            binary_class.drop_table()
+            binary_class.create_table()
+            HBaseFollowing.create(from_user_id=14, created_at=ts, to_user_id=5)
+            out = StringIO()
+            call_command(
+                'migrate_hbase_row_keys',
+                'friendships.models.HBaseFollowing',
+                'twitter_followings_binary',
+                stdout=out,
+            )
+            self.assertIn('1 rows copied', out.getvalue())
+            instance = binary_class.get(from_user_id=14, created_at=ts)
+            self.assertEqual(instance.to_user_id, 5)
+
+            # 源表里删掉的数据用 --prune 从目标表里删掉
+            HBaseFollowing.create(from_user_id=14, created_at=ts + 1, to_user_id=6)
+            call_command(
+                'migrate_hbase_row_keys',
+                'friendships.models.HBaseFollowing',
+                'twitter_followings_binary',
+                stdout=StringIO(),
+            )
+            HBaseFollowing.delete(from_user_id=14, created_at=ts)
+            out = StringIO()
+            call_command(
+                'migrate_hbase_row_keys',
+                'friendships.models.HBaseFollowing',
+                'twitter_followings_binary',
+                prune=True,
+                stdout=out,
+            )
+            self.assertIn('1 rows deleted', out.getvalue())
+            instances = binary_class.filter(prefix=(14, None))
+            self.assertEqual([i.to_user_id for i in instances], [6])
+
+            # 对比两种编码扫描同样数据的速度
+            out = StringIO()
+            call_command(
+                'benchmark_hbase_models',
+                model=['friendships.models.HBaseFollowing'],
+                count=10,
+                repeat=1,
+                prefix=14,
+                binary_table='twitter_followings_binary',
+                stdout=out,
+            )
+            self.assertIn('scan HBaseFollowing', out.getvalue())
+            self.assertIn('scan binary', out.getvalue())
+        finally:
+            binary_class.drop_table()
+
+    def test_client_retry_and_metrics(self):
+        HBaseClient.reset_metrics()
+        table_name = HBaseFollowing.get_table_name()
+        calls = []
+
+        def flaky_get(table):
+            calls.append(table)
+            if len(calls) == 1:
+                raise TTransportException(message='connection reset')
+            return table.row(b'not-exists')
+
+        # 读操作遇到连接错误会换一个连接重试
+        self.assertEqual(HBaseClient.execute(table_name, 'get', flaky_get, retry=True), {})
+        self.assertEqual(len(calls), 2)
+        metrics = HBaseClient.get_metrics()['get']
+        self.assertEqual((metrics['count'], metrics['errors'], metrics['retries']), (2, 1, 1))
+
+        # 写操作不重试，直接把异常抛给调用方
+        def broken_put(table):
+            calls.append(table)
+            raise TTransportException(message='connection reset')
+
+        with self.assertRaises(TTransportException):
+            HBaseClient.execute(table_name, 'put', broken_put)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(HBaseClient.get_metrics()['put']['errors'], 1)
+
+        # model 的操作都会记录耗时
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=self.ts_now)
+        HBaseFollowing.filter(prefix=(1, None))
+        metrics = HBaseClient.get_metrics()
+        self.assertEqual(metrics['put']['count'], 2)
+        self.assertEqual(metrics['scan']['count'], 1)
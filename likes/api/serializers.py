@@ -1,11 +1,22 @@
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
 from comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Manager
 from likes.models import Like
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 
+class LikeListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # 一页 likes 的 user 和 profile 批量读取
+        likes = list(data.all() if isinstance(data, Manager) else data)
+        UserService.prefetch_users(likes)
+        return super(LikeListSerializer, self).to_representation(likes)
+
+
 # 这里只需要 user 和 created_at
 # 因为你获取点赞信息一定是基于 comment 或 tweet
 # 所以不用加 comment 和 tweet 信息
@@ -14,6 +25,7 @@ class LikeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Like
+        list_serializer_class = LikeListSerializer
         fields = ('user', 'created_at')
 
 
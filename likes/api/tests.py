@@ -1,5 +1,6 @@
 from testing.testcases import TestCase
 from rest_framework.test import APIClient
+from utils.redis_helper import RedisHelper
 
 
 LIKE_BASE_URL = '/api/likes/'
@@ -226,15 +227,19 @@ class LikeApiTests(TestCase):
         tweet = self.create_tweet(self.linghu)
         data = {'content_type': 'tweet', 'object_id': tweet.id}
         self.linghu_client.post(LIKE_BASE_URL, data)
+        self.run_on_commit_callbacks()
 
         tweet_url = TWEET_DETAIL_API.format(tweet.id)
         response = self.linghu_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 1)
+        RedisHelper.flush_count_deltas()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 1)
 
         # dongxie canceled likes
         self.linghu_client.post(LIKE_BASE_URL + 'cancel/', data)
+        self.run_on_commit_callbacks()
+        RedisHelper.flush_count_deltas()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 0)
         response = self.dongxie_client.get(tweet_url)
@@ -250,15 +255,19 @@ class LikeApiTests(TestCase):
         for i in range(3):
             _, client = self.create_user_and_client('someone{}'.format(i))
             client.post(LIKE_BASE_URL, data)
+            self.run_on_commit_callbacks()
             # check tweet api
             response = client.get(tweet_url)
             self.assertEqual(response.data['likes_count'], i + 1)
+            RedisHelper.flush_count_deltas()
             tweet.refresh_from_db()
             self.assertEqual(tweet.likes_count, i + 1)
 
         self.dongxie_client.post(LIKE_BASE_URL, data)
+        self.run_on_commit_callbacks()
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 4)
+        RedisHelper.flush_count_deltas()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 4)
 
@@ -271,6 +280,8 @@ class LikeApiTests(TestCase):
 
         # dongxie canceled likes
         self.dongxie_client.post(LIKE_BASE_URL + 'cancel/', data)
+        self.run_on_commit_callbacks()
+        RedisHelper.flush_count_deltas()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 3)
         response = self.dongxie_client.get(tweet_url)
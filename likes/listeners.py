@@ -1,39 +1,44 @@
+from django.db import transaction
 from utils.redis_helper import RedisHelper
 
 
 def incr_likes_count(sender, instance, created, **kwargs):
+    from comments.models import Comment
     from tweets.models import Tweet
-    from django.db.models import F
 
     if not created:
         return
 
+    # 事务提交之后再更新点赞过的 object ids，否则正在从数据库 load 的 set 里可能没有这个点赞
+    from likes.services import LikeService
+    transaction.on_commit(lambda: LikeService.add_liked_object(instance))
+
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    if model_class not in (Tweet, Comment):
         return
 
-    # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式
-    # 因此这个操作不是原子操作，必须使用 update 语句才是原子操作
-    # 方法一
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
-    tweet = instance.content_object
-    RedisHelper.incr_count(tweet, 'likes_count')
-    # 方法二
-    # tweet = instance.content_object
-    # tweet.likes_count = F('likes_count') + 1
-    # tweet.save()
+    # 热门 tweet 每次点赞都去 update 同一行会造成大量的行锁竞争
+    # 所以先把 +1 记在 redis 里，由 tweets.tasks.flush_count_deltas_task 定期批量写回数据库
+    # 事务回滚的话这个 +1 就会被当成真的写回数据库，所以等到提交之后再记
+    content_object = instance.content_object
+    transaction.on_commit(lambda: RedisHelper.incr_count(content_object, 'likes_count'))
+    if model_class == Tweet:
+        transaction.on_commit(lambda: LikeService.push_tweet_like_to_cache(instance))
 
 def decr_likes_count(sender, instance, **kwargs):
+    from comments.models import Comment
     from tweets.models import Tweet
-    from django.db.models import F
+    from likes.services import LikeService
+
+    transaction.on_commit(lambda: LikeService.remove_liked_object(instance))
 
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    if model_class not in (Tweet, Comment):
         return
 
-    # handle tweet likes cancel
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
-    tweet = instance.content_object
-    RedisHelper.decr_count(tweet, 'likes_count')
+    # handle tweet and comment likes cancel
+    content_object = instance.content_object
+    transaction.on_commit(lambda: RedisHelper.decr_count(content_object, 'likes_count'))
+    if model_class == Tweet:
+        # 和 comments 一样在事务提交之后再删掉 cache，避免别的进程把删掉的 like 重新 load 进去
+        transaction.on_commit(lambda: LikeService.invalidate_cached_tweet_likes(instance.object_id))
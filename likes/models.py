@@ -2,7 +2,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
+from django.db.models.signals import post_delete, post_save
 from likes.listeners import incr_likes_count, decr_likes_count
 from utils.memcached_helper import MemcachedHelper
 
@@ -40,8 +40,11 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        # 列表页会用 UserService.prefetch_users 提前批量读取好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
-pre_delete.connect(decr_likes_count, sender=Like)
+post_delete.connect(decr_likes_count, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
\ No newline at end of file
@@ -1,15 +1,150 @@
-from likes.models import Like
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from likes.models import Like
+from twitter.cache import TWEET_LIKES_PATTERN, USER_LIKED_OBJECTS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+# object 的 id 都是正整数，用 0 作为占位符表示这个 set 已经从数据库 load 过了
+# 否则没有点赞过任何东西的用户的 set 是空的，在 redis 里不存在，每次都会去数据库里 load
+LIKED_SET_PLACEHOLDER = 0
+
+
+def lazy_load_tweet_likes(tweet_id):
+    def _lazy_load(limit):
+        from tweets.models import Tweet
+        return Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Tweet),
+            object_id=tweet_id,
+        ).order_by('-created_at')[:limit]
+    return _lazy_load
 
 
 class LikeService(object): # 这个没有放在 api 里，因为也可能被异步任务使用
 
+    @classmethod
+    def get_liked_objects_key(cls, user_id, model_class):
+        return USER_LIKED_OBJECTS_PATTERN.format(
+            model_name=model_class.__name__.lower(),
+            user_id=user_id,
+        )
+
     @classmethod
     def has_liked(cls, user, target):
-        if user.is_anonymous:
-            return False
-        return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(target.__class__),
-            object_id=target.id,
-            user=user,
-        ).exists()
\ No newline at end of file
+        return target.id in cls.get_liked_object_ids(user, target.__class__, [target.id])
+
+    @classmethod
+    def get_liked_object_ids(cls, user, model_class, object_ids):
+        """
+        批量版本的 has_liked，返回 user 点赞过的那些 object 的 id 组成的 set
+        列表页渲染之前先调用一次，而不是每个 object 都查一次数据库
+        每个用户点赞过的 object ids 存在 redis 的 set 里，一次 pipeline 就能检查完一整页
+        redis-py 3.5 没有 SMISMEMBER（而且需要 redis 6.2 以上），所以用 pipeline 发送多个 SISMEMBER
+        """
+        if user.is_anonymous or not object_ids:
+            return set()
+
+        key = cls.get_liked_objects_key(user.id, model_class)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.exists(key)
+        pipeline.get(cls.get_min_object_id_key(key))
+        for object_id in object_ids:
+            pipeline.sismember(key, object_id)
+        exists, min_object_id, *results = pipeline.execute()
+        if exists:
+            liked_object_ids = {
+                object_id
+                for object_id, is_member in zip(object_ids, results)
+                if is_member
+            }
+            min_object_id = int(min_object_id or 0)
+        else:
+            # cache miss，从数据库里 load 这个用户最近点赞过的 objects
+            liked_object_ids, min_object_id = cls._load_liked_object_ids(user.id, model_class)
+            liked_object_ids &= set(object_ids)
+
+        # set 里只有 id 不小于 min_object_id 的 objects，更早的 objects 要去数据库里查
+        # 列表页基本上都是最近的 tweets，一般不需要查询
+        older_object_ids = [
+            object_id
+            for object_id in object_ids
+            if object_id < min_object_id and object_id not in liked_object_ids
+        ]
+        if older_object_ids:
+            liked_object_ids |= set(Like.objects.filter(
+                content_type=ContentType.objects.get_for_model(model_class),
+                user_id=user.id,
+                object_id__in=older_object_ids,
+            ).values_list('object_id', flat=True))
+        return liked_object_ids
+
+    @classmethod
+    def get_min_object_id_key(cls, key):
+        return '{}:min_object_id'.format(key)
+
+    @classmethod
+    def _load_liked_object_ids(cls, user_id, model_class):
+        """
+        只 load object id 最大的 REDIS_LIKED_SET_SIZE_LIMIT 个点赞，返回 (object ids, min_object_id)
+        id 不小于 min_object_id 的 objects 的点赞都在 set 里，没有超过限制的时候 min_object_id 是 0
+        用 <user, content_type, object_id> 的 unique 索引倒序读取，不需要排序
+        """
+        key = cls.get_liked_objects_key(user_id, model_class)
+        # 读取数据库之前先拿到 version，load 期间有点赞或者取消点赞的话不写 cache
+        version = RedisHelper.get_set_version(key)
+        limit = settings.REDIS_LIKED_SET_SIZE_LIMIT
+        object_ids = list(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(model_class),
+            user_id=user_id,
+        ).order_by('-object_id').values_list('object_id', flat=True)[:limit + 1])
+        min_object_id = 0
+        if len(object_ids) > limit:
+            object_ids = object_ids[:limit]
+            min_object_id = object_ids[-1]
+
+        RedisHelper.load_set_if_unchanged(
+            key,
+            version,
+            [LIKED_SET_PLACEHOLDER, *object_ids],
+            meta_key=cls.get_min_object_id_key(key),
+            meta_value=min_object_id,
+        )
+        return set(object_ids), min_object_id
+
+    @classmethod
+    def add_liked_object(cls, like):
+        # 由 likes.listeners 在创建 like 的事务提交之后调用
+        key = cls.get_liked_objects_key(like.user_id, like.content_type.model_class())
+        RedisHelper.add_to_set_if_cached(key, like.object_id)
+
+    @classmethod
+    def remove_liked_object(cls, like):
+        # 由 likes.listeners 在删除 like 的事务提交之后调用
+        key = cls.get_liked_objects_key(like.user_id, like.content_type.model_class())
+        RedisHelper.remove_from_set(key, like.object_id)
+
+    @classmethod
+    def get_cached_tweet_likes_in_range(cls, tweet_id, created_at__lt=None, created_at__gt=None, limit=None):
+        # 每个 tweet 最新的 likes 存在 redis 的 sorted set 里，用于 tweet 详情页的预览和翻页
+        # 返回 (likes, is_complete)
+        key = TWEET_LIKES_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects_in_range(
+            key,
+            lazy_load_tweet_likes(tweet_id),
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+        )
+
+    @classmethod
+    def push_tweet_like_to_cache(cls, like):
+        # 热门 tweet 的点赞非常多，cache 不在的时候不去数据库里 load，等读取的时候再 lazy load
+        key = TWEET_LIKES_PATTERN.format(tweet_id=like.object_id)
+        RedisHelper.push_objects_if_cached([(key, like)])
+
+    @classmethod
+    def invalidate_cached_tweet_likes(cls, tweet_id):
+        # 和 comments 一样，删掉一个 like 之后直接删掉整个 key，下次读取的时候重新 load
+        conn = RedisClient.get_connection()
+        conn.delete(TWEET_LIKES_PATTERN.format(tweet_id=tweet_id))
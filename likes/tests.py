@@ -0,0 +1,137 @@
+from comments.models import Comment
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from likes.models import Like
+from likes.services import LikeService
+from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        super(LikeServiceTests, self).setUp()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+        self.tweets = [self.create_tweet(self.linghu) for _ in range(3)]
+        self.comment = self.create_comment(self.dongxie, self.tweets[0])
+
+    def test_get_liked_object_ids(self):
+        self.create_like(self.dongxie, self.tweets[0])
+        self.create_like(self.dongxie, self.tweets[2])
+        self.create_like(self.linghu, self.tweets[1])
+        self.create_like(self.dongxie, self.comment)
+
+        tweet_ids = [tweet.id for tweet in self.tweets]
+        with self.assertNumQueries(1):
+            liked_tweet_ids = LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids)
+        self.assertEqual(liked_tweet_ids, {self.tweets[0].id, self.tweets[2].id})
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.linghu, Tweet, tweet_ids),
+            {self.tweets[1].id},
+        )
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.dongxie, Comment, [self.comment.id]),
+            {self.comment.id},
+        )
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.linghu, Comment, [self.comment.id]),
+            set(),
+        )
+
+    def test_liked_object_ids_cache(self):
+        tweet_ids = [tweet.id for tweet in self.tweets]
+        self.create_like(self.dongxie, self.tweets[0])
+        # cache miss，从数据库里 load
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids),
+                {self.tweets[0].id},
+            )
+        # cache hit 不再访问数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids),
+                {self.tweets[0].id},
+            )
+            self.assertEqual(LikeService.has_liked(self.dongxie, self.tweets[0]), True)
+
+        # 点赞和取消点赞的时候 listeners 会更新 cache
+        like = self.create_like(self.dongxie, self.tweets[1])
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids),
+            {self.tweets[0].id, self.tweets[1].id},
+        )
+        like.delete()
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids),
+                {self.tweets[0].id},
+            )
+
+        # 没有点赞过任何东西的用户也只需要 load 一次
+        with self.assertNumQueries(1):
+            self.assertEqual(LikeService.has_liked(self.linghu, self.tweets[0]), False)
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.linghu, self.tweets[0]), False)
+
+    def test_liked_object_ids_size_limit(self):
+        # set 里只放 object id 最大的 REDIS_LIKED_SET_SIZE_LIMIT 个点赞
+        tweets = [self.create_tweet(self.linghu) for _ in range(settings.REDIS_LIKED_SET_SIZE_LIMIT)]
+        for tweet in self.tweets + tweets:
+            self.create_like(self.dongxie, tweet)
+        self.clear_cache()
+
+        tweet_ids = [tweet.id for tweet in tweets]
+        with self.assertNumQueries(1):
+            self.assertEqual(LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids), set(tweet_ids))
+        key = LikeService.get_liked_objects_key(self.dongxie.id, Tweet)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.scard(key), settings.REDIS_LIKED_SET_SIZE_LIMIT + 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.get_liked_object_ids(self.dongxie, Tweet, tweet_ids), set(tweet_ids))
+
+        # 更早的 objects 不在 set 里，去数据库里查
+        with self.assertNumQueries(1):
+            self.assertEqual(LikeService.has_liked(self.dongxie, self.tweets[0]), True)
+
+        # load 的期间有点赞的话不写 cache
+        self.clear_cache()
+        version = RedisHelper.get_set_version(key)
+        LikeService.add_liked_object(Like.objects.filter(user=self.dongxie).first())
+        self.assertEqual(RedisHelper.load_set_if_unchanged(key, version, [0]), False)
+        self.assertEqual(conn.exists(key), False)
+
+    def test_counts_after_rollback(self):
+        tweet = self.tweets[1]
+        like = self.create_like(self.dongxie, tweet)
+        self.create_comment(self.linghu, tweet)
+        RedisHelper.flush_count_deltas()
+
+        # 事务回滚之后 redis 里的计数也不会变，不会在 flush 的时候把错误的计数写回数据库
+        try:
+            with transaction.atomic():
+                Like.objects.create(
+                    content_type=ContentType.objects.get_for_model(Tweet),
+                    object_id=tweet.id,
+                    user=self.linghu,
+                )
+                like.delete()
+                Comment.objects.create(user=self.dongxie, tweet=tweet, content='rollback')
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+        self.run_on_commit_callbacks()
+        counts = RedisHelper.get_counts([tweet], ['likes_count', 'comments_count'])
+        self.assertEqual(counts, {tweet.id: {'likes_count': 1, 'comments_count': 1}})
+        RedisHelper.flush_count_deltas()
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (1, 1))
+
+        # 提交之后才记到 redis 里
+        self.create_like(self.linghu, tweet)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
@@ -1,11 +1,25 @@
+from newsfeeds.services import NewsFeedService
 from rest_framework import serializers
-from tweets.api.serializers import TweetSerializer
+from tweets.api.serializers import TweetListSerializer, TweetSerializer
+
+
+class NewsFeedListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # 渲染一页 newsfeeds 之前先批量读取好所有的 tweets 以及 tweets 的 user
+        newsfeeds = list(data)
+        tweets = NewsFeedService.prefetch_tweets(newsfeeds)
+        TweetListSerializer.prefetch_context(self.context, list(tweets.values()))
+        return super(NewsFeedListSerializer, self).to_representation(newsfeeds)
 
 
 class NewsFeedSerializer(serializers.Serializer):
     tweet = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = NewsFeedListSerializer
+
     def get_tweet(self, obj):
         return TweetSerializer(obj.cached_tweet, context=self.context).data
 
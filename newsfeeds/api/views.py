@@ -22,8 +22,15 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        # 刚从不活跃状态回来的用户先把错过的 newsfeeds 补上
+        NewsFeedService.rebuild_dormant_newsfeeds(request.user.id)
+        page = self.paginator.paginate_cached_range(
+            lambda **kwargs: NewsFeedService.get_cached_newsfeeds_in_range(
+                request.user.id,
+                **kwargs,
+            ),
+            request,
+        )
         if page is None:
             if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
                 page = self.paginator.paginate_hbase(
@@ -34,10 +41,33 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
             else:
                 queryset = NewsFeed.objects.filter(user=request.user)
                 page = self.paginate_queryset(queryset)
+            page = self.merge_pulled_newsfeeds(page, request)
 
         serializer = NewsFeedSerializer(
             page,
             context={'request': request},
             many=True,
         )
-        return self.get_paginated_response(serializer.data)
\ No newline at end of file
+        return self.get_paginated_response(serializer.data)
+
+    def merge_pulled_newsfeeds(self, page, request):
+        # 从数据库翻页的时候，还需要把 pull 模式的用户的 tweets 合并进来
+        pull_mode_user_ids = NewsFeedService.get_pull_mode_following_ids(request.user.id)
+        if not pull_mode_user_ids:
+            return page
+
+        page_size = self.paginator.page_size
+        has_next_page = self.paginator.has_next_page
+        pulled_newsfeeds = NewsFeedService.load_pulled_newsfeeds(
+            request.user.id,
+            pull_mode_user_ids,
+            request.query_params,
+            limit=page_size + 1,
+        )
+        newsfeeds = NewsFeedService.merge_newsfeeds([list(page), pulled_newsfeeds])
+        if 'created_at__gt' in request.query_params:
+            return newsfeeds
+
+        # 两边各自取了一页，合并之后的前 page_size 个就是正确的一页
+        self.paginator.has_next_page = has_next_page or len(newsfeeds) > page_size
+        return newsfeeds[:page_size]
\ No newline at end of file
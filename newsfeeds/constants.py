@@ -1,3 +1,44 @@
 from django.conf import settings
+from utils.time_constants import ONE_DAY, ONE_HOUR
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# 粉丝数超过这个阈值的用户（大V）发帖时不再 fanout 到每个粉丝的 newsfeed 里（push 模式）
+# 而是在粉丝读取 newsfeed 的时候从大V的 user_tweets 里拉取再合并（pull 模式）
+PULL_MODE_FOLLOWERS_THRESHOLD = 100000 if not settings.TESTING else 5
+
+
+class FanoutPriority:
+    # 每个优先级对应 CELERY_QUEUES 里的一个 queue
+    HIGH = 'newsfeeds_high'
+    NORMAL = 'newsfeeds'
+    LOW = 'newsfeeds_low'
+
+
+FANOUT_PRIORITIES = (FanoutPriority.HIGH, FanoutPriority.NORMAL, FanoutPriority.LOW)
+
+# 每条 tweet 的前 HIGH_PRIORITY_FANOUT_SIZE 个粉丝走高优先级的 queue
+# 普通用户的粉丝一般不会超过这个数量，所以普通用户的 tweet 会全部走高优先级的 queue
+# 不会因为排在某个大V的几万个 batch 后面而迟迟看不到
+HIGH_PRIORITY_FANOUT_SIZE = 1000 if not settings.TESTING else 3
+
+# 剩下的粉丝里，最近访问过的走普通的 queue，其他的长尾粉丝走低优先级的 queue
+RECENTLY_ACTIVE_THRESHOLD = ONE_DAY
+
+# 每个优先级的 batch 期望在创建之后多久（秒）之内完成，超时的会记录在 fanout 进度里
+FANOUT_DEADLINES = {
+    FanoutPriority.HIGH: 10,
+    FanoutPriority.NORMAL: 5 * 60,
+    FanoutPriority.LOW: ONE_HOUR,
+}
+
+# 超过 deadline 还在排队的 batch 会被 bump_overdue_fanout_batches_task 挪到高一级的 queue 里
+# 只从低优先级挪到普通的 queue，不会挪进高优先级的 queue
+# 否则大V的长尾粉丝积压的时候会把高优先级的 queue 塞满，普通用户的 tweets 反而要排队
+FANOUT_BUMP_QUEUES = {
+    FanoutPriority.LOW: FanoutPriority.NORMAL,
+}
+# 每次最多挪多少个 batch，避免一下子把普通的 queue 塞满
+FANOUT_BUMP_BATCH_SIZE = 100
+
+FANOUT_PROGRESS_EXPIRE_TIME = ONE_DAY
\ No newline at end of file
@@ -1,2 +1,3 @@
 from .hbase_newsfeed import *
-from .newsfeed import *
\ No newline at end of file
+from .newsfeed import *
+from .pull_mode_user import *
@@ -29,8 +29,11 @@ class NewsFeed(models.Model):
     def __str__(self):
         return f'{self.created_at}  inbox of {self.user}: {self.tweet}'
 
-    @ property
+    @property
     def cached_tweet(self):
+        # 列表页会用 NewsFeedService.prefetch_tweets 提前批量读取好
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 
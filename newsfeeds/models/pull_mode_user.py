@@ -0,0 +1,12 @@
+from django.contrib.auth.models import User
+from django.db import models
+
+
+class PullModeUser(models.Model):
+    # 进入 pull 模式的大V，这些用户的 tweets 没有 fanout 到粉丝的 newsfeeds 里
+    # redis 里的 NEWSFEED_PULL_MODE_USERS_KEY 只是这张表的 cache，丢了可以从这里重新 load
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.user} in pull mode since {self.created_at}'
@@ -1,9 +1,45 @@
+from accounts.services import UserService
+from datetime import datetime
+from django.conf import settings
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
-from newsfeeds.models import NewsFeed, HBaseNewsFeed
+from newsfeeds.constants import FANOUT_PRIORITIES, FANOUT_PROGRESS_EXPIRE_TIME
+from newsfeeds.models import NewsFeed, HBaseNewsFeed, PullModeUser
 from newsfeeds.tasks import fanout_newsfeeds_main_task
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    FANOUT_BATCH_BUMPED_PATTERN,
+    FANOUT_PROGRESS_PATTERN,
+    NEWSFEED_PULL_MODE_USERS_KEY,
+    PENDING_FANOUT_BATCHES_KEY,
+    USER_NEWSFEEDS_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.paginations import parse_cursor
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.time_helpers import timestamp_to_datetime
+
+import heapq
+import itertools
+import json
+import time
+import uuid
+
+# user id 都是正整数，用 0 作为占位符表示 pull 模式的用户 set 已经 load 过了
+PULL_MODE_USERS_PLACEHOLDER = 0
+
+# 认领排队超时的 batch，认领成功的话留下一个标记
+# 原来的 batch 任务只有看到这个标记才能确定 batch 已经被挪走了，可以跳过
+CLAIM_OVERDUE_FANOUT_BATCH_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+return 1
+"""
 
 
 def lazy_load_newsfeeds(user_id):
@@ -14,6 +50,27 @@ def lazy_load_newsfeeds(user_id):
     return _lazy_load
 
 
+def tweets_to_newsfeeds(user_id, tweets):
+    # pull 模式下大V的 tweets 没有被 fanout 到粉丝的 newsfeeds 里
+    # 读取的时候构造出不存入数据库的 newsfeed，和 push 过来的 newsfeeds 合并
+    if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+        return [
+            HBaseNewsFeed(user_id=user_id, created_at=tweet.timestamp, tweet_id=tweet.id)
+            for tweet in tweets
+        ]
+    return [
+        NewsFeed(user_id=user_id, created_at=tweet.created_at, tweet_id=tweet.id)
+        for tweet in tweets
+    ]
+
+
+def to_datetime(created_at):
+    # hbase 的 newsfeed 的 created_at 是 int 类型的时间戳，而 tweet 的 created_at 是 datetime
+    if created_at is None or isinstance(created_at, datetime):
+        return created_at
+    return timestamp_to_datetime(created_at)
+
+
 class NewsFeedService(object):
 
     # 错误的方法
@@ -44,14 +101,169 @@ class NewsFeedService(object):
             created_at = tweet.created_at
         fanout_newsfeeds_main_task.delay(tweet.id, tweet.timestamp, tweet.user_id)
 
+    @classmethod
+    def add_pull_mode_user(cls, user_id):
+        # 进入 pull 模式之后就不再移出，就算粉丝数掉到阈值以下也一样
+        # 否则之前没有 fanout 的 tweets 就会从粉丝的 newsfeeds 里消失
+        # 之后又被 push 的 tweets 在合并的时候会按照 tweet_id 去重
+        # 这些用户的 tweets 没有 fanout 过，标记丢了粉丝就看不到了，所以先写数据库再更新 cache
+        PullModeUser.objects.get_or_create(user_id=user_id)
+        RedisHelper.add_to_set_if_cached(NEWSFEED_PULL_MODE_USERS_KEY, user_id)
+
+    @classmethod
+    def get_pull_mode_user_ids(cls):
+        """
+        pull 模式的用户存在 redis 的 set 里，key 过期或者 redis 数据丢失的时候从数据库重新 load
+        """
+        conn = RedisClient.get_connection()
+        members = conn.smembers(NEWSFEED_PULL_MODE_USERS_KEY)
+        if members:
+            user_id_set = set(int(member) for member in members)
+            user_id_set.discard(PULL_MODE_USERS_PLACEHOLDER)
+            return user_id_set
+
+        # 和 followings 一样，load 期间有新的用户进入 pull 模式的话不写 cache
+        version = RedisHelper.get_set_version(NEWSFEED_PULL_MODE_USERS_KEY)
+        user_id_set = set(PullModeUser.objects.values_list('user_id', flat=True))
+        RedisHelper.load_set_if_unchanged(
+            NEWSFEED_PULL_MODE_USERS_KEY,
+            version,
+            [PULL_MODE_USERS_PLACEHOLDER, *user_id_set],
+        )
+        return user_id_set
+
+    @classmethod
+    def is_pull_mode_user(cls, user_id):
+        return user_id in cls.get_pull_mode_user_ids()
+
+    @classmethod
+    def get_pull_mode_following_ids(cls, user_id):
+        pull_mode_user_ids = cls.get_pull_mode_user_ids()
+        if not pull_mode_user_ids:
+            return []
+        following_user_id_set = FriendshipService.get_following_user_id_set(user_id)
+        return [
+            pull_mode_user_id
+            for pull_mode_user_id in pull_mode_user_ids
+            if pull_mode_user_id in following_user_id_set
+        ]
+
+    @classmethod
+    def merge_newsfeeds(cls, newsfeed_lists):
+        # 每个 list 都已经按照 created_at 倒序排好了，做一个 k 路归并
+        # 同一条 tweet 可能既被 push 过来又被 pull 进来，按照 tweet_id 去重
+        merged_newsfeeds = heapq.merge(
+            *newsfeed_lists,
+            key=lambda newsfeed: newsfeed.created_at,
+            reverse=True,
+        )
+        tweet_ids = set()
+        newsfeeds = []
+        for newsfeed in merged_newsfeeds:
+            if newsfeed.tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(newsfeed.tweet_id)
+            newsfeeds.append(newsfeed)
+        return newsfeeds
+
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
+        newsfeeds, _ = cls.get_cached_newsfeeds_in_range(user_id)
+        return newsfeeds
+
+    @classmethod
+    def get_cached_newsfeeds_in_range(cls, user_id, created_at__lt=None, created_at__gt=None, limit=None):
+        """
+        只读取一页需要的 newsfeeds，翻页参数的含义和 EndlessPagination 里一致
+        返回 (newsfeeds, is_complete)
+        is_complete 为 False 表示 cache 里的数据不够回答这次查询，需要去数据库里查询
+        """
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
             serializer = HBaseModelSerializer
         else:
             serializer = DjangoModelSerializer
-        return RedisHelper.load_objects(key, lazy_load_newsfeeds(user_id), serializer=serializer)
+        newsfeeds, is_complete = RedisHelper.load_objects_in_range(
+            key,
+            lazy_load_newsfeeds(user_id),
+            serializer=serializer,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+        )
+
+        pull_mode_user_ids = cls.get_pull_mode_following_ids(user_id)
+        if not pull_mode_user_ids:
+            return newsfeeds, is_complete
+
+        # pull 模式的用户的 tweets 用同样的翻页参数各取一页，再和 push 过来的 newsfeeds 合并
+        results = [(newsfeeds, is_complete)]
+        for pull_mode_user_id in pull_mode_user_ids:
+            tweets, is_complete = TweetService.get_cached_tweets_in_range(
+                pull_mode_user_id,
+                created_at__lt=to_datetime(created_at__lt),
+                created_at__gt=to_datetime(created_at__gt),
+                limit=limit,
+            )
+            results.append((tweets_to_newsfeeds(user_id, tweets), is_complete))
+        newsfeeds = cls.merge_newsfeeds([newsfeed_list for newsfeed_list, _ in results])
+        if limit is not None:
+            newsfeeds = newsfeeds[:limit]
+
+        incomplete_lists = [
+            newsfeed_list
+            for newsfeed_list, is_complete in results
+            if not is_complete
+        ]
+        if not incomplete_lists:
+            return newsfeeds, True
+        if not all(incomplete_lists):
+            return [], False
+
+        # cache 里数据不够的 list，比它的最后一个元素更老的数据不在 cache 里
+        # 所以合并之后只有不比这些 list 的最后一个元素更老的那部分是准确的
+        oldest_created_at = max(
+            newsfeed_list[-1].created_at
+            for newsfeed_list in incomplete_lists
+        )
+        newsfeeds = [
+            newsfeed
+            for newsfeed in newsfeeds
+            if newsfeed.created_at >= oldest_created_at
+        ]
+        return newsfeeds, limit is not None and len(newsfeeds) == limit
+
+    @classmethod
+    def load_pulled_newsfeeds(cls, user_id, pull_mode_user_ids, query_params, limit):
+        """
+        cache 里的数据不够翻页的时候，从数据库里读取 pull 模式的用户的 tweets
+        翻页参数的含义和 EndlessPagination 里一致
+        """
+        queryset = Tweet.objects.filter(user_id__in=pull_mode_user_ids)
+        if 'created_at__gt' in query_params:
+            created_at__gt = to_datetime(parse_cursor(query_params['created_at__gt']))
+            tweets = queryset.filter(created_at__gt=created_at__gt).order_by('-created_at')
+            return tweets_to_newsfeeds(user_id, tweets)
+
+        if 'created_at__lt' in query_params:
+            created_at__lt = to_datetime(parse_cursor(query_params['created_at__lt']))
+            queryset = queryset.filter(created_at__lt=created_at__lt)
+        tweets = queryset.order_by('-created_at')[:limit]
+        return tweets_to_newsfeeds(user_id, tweets)
+
+    @classmethod
+    def prefetch_tweets(cls, newsfeeds):
+        # 批量读取一页 newsfeeds 的 tweets 以及 tweets 的 user，避免渲染的时候每条单独访问 cache
+        # 返回 {tweet_id: tweet}
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id in tweets:
+                newsfeed._cached_tweet = tweets[newsfeed.tweet_id]
+        UserService.prefetch_users(tweets.values())
+        return tweets
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
@@ -69,17 +281,240 @@ class NewsFeedService(object):
         return newsfeed
 
     @classmethod
-    def batch_create(cls, batch_params):
+    def _batch_create_in_storage(cls, batch_params):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            newsfeeds = HBaseNewsFeed.batch_create(batch_params)
-        else:
-            newsfeeds = [NewsFeed(**params) for params in batch_params]
-            NewsFeed.objects.bulk_create(newsfeeds)
+            return HBaseNewsFeed.batch_create(batch_params)
+        newsfeeds = [NewsFeed(**params) for params in batch_params]
+        NewsFeed.objects.bulk_create(newsfeeds)
+        return newsfeeds
+
+    @classmethod
+    def batch_create(cls, batch_params):
+        newsfeeds = cls._batch_create_in_storage(batch_params)
         # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-        for newsfeed in newsfeeds:
-            NewsFeedService.push_newsfeed_to_cache(newsfeed)
+        # 一个 batch 的 newsfeeds 用一次 pipeline 批量 push，而不是每个 newsfeed 三次网络往返
+        RedisHelper.push_objects_if_cached([
+            (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+            for newsfeed in newsfeeds
+        ])
         return newsfeeds
 
+    @classmethod
+    def rebuild_dormant_newsfeeds(cls, user_id):
+        """
+        不活跃的用户不会收到 fanout，当他回来第一次打开 newsfeeds 的时候
+        从他关注的人的 user_tweets cache 里把错过的 tweets 补到他的 newsfeeds 里
+        """
+        # 重建成功之后才清除标记，中途出错的话下次打开 newsfeeds 的时候还会再重建
+        # 已经补过的 newsfeeds 会在下面去重，重复重建是安全的
+        dormant_since = UserService.get_dormant_since(user_id)
+        if dormant_since is None:
+            return 0
+
+        # pull 模式的用户的 tweets 在读取的时候会被合并进来，不需要补
+        following_user_ids = FriendshipService.get_following_user_id_set(user_id)
+        following_user_ids -= set(cls.get_pull_mode_following_ids(user_id))
+        # 只需要读取每个人在变得不活跃之后发的 tweets
+        created_at__gt = timestamp_to_datetime(dormant_since * 1000000)
+        tweet_lists = [
+            TweetService.get_cached_tweets_in_range(
+                following_user_id,
+                created_at__gt=created_at__gt,
+            )[0]
+            for following_user_id in following_user_ids
+        ]
+        tweets = heapq.merge(
+            *tweet_lists,
+            key=lambda tweet: tweet.created_at,
+            reverse=True,
+        )
+        tweets = list(itertools.islice(tweets, settings.REDIS_LIST_LENGTH_LIMIT))
+
+        # 变得不活跃之前的那段时间里 fanout 过来的 newsfeeds 已经存在了，需要去重
+        # hbase 里每条 newsfeed 的 row key 是 (user_id, tweet 的 timestamp)，用一次 get_many 查出来
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            existing_newsfeeds = HBaseNewsFeed.get_many([
+                {'user_id': user_id, 'created_at': tweet.timestamp}
+                for tweet in tweets
+            ])
+            existing_tweet_ids = set(
+                newsfeed.tweet_id
+                for newsfeed in existing_newsfeeds
+                if newsfeed is not None
+            )
+        else:
+            existing_tweet_ids = set(NewsFeed.objects.filter(
+                user_id=user_id,
+                tweet_id__in=[tweet.id for tweet in tweets],
+            ).values_list('tweet_id', flat=True))
+        tweets = [tweet for tweet in tweets if tweet.id not in existing_tweet_ids]
+
+        if tweets:
+            cls._batch_create_in_storage([
+                {
+                    'user_id': newsfeed.user_id,
+                    'tweet_id': newsfeed.tweet_id,
+                    'created_at': newsfeed.created_at,
+                }
+                for newsfeed in tweets_to_newsfeeds(user_id, tweets)
+            ])
+        # 直接删掉 cache，下次读取的时候从数据库重新 load
+        conn = RedisClient.get_connection()
+        conn.delete(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        UserService.clear_dormant_since(user_id)
+        return len(tweets)
+
+    @classmethod
+    def start_fanout_progress(cls, tweet_id):
+        # 用一个 redis hash 记录每条 tweet 的 fanout 进度
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hset(key, 'started_at', time.time())
+        pipeline.expire(key, FANOUT_PROGRESS_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def finish_fanout_dispatch(cls, tweet_id, batch_counts):
+        # 所有的 batch 任务都已经创建好了，记录每个优先级的 batch 总数
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        mapping = {
+            '{}:total'.format(priority): batch_count
+            for priority, batch_count in batch_counts.items()
+        }
+        mapping['dispatched'] = 1
+        conn = RedisClient.get_connection()
+        conn.hset(key, mapping=mapping)
+        cls._check_fanout_finished(tweet_id)
+
+    @classmethod
+    def finish_fanout_batch(cls, tweet_id, priority, newsfeeds_count, deadline=None):
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        now = time.time()
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hincrby(key, '{}:done'.format(priority), 1)
+        pipeline.hincrby(key, 'newsfeeds', newsfeeds_count)
+        pipeline.hset(key, '{}:finished_at'.format(priority), now)
+        if deadline is not None and now > deadline:
+            pipeline.hincrby(key, '{}:missed_deadline'.format(priority), 1)
+        pipeline.expire(key, FANOUT_PROGRESS_EXPIRE_TIME)
+        pipeline.execute()
+        cls._check_fanout_finished(tweet_id)
+
+    @classmethod
+    def record_bumped_fanout_batch(cls, tweet_id, priority):
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hincrby(key, '{}:bumped'.format(priority), 1)
+        pipeline.expire(key, FANOUT_PROGRESS_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def add_pending_fanout_batch(cls, batch, bump_at):
+        """
+        用一个 sorted set 记录还在排队的 batch，score 是超时之后需要挪到高一级 queue 的时间
+        返回的 batch_key 交给 batch 任务，开始执行的时候用它从 sorted set 里认领这个 batch
+        """
+        batch_key = json.dumps({'batch_id': uuid.uuid4().hex, **batch})
+        conn = RedisClient.get_connection()
+        conn.zadd(PENDING_FANOUT_BATCHES_KEY, {batch_key: bump_at})
+        return batch_key
+
+    @classmethod
+    def claim_pending_fanout_batch(cls, batch_key):
+        # batch 任务和 bump_overdue_fanout_batches_task 谁先 zrem 成功谁执行，保证不会重复 fanout
+        conn = RedisClient.get_connection()
+        return conn.zrem(PENDING_FANOUT_BATCHES_KEY, batch_key) == 1
+
+    @classmethod
+    def claim_overdue_fanout_batches(cls, limit):
+        conn = RedisClient.get_connection()
+        batch_keys = conn.zrangebyscore(
+            PENDING_FANOUT_BATCHES_KEY,
+            '-inf',
+            time.time(),
+            start=0,
+            num=limit,
+        )
+        if not batch_keys:
+            return []
+        script = conn.register_script(CLAIM_OVERDUE_FANOUT_BATCH_SCRIPT)
+        pipeline = conn.pipeline()
+        batches = [json.loads(batch_key) for batch_key in batch_keys]
+        for batch_key, batch in zip(batch_keys, batches):
+            script(
+                keys=[
+                    PENDING_FANOUT_BATCHES_KEY,
+                    FANOUT_BATCH_BUMPED_PATTERN.format(batch_id=batch['batch_id']),
+                ],
+                args=[batch_key, FANOUT_PROGRESS_EXPIRE_TIME],
+                client=pipeline,
+            )
+        return [
+            batch
+            for batch, claimed in zip(batches, pipeline.execute())
+            if claimed
+        ]
+
+    @classmethod
+    def is_fanout_batch_bumped(cls, batch_key):
+        batch_id = json.loads(batch_key)['batch_id']
+        conn = RedisClient.get_connection()
+        return conn.exists(FANOUT_BATCH_BUMPED_PATTERN.format(batch_id=batch_id)) == 1
+
+    @classmethod
+    def _check_fanout_finished(cls, tweet_id):
+        # batch 任务可能在所有的 batch 创建完之前就已经执行完了
+        # 所以 finish_fanout_dispatch 和 finish_fanout_batch 之后都需要检查一次
+        progress = cls.get_fanout_progress(tweet_id)
+        if progress is None or not progress['dispatched'] or progress['finished_at']:
+            return
+        for tier in progress['tiers'].values():
+            if tier['done'] < tier['total']:
+                return
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        conn.hsetnx(key, 'finished_at', time.time())
+
+    @classmethod
+    def get_fanout_progress(cls, tweet_id):
+        """
+        返回某条 tweet 的 fanout 进度，包括每个优先级的 batch 完成情况和完成所花的时间（秒）
+        没有记录（或者已经过期）的话返回 None
+        """
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        conn = RedisClient.get_connection()
+        redis_hash = conn.hgetall(key)
+        if b'started_at' not in redis_hash:
+            return None
+
+        data = {
+            field.decode('utf-8'): value.decode('utf-8')
+            for field, value in redis_hash.items()
+        }
+        started_at = float(data['started_at'])
+        tiers = {}
+        for priority in FANOUT_PRIORITIES:
+            finished_at = data.get('{}:finished_at'.format(priority))
+            tiers[priority] = {
+                'total': int(data.get('{}:total'.format(priority), 0)),
+                'done': int(data.get('{}:done'.format(priority), 0)),
+                'missed_deadline': int(data.get('{}:missed_deadline'.format(priority), 0)),
+                'bumped': int(data.get('{}:bumped'.format(priority), 0)),
+                'latency': float(finished_at) - started_at if finished_at else None,
+            }
+        finished_at = float(data['finished_at']) if 'finished_at' in data else None
+        return {
+            'dispatched': 'dispatched' in data,
+            'newsfeeds': int(data.get('newsfeeds', 0)),
+            'tiers': tiers,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'latency': finished_at - started_at if finished_at else None,
+        }
+
     @classmethod
     def count(cls, user_id=None):
         # for test only
@@ -1,20 +1,127 @@
+from accounts.services import UserService
 from celery import shared_task
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    FANOUT_BUMP_BATCH_SIZE,
+    FANOUT_BUMP_QUEUES,
+    FANOUT_DEADLINES,
+    FANOUT_PRIORITIES,
+    FanoutPriority,
+    HIGH_PRIORITY_FANOUT_SIZE,
+    PULL_MODE_FOLLOWERS_THRESHOLD,
+    RECENTLY_ACTIVE_THRESHOLD,
+)
 from utils.time_constants import ONE_HOUR
 
+import time
+
+
 @shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+def fanout_newsfeeds_batch_task(
+    tweet_id,
+    created_at,
+    follower_ids,
+    priority=FanoutPriority.NORMAL,
+    deadline=None,
+    batch_key=None,
+):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
+
+    # 排队超时的 batch 已经被挪到高一级的 queue 里执行了，这里就不用再执行一次
+    # 排队的记录因为别的原因不见了（比如 redis 丢了数据）的话照常执行，不能让这些粉丝收不到 tweet
+    if batch_key is not None and not NewsFeedService.claim_pending_fanout_batch(batch_key):
+        if NewsFeedService.is_fanout_batch_bumped(batch_key):
+            return "batch already bumped"
+
     batch_params = [
         {'user_id': follower_id, 'created_at': created_at, 'tweet_id': tweet_id}
         for follower_id in follower_ids
     ]
     newsfeeds = NewsFeedService.batch_create(batch_params)
+    NewsFeedService.finish_fanout_batch(tweet_id, priority, len(newsfeeds), deadline)
     return "{} newsfeeds created".format(len(newsfeeds))
 
 
+def get_fanout_priorities(follower_ids, offset):
+    """
+    返回每个 follower 的 fanout 优先级，不活跃的 follower 不需要 fanout，返回 None
+    offset 是在这些 follower 之前已经扫描过的 follower 的数量
+    """
+    now = time.time()
+    last_seen_list = UserService.get_last_seen_list(follower_ids)
+    priorities = []
+    for index, last_seen in enumerate(last_seen_list):
+        # 不活跃的粉丝不 fanout，等他们回来打开 newsfeeds 的时候再重建
+        if not UserService.is_active(last_seen, now):
+            priorities.append(None)
+        elif offset + index < HIGH_PRIORITY_FANOUT_SIZE:
+            priorities.append(FanoutPriority.HIGH)
+        elif last_seen is None or last_seen >= now - RECENTLY_ACTIVE_THRESHOLD:
+            priorities.append(FanoutPriority.NORMAL)
+        else:
+            priorities.append(FanoutPriority.LOW)
+    return priorities
+
+
+def dispatch_fanout_batch(tweet_id, created_at, follower_ids, priority, deadline=None, queue=None):
+    """
+    priority 是这个 batch 在 fanout 进度里统计的优先级，deadline 也是按照 priority 算的
+    queue 是实际执行的 queue，被挪到高一级的 queue 里的 batch 两者不一样
+    """
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    now = time.time()
+    if deadline is None:
+        deadline = now + FANOUT_DEADLINES[priority]
+    if queue is None:
+        queue = priority
+
+    # 还有更高一级的 queue 的话，记录下来，排队超过这个 queue 的 deadline 还没有执行就挪过去
+    batch_key = None
+    if queue in FANOUT_BUMP_QUEUES:
+        batch_key = NewsFeedService.add_pending_fanout_batch({
+            'tweet_id': tweet_id,
+            'created_at': created_at,
+            'follower_ids': follower_ids,
+            'priority': priority,
+            'deadline': deadline,
+            'queue': queue,
+        }, bump_at=now + FANOUT_DEADLINES[queue])
+
+    fanout_newsfeeds_batch_task.apply_async(
+        args=(tweet_id, created_at, follower_ids),
+        kwargs={
+            'priority': priority,
+            'deadline': deadline,
+            'batch_key': batch_key,
+        },
+        queue=queue,
+        routing_key=queue,
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def bump_overdue_fanout_batches_task():
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    batches = NewsFeedService.claim_overdue_fanout_batches(FANOUT_BUMP_BATCH_SIZE)
+    for batch in batches:
+        NewsFeedService.record_bumped_fanout_batch(batch['tweet_id'], batch['priority'])
+        dispatch_fanout_batch(
+            batch['tweet_id'],
+            batch['created_at'],
+            batch['follower_ids'],
+            batch['priority'],
+            deadline=batch['deadline'],
+            queue=FANOUT_BUMP_QUEUES[batch['queue']],
+        )
+    return '{} fanout batches bumped'.format(len(batches))
+
+
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
 def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
     # import 写在里面避免循环依赖
@@ -26,16 +133,50 @@ def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
         tweet_id=tweet_id,
         created_at=created_at,
     )
+    NewsFeedService.start_fanout_progress(tweet_id)
+
+    # 大V 的粉丝太多，fanout 一条 tweet 要写几百万条 newsfeed，改为在粉丝读取时拉取
+    # 已经是 pull 模式的用户不需要再数粉丝，其他用户最多数到阈值为止
+    if NewsFeedService.is_pull_mode_user(tweet_user_id):
+        NewsFeedService.finish_fanout_dispatch(tweet_id, {})
+        return 'pull mode, no newsfeeds going to fanout.'
+    follower_count = FriendshipService.get_follower_count(
+        tweet_user_id,
+        limit=PULL_MODE_FOLLOWERS_THRESHOLD,
+    )
+    if follower_count >= PULL_MODE_FOLLOWERS_THRESHOLD:
+        NewsFeedService.add_pull_mode_user(tweet_user_id)
+        NewsFeedService.finish_fanout_dispatch(tweet_id, {})
+        return '{} followers, pull mode, no newsfeeds going to fanout.'.format(
+            follower_count,
+        )
+
+    # 一边扫描 follower ids 一边按照优先级分组，每个优先级凑够一个 batch 就马上创建任务
+    # 不需要等所有的 follower ids 都读到内存里之后才开始 fanout
+    scanned_count = 0
+    follower_count = 0
+    pending_ids = {priority: [] for priority in FANOUT_PRIORITIES}
+    batch_counts = {priority: 0 for priority in FANOUT_PRIORITIES}
+    for batch_ids in FriendshipService.get_follower_id_batches(tweet_user_id, FANOUT_BATCH_SIZE):
+        priorities = get_fanout_priorities(batch_ids, scanned_count)
+        scanned_count += len(batch_ids)
+        for follower_id, priority in zip(batch_ids, priorities):
+            if priority is None:
+                continue
+            pending_ids[priority].append(follower_id)
+            follower_count += 1
+            if len(pending_ids[priority]) == FANOUT_BATCH_SIZE:
+                dispatch_fanout_batch(tweet_id, created_at, pending_ids[priority], priority)
+                pending_ids[priority] = []
+                batch_counts[priority] += 1
 
-    # 获得所有的 follower ids，按照 batch size 拆分开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    for priority in FANOUT_PRIORITIES:
+        if pending_ids[priority]:
+            dispatch_fanout_batch(tweet_id, created_at, pending_ids[priority], priority)
+            batch_counts[priority] += 1
+    NewsFeedService.finish_fanout_dispatch(tweet_id, batch_counts)
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        follower_count,
+        sum(batch_counts.values()),
     )
\ No newline at end of file
@@ -1,9 +1,21 @@
+from accounts.constants import INACTIVE_USER_THRESHOLD
+from accounts.services import UserService
+from gatekeeper.models import GateKeeper
+from newsfeeds.constants import FanoutPriority, PULL_MODE_FOLLOWERS_THRESHOLD
+from newsfeeds.models import PullModeUser
 from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import (
+    bump_overdue_fanout_batches_task,
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+)
 from testing.testcases import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import PENDING_FANOUT_BATCHES_KEY, USER_NEWSFEEDS_PATTERN, USER_LAST_SEEN_KEY
 from utils.redis_client import RedisClient
-from newsfeeds.tasks import fanout_newsfeeds_main_task
-from gatekeeper.models import GateKeeper
+from utils.time_constants import ONE_DAY
+
+import time
+
 
 class NewsFeedServiceTests(TestCase):
 
@@ -99,4 +111,164 @@ class NewsFeedTaskTests(TestCase):
         cached_list = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_main_task_in_pull_mode(self):
+        followers = [
+            self.create_user('follower{}'.format(i))
+            for i in range(PULL_MODE_FOLLOWERS_THRESHOLD)
+        ]
+        for follower in followers:
+            self.create_friendship(follower, self.linghu)
+        tweet = self.create_tweet(self.linghu, 'pull mode tweet')
+        msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.linghu.id)
+        self.assertEqual(msg, '{} followers, pull mode, no newsfeeds going to fanout.'.format(
+            PULL_MODE_FOLLOWERS_THRESHOLD,
+        ))
+        self.assertEqual(PullModeUser.objects.filter(user=self.linghu).exists(), True)
+        # 只给自己创建了 newsfeed，粉丝读取的时候再拉取
+        self.assertEqual(NewsFeedService.count(self.linghu.id), 1)
+        self.assertEqual(NewsFeedService.count(followers[0].id), 0)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+        # push 过来的 newsfeeds 和 pull 进来的 tweets 按照时间倒序合并
+        self.create_friendship(followers[0], self.dongxie)
+        dongxie_tweet = self.create_tweet(self.dongxie)
+        self.create_newsfeed(followers[0], dongxie_tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [dongxie_tweet.id, tweet.id])
+
+        # 不关注的用户看不到
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual(newsfeeds, [])
+
+        # redis 里的 pull 模式标记丢了之后从数据库重新 load，已经是 pull 模式的用户不会再数粉丝
+        RedisClient.clear()
+        self.clear_cache()
+        tweet2 = self.create_tweet(self.linghu, 'another pull mode tweet')
+        msg = fanout_newsfeeds_main_task(tweet2.id, tweet2.timestamp, self.linghu.id)
+        self.assertEqual(msg, 'pull mode, no newsfeeds going to fanout.')
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet2.id, dongxie_tweet.id, tweet.id])
+
+    def test_fanout_skips_inactive_followers(self):
+        self.create_friendship(self.dongxie, self.linghu)
+        conn = RedisClient.get_connection()
+        long_ago = int(time.time()) - INACTIVE_USER_THRESHOLD - 1
+        conn.zadd(USER_LAST_SEEN_KEY, {self.dongxie.id: long_ago})
+
+        tweet = self.create_tweet(self.linghu)
+        fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.linghu.id)
+        self.assertEqual(NewsFeedService.count(self.linghu.id), 1)
+        self.assertEqual(NewsFeedService.count(self.dongxie.id), 0)
+
+        # 还没有回来之前不会重建
+        self.assertEqual(NewsFeedService.rebuild_dormant_newsfeeds(self.dongxie.id), 0)
+
+        # 回来之后第一次打开 newsfeeds 的时候重建，之后就不再重建了
+        UserService.mark_user_active(self.dongxie.id)
+        self.assertEqual(UserService.get_dormant_since(self.dongxie.id), long_ago)
+        # 读取不会清除标记，重建成功之后才清除
+        self.assertEqual(UserService.get_dormant_since(self.dongxie.id), long_ago)
+        self.assertEqual(NewsFeedService.rebuild_dormant_newsfeeds(self.dongxie.id), 1)
+        self.assertEqual(UserService.get_dormant_since(self.dongxie.id), None)
+        self.assertEqual(NewsFeedService.count(self.dongxie.id), 1)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+        self.assertEqual(NewsFeedService.rebuild_dormant_newsfeeds(self.dongxie.id), 0)
+
+        # 活跃的粉丝可以正常收到 fanout
+        tweet = self.create_tweet(self.linghu)
+        fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.linghu.id)
+        self.assertEqual(NewsFeedService.count(self.dongxie.id), 2)
+
+    def test_fanout_priorities_and_progress(self):
+        followers = [self.create_user('user{}'.format(i)) for i in range(4)]
+        for follower in followers:
+            self.create_friendship(follower, self.linghu)
+        # 最后一个粉丝两天没有访问过了，属于长尾粉丝
+        conn = RedisClient.get_connection()
+        conn.zadd(USER_LAST_SEEN_KEY, {followers[-1].id: int(time.time()) - 2 * ONE_DAY})
+
+        tweet = self.create_tweet(self.linghu)
+        msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.linghu.id)
+        self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
+
+        progress = NewsFeedService.get_fanout_progress(tweet.id)
+        self.assertEqual(progress['newsfeeds'], 4)
+        tiers = progress['tiers']
+        self.assertEqual(tiers[FanoutPriority.HIGH]['total'], 1)
+        self.assertEqual(tiers[FanoutPriority.HIGH]['done'], 1)
+        self.assertEqual(tiers[FanoutPriority.NORMAL]['total'], 0)
+        self.assertEqual(tiers[FanoutPriority.NORMAL]['done'], 0)
+        self.assertEqual(tiers[FanoutPriority.LOW]['total'], 1)
+        self.assertEqual(tiers[FanoutPriority.LOW]['done'], 1)
+        self.assertEqual(tiers[FanoutPriority.HIGH]['missed_deadline'], 0)
+        self.assertNotEqual(progress['finished_at'], None)
+        self.assertEqual(progress['latency'] >= 0, True)
+
+        self.assertEqual(NewsFeedService.get_fanout_progress(0), None)
+        # 每个 batch 开始执行的时候都从排队的记录里认领掉了
+        self.assertEqual(conn.zcard(PENDING_FANOUT_BATCHES_KEY), 0)
+
+    def test_bump_overdue_fanout_batches(self):
+        tweet = self.create_tweet(self.linghu)
+        NewsFeedService.start_fanout_progress(tweet.id)
+        NewsFeedService.finish_fanout_dispatch(tweet.id, {FanoutPriority.LOW: 1})
+        # 模拟一个在低优先级的 queue 里排队超时的 batch
+        now = time.time()
+        batch_key = NewsFeedService.add_pending_fanout_batch({
+            'tweet_id': tweet.id,
+            'created_at': tweet.timestamp,
+            'follower_ids': [self.dongxie.id],
+            'priority': FanoutPriority.LOW,
+            'deadline': now - 1,
+            'queue': FanoutPriority.LOW,
+        }, bump_at=now - 1)
+        # 还没有超时的 batch 不会被挪走
+        NewsFeedService.add_pending_fanout_batch({'tweet_id': 0}, bump_at=now + 100)
+
+        msg = bump_overdue_fanout_batches_task()
+        self.assertEqual(msg, '1 fanout batches bumped')
+        self.assertEqual(NewsFeedService.count(self.dongxie.id), 1)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.zcard(PENDING_FANOUT_BATCHES_KEY), 1)
+
+        # 按照原来的优先级统计进度
+        progress = NewsFeedService.get_fanout_progress(tweet.id)
+        tier = progress['tiers'][FanoutPriority.LOW]
+        self.assertEqual((tier['done'], tier['bumped'], tier['missed_deadline']), (1, 1, 1))
+        self.assertNotEqual(progress['finished_at'], None)
+
+        # 原来的任务轮到执行的时候什么都不做
+        msg = fanout_newsfeeds_batch_task(
+            tweet.id,
+            tweet.timestamp,
+            [self.dongxie.id],
+            priority=FanoutPriority.LOW,
+            batch_key=batch_key,
+        )
+        self.assertEqual(msg, 'batch already bumped')
+        self.assertEqual(NewsFeedService.count(self.dongxie.id), 1)
+
+        # 排队的记录丢了，但是没有被挪走的 batch 照常执行
+        follower = self.create_user('follower')
+        batch_key = NewsFeedService.add_pending_fanout_batch({
+            'tweet_id': tweet.id,
+            'created_at': tweet.timestamp,
+            'follower_ids': [follower.id],
+            'priority': FanoutPriority.LOW,
+            'deadline': now + 100,
+            'queue': FanoutPriority.LOW,
+        }, bump_at=now + 100)
+        conn.delete(PENDING_FANOUT_BATCHES_KEY)
+        msg = fanout_newsfeeds_batch_task(
+            tweet.id,
+            tweet.timestamp,
+            [follower.id],
+            priority=FanoutPriority.LOW,
+            batch_key=batch_key,
+        )
+        self.assertEqual(msg, '1 newsfeeds created')
+        self.assertEqual(NewsFeedService.count(follower.id), 1)
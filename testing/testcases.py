@@ -2,6 +2,7 @@ from comments.models import Comment
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.test import TestCase as DjangoTestCase
 from django_hbase.models import HBaseModel
 from friendships.services import FriendshipService
@@ -38,6 +39,14 @@ class TestCase(DjangoTestCase):
         GateKeeper.turn_on('switch_friendship_to_hbase')
         GateKeeper.turn_on('switch_newsfeed_to_hbase')
 
+    def run_on_commit_callbacks(self):
+        # django 的 TestCase 把每个测试包在一个事务里，不会真正提交，transaction.on_commit 的回调不会执行
+        # 需要测试这些回调的时候手动执行一下，相当于提交了事务
+        # 升级到 django 3.2 之后可以换成 captureOnCommitCallbacks(execute=True)
+        connection = connections[DEFAULT_DB_ALIAS]
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
 
     @property
     def anonymous_client(self):
@@ -60,7 +69,9 @@ class TestCase(DjangoTestCase):
         return User.objects.create_user(username, email, password)
 
     def create_friendship(self, from_user, to_user):
-        return FriendshipService.follow(from_user.id, to_user.id)
+        friendship = FriendshipService.follow(from_user.id, to_user.id)
+        self.run_on_commit_callbacks()
+        return friendship
 
     def create_tweet(self, user, content=None):
         if content is None:
@@ -81,7 +92,9 @@ class TestCase(DjangoTestCase):
     def create_comment(self, user, tweet, content=None):
         if content is None:
             content = 'default comment content'
-        return Comment.objects.create(user=user, tweet=tweet, content=content)
+        comment = Comment.objects.create(user=user, tweet=tweet, content=content)
+        self.run_on_commit_callbacks()
+        return comment
 
     def create_like(self, user, target):
         # user 要点赞 target
@@ -102,6 +115,7 @@ class TestCase(DjangoTestCase):
             object_id=target.id,
             user=user,
         )
+        self.run_on_commit_callbacks()
         return instance
 
     def create_user_and_client(self, *args, **kwargs):
@@ -1,15 +1,46 @@
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
+from comments.services import CommentService
+from django.db.models import Manager
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService # 没放在api里,因为这个共享代码不一定被api使用,也可能被异步任务使用
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
+from tweets.constants import (
+    TWEET_DETAIL_PREVIEW_COMMENTS,
+    TWEET_DETAIL_PREVIEW_LIKES,
+    TWEET_PHOTOS_UPLOAD_LIMIT,
+)
 from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.redis_helper import RedisHelper
 
 
+class TweetListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # 渲染一页 tweets 之前先批量读取好所有的 user 和 profile
+        tweets = list(data.all() if isinstance(data, Manager) else data)
+        UserService.prefetch_users(tweets)
+        self.prefetch_context(self.context, tweets)
+        return super(TweetListSerializer, self).to_representation(tweets)
+
+    @classmethod
+    def prefetch_context(cls, context, tweets):
+        # 一页 tweets 需要的数据批量读取好放在 context 里，TweetSerializer 渲染的时候直接从 context 里读取
+        # 用一次查询拿到这一页里当前用户点赞过的 tweets
+        context['liked_tweet_ids'] = LikeService.get_liked_object_ids(
+            context['request'].user,
+            Tweet,
+            [tweet.id for tweet in tweets],
+        )
+        # 用一次 MGET 读取所有 tweets 的 likes_count 和 comments_count
+        context['tweet_counts'] = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        # 用一次 MGET 读取所有 tweets 的照片，没有照片的 tweets 也在 cache 里有记录
+        context['tweet_photo_urls'] = TweetService.get_photo_urls([tweet.id for tweet in tweets])
+
+
 class TweetSerializer(serializers.ModelSerializer):
     user = UserSerializerForTweet(source='cached_user') # used in fields
     comments_count = serializers.SerializerMethodField()
@@ -19,6 +50,7 @@ class TweetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Tweet
+        list_serializer_class = TweetListSerializer
         fields = (
             'id',
             'user',
@@ -30,20 +62,29 @@ class TweetSerializer(serializers.ModelSerializer):
             'photo_urls',
         )
 
+    def _get_count(self, obj, attr):
+        counts = self.context.get('tweet_counts')
+        if counts is not None and obj.id in counts:
+            return counts[obj.id][attr]
+        return RedisHelper.get_count(obj, attr)
+
     def get_likes_count(self, obj):
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj): # obj 得到这个帖子我有没有赞过
+        liked_tweet_ids = self.context.get('liked_tweet_ids')
+        if liked_tweet_ids is not None:
+            return obj.id in liked_tweet_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
-        photo_urls = []
-        for photo in obj.tweetphoto_set.all().order_by('order'):
-            photo_urls.append(photo.file.url)
-        return photo_urls
+        photo_urls = self.context.get('tweet_photo_urls')
+        if photo_urls is not None and obj.id in photo_urls:
+            return photo_urls[obj.id]
+        return TweetService.get_photo_urls([obj.id])[obj.id]
 
 
 class TweetSerializerForCreate(serializers.ModelSerializer):
@@ -70,11 +111,11 @@ class TweetSerializerForCreate(serializers.ModelSerializer):
         user = self.context['request'].user
         content = validated_data['content']
         tweet = Tweet.objects.create(user=user, content=content)
-        if validated_data.get('files'):
-            TweetService.create_photos_from_files(
-                tweet,
-                validated_data['files'],
-            )
+        # 没有上传照片的时候也调用一次，在 cache 里记录这个 tweet 没有照片
+        TweetService.create_photos_from_files(
+            tweet,
+            validated_data.get('files', []),
+        )
         return tweet
 
 
@@ -82,10 +123,10 @@ class TweetSerializerForCreate(serializers.ModelSerializer):
 # 改名，原来叫 TweetSerializerWithComments(
 # 改继承，原来继承 serializers.ModelSerializer
 class TweetSerializerForDetail(TweetSerializer):
-    # user = UserSerializerForTweet()
-    # <HOMEWORK> 使用 serialziers.SerializerMethodField 的方式实现 comments
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
+    # 热门 tweet 可能有成千上万的 comments 和 likes，详情页里只带上最新的几条作为预览
+    # 完整的列表通过 /api/tweets/<id>/comments/ 和 /api/tweets/<id>/likes/ 翻页读取
+    comments = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
@@ -96,9 +137,26 @@ class TweetSerializerForDetail(TweetSerializer):
             'created_at',
             'content',
             'likes',
-            'comments',
             'likes_count',
             'comments_count',
             'has_liked',
             'photo_urls',
-            )
\ No newline at end of file
+            )
+
+    def get_comments(self, obj):
+        comments, is_complete = CommentService.get_cached_comments_in_range(
+            obj.id,
+            limit=TWEET_DETAIL_PREVIEW_COMMENTS,
+        )
+        if not is_complete:
+            comments = obj.comment_set.order_by('-created_at')[:TWEET_DETAIL_PREVIEW_COMMENTS]
+        return CommentSerializer(comments, context=self.context, many=True).data
+
+    def get_likes(self, obj):
+        likes, is_complete = LikeService.get_cached_tweet_likes_in_range(
+            obj.id,
+            limit=TWEET_DETAIL_PREVIEW_LIKES,
+        )
+        if not is_complete:
+            likes = obj.like_set[:TWEET_DETAIL_PREVIEW_LIKES]
+        return LikeSerializer(likes, many=True).data
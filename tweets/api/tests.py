@@ -1,6 +1,7 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.constants import TWEET_DETAIL_PREVIEW_COMMENTS, TWEET_DETAIL_PREVIEW_LIKES
 from tweets.models import Tweet, TweetPhoto
 from utils.paginations import EndlessPagination
 
@@ -8,6 +9,8 @@ from utils.paginations import EndlessPagination
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_COMMENTS_API = '/api/tweets/{}/comments/'
+TWEET_LIKES_API = '/api/tweets/{}/likes/'
 
 
 class TweetApiTests(TestCase):
@@ -160,6 +163,65 @@ class TweetApiTests(TestCase):
         response = self.anonymous_client.get(url)
         self.assertEqual(len(response.data['comments']), 2)
 
+    def test_retrieve_previews(self):
+        page_size = EndlessPagination.page_size
+        tweet = self.create_tweet(self.user1)
+        comments, likes = [], []
+        for i in range(page_size + 2):
+            user = self.create_user('user{}'.format(i + 3))
+            comments.append(self.create_comment(user, tweet, 'comment {}'.format(i)))
+            likes.append(self.create_like(user, tweet))
+        comments, likes = comments[::-1], likes[::-1]
+
+        # 详情页只带上最新的几条 comments 和 likes
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.user1_client.get(url)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[:TWEET_DETAIL_PREVIEW_COMMENTS]],
+        )
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['likes']],
+            [like.user_id for like in likes[:TWEET_DETAIL_PREVIEW_LIKES]],
+        )
+        self.assertEqual(response.data['comments_count'], page_size + 2)
+        self.assertEqual(response.data['likes_count'], page_size + 2)
+
+        # 完整的列表通过翻页读取
+        response = self.anonymous_client.get(TWEET_COMMENTS_API.format(tweet.id))
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(len(response.data['results']), page_size)
+        response = self.anonymous_client.get(TWEET_COMMENTS_API.format(tweet.id), {
+            'created_at__lt': response.data['results'][-1]['created_at'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(response.data['results'][-1]['id'], comments[-1].id)
+
+        response = self.anonymous_client.get(TWEET_LIKES_API.format(tweet.id))
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['results']],
+            [like.user_id for like in likes[:page_size]],
+        )
+        response = self.anonymous_client.get(TWEET_LIKES_API.format(tweet.id), {
+            'created_at__lt': response.data['results'][-1]['created_at'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(response.data['results']), 2)
+
+        # 取消点赞之后 likes 的 cache 会重新 load
+        likes[0].delete()
+        self.run_on_commit_callbacks()
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['likes'][0]['user']['id'], likes[1].user_id)
+
+        # tweet 不存在或者 id 不合法都返回 404
+        for api in [TWEET_COMMENTS_API, TWEET_LIKES_API]:
+            response = self.anonymous_client.get(api.format(tweet.id + 100))
+            self.assertEqual(response.status_code, 404)
+            response = self.anonymous_client.get(api.format('abc'))
+            self.assertEqual(response.status_code, 404)
+
     def test_pagination(self):
         page_size = EndlessPagination.page_size
 
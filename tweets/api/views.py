@@ -1,6 +1,15 @@
+from comments.api.serializers import CommentSerializer
+from comments.models import Comment
+from comments.services import CommentService
+from django.contrib.contenttypes.models import ContentType
+from django.http import Http404
 from django.utils.decorators import method_decorator
+from likes.api.serializers import LikeSerializer
+from likes.models import Like
+from likes.services import LikeService
 from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
@@ -12,6 +21,7 @@ from tweets.api.serializers import (
 from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.decorators import required_params
+from utils.memcached_helper import MemcachedHelper
 from utils.paginations import EndlessPagination
 
 
@@ -25,14 +35,14 @@ class TweetViewSet(GenericViewSet):
     pagination_class = EndlessPagination
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:  # self.action 指调用的带request的函数
+        if self.action in ['list', 'retrieve', 'comments', 'likes']:  # self.action 指调用的带request的函数
             return [AllowAny()]
         return [IsAuthenticated()]
 
     @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
     def retrieve(self, request, *args, **kwargs):
-        # <HOMEWORK 1> 通过某个 query 参数 with_all_comments 来决定是否需要带上所有 comments
-        # <HOMEWORK 2> 通过某个 query 参数 with_preview_comments 来决定是否需要带上前三条 comments
+        # 详情页只带上最新的几条 comments 和 likes 作为预览，都从 redis 里读取
+        # 需要所有 comments 和 likes 的时候用下面的 comments 和 likes 两个接口翻页读取
         tweet = self.get_object()
         # return Response(
         #     TweetSerializerForDetail(tweet, context={'request': request}).data,
@@ -43,14 +53,61 @@ class TweetViewSet(GenericViewSet):
         )
         return Response(serializer.data)
 
+    def get_cached_object(self):
+        """
+        和 get_object 一样，tweet 不存在或者 id 不合法的时候返回 404
+        comments 和 likes 每翻一页都要确认一下 tweet 存在，从 memcached 里读取，不用每次都查数据库
+        """
+        try:
+            tweet_id = int(self.kwargs['pk'])
+        except ValueError:
+            raise Http404
+        tweet = MemcachedHelper.get_objects_through_cache(Tweet, [tweet_id]).get(tweet_id)
+        if tweet is None:
+            raise Http404
+        return tweet
+
+    @action(methods=['GET'], detail=True)
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
+    def comments(self, request, pk):
+        # 按照时间倒序翻页读取 comments，/api/comments/?tweet_id= 是按照时间顺序返回所有 comments 的老接口
+        tweet = self.get_cached_object()
+        page = self.paginator.paginate_cached_range(
+            lambda **kwargs: CommentService.get_cached_comments_in_range(tweet.id, **kwargs),
+            request,
+        )
+        if page is None:
+            page = self.paginate_queryset(Comment.objects.filter(tweet_id=tweet.id))
+        serializer = CommentSerializer(page, context={'request': request}, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=['GET'], detail=True)
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
+    def likes(self, request, pk):
+        tweet = self.get_cached_object()
+        page = self.paginator.paginate_cached_range(
+            lambda **kwargs: LikeService.get_cached_tweet_likes_in_range(tweet.id, **kwargs),
+            request,
+        )
+        if page is None:
+            queryset = Like.objects.filter(
+                content_type=ContentType.objects.get_for_model(Tweet),
+                object_id=tweet.id,
+            )
+            page = self.paginate_queryset(queryset)
+        serializer = LikeSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @required_params(params=['user_id'])
     def list(self, request, *args, **kwargs): # 只有加了view function，才会在api root页面看到链接。
         """
         重载 list方法，不列出所有 tweets，必须要求指定 user_id 作为筛选条件。
         """
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        page = self.paginator.paginate_cached_range(
+            lambda **kwargs: TweetService.get_cached_tweets_in_range(user_id, **kwargs),
+            request,
+        )
         if page is None:
             # 这句查询会被翻译为
             # select * from twitter_tweets
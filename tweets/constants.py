@@ -10,4 +10,8 @@ TWEET_PHOTO_STATUS_CHOICES = (
     (TweetPhotoStatus.REJECTED, 'Rejected'),
 )
 
-TWEET_PHOTOS_UPLOAD_LIMIT = 9
\ No newline at end of file
+TWEET_PHOTOS_UPLOAD_LIMIT = 9
+
+# tweet 详情页里只预览最新的几条 comments 和 likes，完整的列表通过翻页的接口读取
+TWEET_DETAIL_PREVIEW_COMMENTS = 3
+TWEET_DETAIL_PREVIEW_LIKES = 10
@@ -3,4 +3,9 @@ def push_tweet_to_cache(sender, instance, created, **kwargs):
         return
 
     from tweets.services import TweetService
-    TweetService.push_tweet_to_cache(instance)
\ No newline at end of file
+    TweetService.push_tweet_to_cache(instance)
+
+def invalidate_tweet_photos_cache(sender, instance, **kwargs):
+    # 照片被修改或者删除（比如审核不通过）之后，下次读取的时候重新从数据库里 load
+    from tweets.services import TweetService
+    TweetService.invalidate_photos_cache(instance.tweet_id)
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.models import HBaseNewsFeed
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.time_helpers import utc_now
+
+import time
+
+BENCHMARK_KEY = 'benchmark:redis_serializers'
+
+
+class Command(BaseCommand):
+    """
+    对比 json 格式和二进制格式在 cache 一个 list 的时候的序列化/反序列化时间和 redis 内存占用
+    用法: python manage.py benchmark_redis_serializers --count 1000 --redis
+    """
+    help = 'Compare encode/decode time and redis memory of json and binary cache formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000)
+        parser.add_argument(
+            '--redis',
+            action='store_true',
+            help='also measure MEMORY USAGE of the cached list in redis',
+        )
+
+    def handle(self, *args, **options):
+        count = options['count']
+        now = utc_now()
+        tweets = [
+            Tweet(
+                id=i + 1,
+                user_id=1,
+                content='benchmark tweet content {}'.format(i),
+                created_at=now,
+                likes_count=i,
+                comments_count=i,
+            )
+            for i in range(count)
+        ]
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=1666000000000000 + i, tweet_id=i + 1)
+            for i in range(count)
+        ]
+
+        for name, serializer, objects in [
+            ('Tweet', DjangoModelSerializer, tweets),
+            ('HBaseNewsFeed', HBaseModelSerializer, newsfeeds),
+        ]:
+            for format_name, encode, decode in [
+                ('json', serializer.serialize_json, serializer.deserialize_json),
+                ('binary', serializer.serialize, serializer.deserialize),
+            ]:
+                self.benchmark(name, format_name, objects, encode, decode, options['redis'])
+
+    def benchmark(self, name, format_name, objects, encode, decode, measure_redis):
+        start = time.perf_counter()
+        serialized_list = [encode(obj) for obj in objects]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for serialized_data in serialized_list:
+            decode(serialized_data)
+        decode_time = time.perf_counter() - start
+
+        size = sum(
+            len(data.encode('utf-8') if isinstance(data, str) else data)
+            for data in serialized_list
+        )
+        line = '{:<14} {:<7} encode {:8.2f} ms  decode {:8.2f} ms  payload {:>9} bytes'.format(
+            name,
+            format_name,
+            encode_time * 1000,
+            decode_time * 1000,
+            size,
+        )
+        if measure_redis:
+            conn = RedisClient.get_connection()
+            conn.delete(BENCHMARK_KEY)
+            conn.rpush(BENCHMARK_KEY, *serialized_list)
+            line += '  redis {:>9} bytes'.format(conn.memory_usage(BENCHMARK_KEY, samples=0))
+            conn.delete(BENCHMARK_KEY)
+        self.stdout.write(line)
\ No newline at end of file
@@ -47,6 +47,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # 列表页会用 UserService.prefetch_users 提前批量读取好
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
     @property
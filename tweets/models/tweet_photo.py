@@ -1,7 +1,9 @@
 from .tweet import Tweet
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, pre_delete
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
+from tweets.listeners import invalidate_tweet_photos_cache
 
 
 class TweetPhoto(models.Model):
@@ -40,4 +42,8 @@ class TweetPhoto(models.Model):
         )
 
     def __str__(self):
-        return f'{self.tweet_id}: {self.file}'
\ No newline at end of file
+        return f'{self.tweet_id}: {self.file}'
+
+
+post_save.connect(invalidate_tweet_photos_cache, sender=TweetPhoto)
+pre_delete.connect(invalidate_tweet_photos_cache, sender=TweetPhoto)
@@ -1,7 +1,11 @@
+from django.conf import settings
 from tweets.models import Tweet, TweetPhoto
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import TWEET_PHOTOS_PATTERN, USER_TWEETS_PATTERN
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
 
+import json
+
 
 def lazy_load_tweets(user_id):
     def _lazy_load(limit):
@@ -22,13 +26,81 @@ class TweetService(object):
                 order=index,
             )
             photos.append(photo)
-        TweetPhoto.objects.bulk_create(photos)
+        if photos:
+            TweetPhoto.objects.bulk_create(photos)
+        # 没有照片的 tweet 也记录一个空列表，渲染的时候就不需要再去数据库里确认
+        cls._set_photo_names_to_cache({tweet.id: [photo.file.name for photo in photos]})
+
+    @classmethod
+    def _set_photo_names_to_cache(cls, photo_names_by_tweet_id):
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        for tweet_id, photo_names in photo_names_by_tweet_id.items():
+            key = TWEET_PHOTOS_PATTERN.format(tweet_id=tweet_id)
+            pipeline.set(key, json.dumps(photo_names), ex=settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def invalidate_photos_cache(cls, tweet_id):
+        if tweet_id is None:
+            return
+        conn = RedisClient.get_connection()
+        conn.delete(TWEET_PHOTOS_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def get_photo_urls(cls, tweet_ids):
+        """
+        批量读取一页 tweets 的照片地址，返回 {tweet_id: [url, ...]}
+        cache 里存的是文件名而不是 url，因为 S3 的 url 可能带有会过期的签名，
+        从文件名生成 url 只是本地计算，不需要访问网络
+        用一次 MGET 读取所有 tweets，cache 里没有的用一次查询读取并写回 cache
+        """
+        tweet_ids = list(dict.fromkeys(tweet_ids))
+        if not tweet_ids:
+            return {}
+        conn = RedisClient.get_connection()
+        keys = [TWEET_PHOTOS_PATTERN.format(tweet_id=tweet_id) for tweet_id in tweet_ids]
+        photo_names_by_tweet_id = {}
+        missing_tweet_ids = []
+        for tweet_id, value in zip(tweet_ids, conn.mget(keys)):
+            if value is None:
+                missing_tweet_ids.append(tweet_id)
+            else:
+                photo_names_by_tweet_id[tweet_id] = json.loads(value)
+
+        if missing_tweet_ids:
+            loaded = {tweet_id: [] for tweet_id in missing_tweet_ids}
+            photos = TweetPhoto.objects.filter(
+                tweet_id__in=missing_tweet_ids,
+            ).order_by('tweet_id', 'order')
+            for photo in photos:
+                loaded[photo.tweet_id].append(photo.file.name)
+            cls._set_photo_names_to_cache(loaded)
+            photo_names_by_tweet_id.update(loaded)
+
+        storage = TweetPhoto._meta.get_field('file').storage
+        return {
+            tweet_id: [storage.url(name) for name in photo_names]
+            for tweet_id, photo_names in photo_names_by_tweet_id.items()
+        }
 
     @classmethod
     def get_cached_tweets(cls, user_id):
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(key, lazy_load_tweets(user_id))
 
+    @classmethod
+    def get_cached_tweets_in_range(cls, user_id, created_at__lt=None, created_at__gt=None, limit=None):
+        # 只读取一页需要的 tweets，返回 (tweets, is_complete)
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_objects_in_range(
+            key,
+            lazy_load_tweets(user_id),
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+            limit=limit,
+        )
+
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
@@ -0,0 +1,77 @@
+from celery import shared_task
+from django.db.models import Count
+from utils.time_constants import ONE_HOUR
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_count_deltas_task():
+    # import 写在里面避免循环依赖
+    from utils.redis_helper import RedisHelper
+    flushed = RedisHelper.flush_count_deltas()
+    return '{} counts flushed.'.format(flushed)
+
+
+def _iterate_id_batches(queryset, batch_size):
+    batch = []
+    for object_id in queryset.order_by('id').values_list('id', flat=True).iterator(batch_size):
+        batch.append(object_id)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _count_by(queryset, field, object_ids):
+    # 返回 {object id: 行数}，没有任何记录的 object 的计数为 0
+    counts = dict(
+        queryset.filter(**{'{}__in'.format(field): object_ids})
+        .values_list(field)
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    return {object_id: counts.get(object_id, 0) for object_id in object_ids}
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_counts_task(batch_size=RECONCILE_BATCH_SIZE):
+    """
+    以 Like 和 Comment 表为准重新计算所有的 likes_count 和 comments_count
+    修正 write-behind 过程中因为 flush 失败或者重复 flush 等原因造成的误差
+    """
+    from comments.models import Comment
+    from django.contrib.contenttypes.models import ContentType
+    from likes.models import Like
+    from tweets.models import Tweet
+    from utils.redis_helper import RedisHelper
+
+    # 先把还没有写回的 deltas 写回去，尽量减少需要修正的计数
+    RedisHelper.flush_count_deltas()
+
+    fixed = 0
+    tweet_likes = Like.objects.filter(content_type=ContentType.objects.get_for_model(Tweet))
+    for tweet_ids in _iterate_id_batches(Tweet.objects.all(), batch_size):
+        fixed += RedisHelper.reconcile_counts(
+            Tweet,
+            'likes_count',
+            tweet_ids,
+            lambda object_ids: _count_by(tweet_likes, 'object_id', object_ids),
+        )
+        fixed += RedisHelper.reconcile_counts(
+            Tweet,
+            'comments_count',
+            tweet_ids,
+            lambda object_ids: _count_by(Comment.objects.all(), 'tweet_id', object_ids),
+        )
+
+    comment_likes = Like.objects.filter(content_type=ContentType.objects.get_for_model(Comment))
+    for comment_ids in _iterate_id_batches(Comment.objects.all(), batch_size):
+        fixed += RedisHelper.reconcile_counts(
+            Comment,
+            'likes_count',
+            comment_ids,
+            lambda object_ids: _count_by(comment_likes, 'object_id', object_ids),
+        )
+    return '{} counts reconciled.'.format(fixed)
@@ -1,8 +1,21 @@
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+FOLLOWER_COUNT_PATTERN = 'follower_count:{user_id}:{limit}'
 
 # redis
+FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
-
+NEWSFEED_PULL_MODE_USERS_KEY = 'newsfeed_pull_mode_users'
+USER_LAST_SEEN_KEY = 'user_last_seen'
+USER_DORMANT_SINCE_PATTERN = 'user_dormant_since:{user_id}'
+FANOUT_PROGRESS_PATTERN = 'fanout_progress:{tweet_id}'
+PENDING_FANOUT_BATCHES_KEY = 'pending_fanout_batches'
+FANOUT_BATCH_BUMPED_PATTERN = 'fanout_batch_bumped:{batch_id}'
+USER_LIKED_OBJECTS_PATTERN = 'user_liked_{model_name}s:{user_id}'
+COUNT_DELTAS_KEY = 'count_deltas'
+FLUSHING_COUNT_DELTAS_KEY = 'count_deltas:flushing'
+COUNT_DELTAS_GENERATION_KEY = 'count_deltas:generation'
+TWEET_PHOTOS_PATTERN = 'tweet_photos:{tweet_id}'
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'
+TWEET_LIKES_PATTERN = 'tweet_likes:{tweet_id}'
@@ -10,10 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+from celery.schedules import crontab
 from kombu import Queue
 from pathlib import Path
 
 import sys
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -61,6 +63,8 @@ INSTALLED_APPS = [
     'comments',
     'likes',
     'inbox',
+    # 只是为了注册 django_hbase 里的 management commands，没有 django 的 model
+    'django_hbase',
 ]
 
 REST_FRAMEWORK = {
@@ -78,6 +82,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middlewares.UserActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -183,6 +188,9 @@ AWS_S3_REGION_NAME = 'us-west-1'
 # - static 里通常是 css,js 文件之类的静态代码文件，是用户可以直接访问的代码文件
 # - media 里使用户上传的数据文件，而不是代码
 MEDIA_ROOT = 'media/'
+# 跑测试的时候上传的文件放到临时目录里，不要写到代码目录下面
+if TESTING:
+    MEDIA_ROOT = tempfile.mkdtemp(prefix='twitter_test_media_')
 
 # https://docs.djangoproject.com/en/3.1/topics/cache/
 # memcached 安装方法: apt-get install memcached
@@ -216,6 +224,19 @@ REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# 每个用户点赞过的 object ids 最多只 cache id 最大的这么多个，更早的 objects 去数据库里查
+REDIS_LIKED_SET_SIZE_LIMIT = 1000 if not TESTING else 20
+# cache miss 的时候只有拿到锁的进程去数据库 load，其他进程等待或者先读旧的数据
+REDIS_LOAD_LOCK_EXPIRE_TIME = 10  # in seconds
+REDIS_LOAD_WAIT_TIMEOUT = 2  # in seconds
+REDIS_LOAD_POLL_INTERVAL = 0.05  # in seconds
+# 快过期的 key 会按照一定的概率被提前刷新，剩余时间越少概率越大，参见 RedisHelper.should_refresh_early
+REDIS_EARLY_REFRESH_WINDOW = 60  # in seconds
+# likes_count 和 comments_count 的 deltas 先记在 redis 里，定期批量写回数据库
+COUNT_DELTAS_FLUSH_LOCK_EXPIRE_TIME = 60  # in seconds
+# flush 或者 reconcile 的期间从数据库 load 的计数可能算重了 deltas，只 cache 很短的时间
+COUNT_UNSTABLE_EXPIRE_TIME = 5  # in seconds
+COUNT_BULK_UPDATE_BATCH_SIZE = 500
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -223,10 +244,32 @@ REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING else 'redis://127.0.0.1:6379/0'
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
+# newsfeeds 的 fanout 任务按照优先级分到三个 queue 里，参见 newsfeeds.constants.FanoutPriority
+# 建议给高优先级的 queue 单独跑 worker，保证普通用户的 tweets 可以在几秒之内 fanout 完
+#   celery -A twitter worker -l INFO -Q newsfeeds_high
+#   celery -A twitter worker -l INFO -Q default,newsfeeds,newsfeeds_low
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
+    Queue('newsfeeds_high', routing_key='newsfeeds_high'),
     Queue('newsfeeds', routing_key='newsfeeds'),
+    Queue('newsfeeds_low', routing_key='newsfeeds_low'),
 )
+# 定期执行的任务，需要单独跑一个 beat 进程来调度
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-count-deltas': {
+        'task': 'tweets.tasks.flush_count_deltas_task',
+        'schedule': 10.0,
+    },
+    'bump-overdue-fanout-batches': {
+        'task': 'newsfeeds.tasks.bump_overdue_fanout_batches_task',
+        'schedule': 30.0,
+    },
+    'reconcile-counts': {
+        'task': 'tweets.tasks.reconcile_counts_task',
+        'schedule': crontab(hour=4, minute=0),
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -235,6 +278,16 @@ RATELIMIT_ENABLE = not TESTING  # 在某些环境下，比如内部测试等环
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+# 每个进程里 happybase.ConnectionPool 的连接数，至少要和 web worker 的线程数或者 celery 的 concurrency 一样
+HBASE_POOL_SIZE = 10
+# thrift 请求的超时时间，单位是毫秒
+HBASE_TIMEOUT = 5000
+# pool 里的连接都被占用的时候最多等待的秒数
+HBASE_POOL_TIMEOUT = 5
+# 读操作遇到连接错误的时候换一个连接重试的次数
+HBASE_READ_RETRIES = 2
+# 连接闲置超过这个秒数之后，使用之前先检查一下连接是否还可用
+HBASE_HEALTH_CHECK_INTERVAL = 60
 
 try:
     from .local_settings import *
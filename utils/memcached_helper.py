@@ -24,6 +24,32 @@ class MemcachedHelper:
         cache.set(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版本的 get_object_through_cache，用一次 get_many 从 cache 里读取所有的 objects
+        cache 里没有的用一次 id__in 的查询从数据库里读取，再用一次 set_many 写回 cache
+        返回 {object_id: obj}，数据库里也不存在的 object 不会出现在结果里
+        """
+        keys = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in set(object_ids)
+        }
+        objects = {
+            keys[key]: obj
+            for key, obj in cache.get_many(keys).items()
+        }
+
+        missing_ids = [object_id for object_id in keys.values() if object_id not in objects]
+        if missing_ids:
+            missing_objects = list(model_class.objects.filter(id__in=missing_ids))
+            cache.set_many({
+                cls.get_key(model_class, obj.id): obj
+                for obj in missing_objects
+            })
+            objects.update({obj.id: obj for obj in missing_objects})
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
@@ -5,6 +5,14 @@ from rest_framework.response import Response
 from utils.time_constants import MAX_TIMESTAMP
 
 
+def parse_cursor(value):
+    # 兼容 iso 格式和 int 格式的时间戳，iso 格式返回 datetime，int 格式原样返回
+    try:
+        return parser.isoparse(value)
+    except ValueError:
+        return int(value)
+
+
 class EndlessPagination(BasePagination):
     page_size = 20 if not settings.TESTING else 10
 
@@ -15,39 +23,6 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
-
-        index = 0
-        if 'created_at__lt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没找到任何满足条件的 objects, 返回空数组
-                # 注意这个 else 对应的是 for，参见 python 的 for else 语法
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
-
     def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
@@ -72,19 +47,31 @@ class EndlessPagination(BasePagination):
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
-        paginated_list = self.paginate_ordered_list(cached_list, request)
-        # 如果是上翻页，paginated_list 里是所有的最新的数据，直接返回
+    def paginate_cached_range(self, load_objects_in_range, request):
+        """
+        从 cache 的 sorted set 里只读取这一页需要的数据，翻页参数的含义和 paginate_queryset 一样
+        load_objects_in_range(created_at__lt, created_at__gt, limit) 返回 (objects, is_complete)
+        返回 None 表示 cache 里的数据不够，需要直接去数据库查询
+        """
         if 'created_at__gt' in request.query_params:
-            return paginated_list
-        # 如果还有下一页，说明 cached_list 里的数据还没有取完，也直接返回
-        if self.has_next_page:
-            return paginated_list
-        # 如果 cached_list 的长度不足最大限制，说明 cached_list 里已经是所有数据了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
-            return paginated_list
-        # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
-        return None
+            objects, is_complete = load_objects_in_range(
+                created_at__gt=parse_cursor(request.query_params['created_at__gt']),
+            )
+            self.has_next_page = False
+            return objects if is_complete else None
+
+        created_at__lt = None
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parse_cursor(request.query_params['created_at__lt'])
+        # 多取一个 object 用来判断是否还有下一页
+        objects, is_complete = load_objects_in_range(
+            created_at__lt=created_at__lt,
+            limit=self.page_size + 1,
+        )
+        if not is_complete:
+            return None
+        self.has_next_page = len(objects) > self.page_size
+        return objects[:self.page_size]
 
     def get_paginated_response(self, data):
         return Response({
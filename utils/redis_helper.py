@@ -1,107 +1,651 @@
+from collections import defaultdict
+from datetime import datetime
+from django.apps import apps
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Coalesce
 from django_hbase.models import HBaseModel
+from redis.exceptions import ResponseError
+from twitter.cache import (
+    COUNT_DELTAS_GENERATION_KEY,
+    COUNT_DELTAS_KEY,
+    FLUSHING_COUNT_DELTAS_KEY,
+)
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.redis_serializers import (
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+    StaleSerializedDataError,
+)
+from utils.time_helpers import datetime_to_timestamp
+
+import math
+import random
+import time
+import uuid
+
+# 空的 timeline 也要 cache 起来，否则大部分没有评论和点赞的 tweet 每次读取都是 cache miss
+# 用一个 score 为 0 的占位 member 表示这个 timeline 已经 load 过了，读取的时候只读 score 大于 0 的部分
+EMPTY_TIMELINE_PLACEHOLDER = ''
+EMPTY_TIMELINE_PLACEHOLDER_SCORE = 0
+
+# 只有 timeline 已经在 cache 里的时候才把 object 加进去，然后 trim 到最大长度
+# 加进去之后 timeline 就不是空的了，删掉占位 member
+# 用 lua script 保证检查和写入是原子的，避免 key 恰好过期的时候写进去一个不完整的 timeline
+PUSH_IF_CACHED_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'zset' then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[4], ARGV[4])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+return 1
+"""
+
+# 计数的 delta 记在一个 hash 里等待写回数据库，cache 里已经有这个计数的话同时更新 cache
+ADD_COUNT_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('INCRBY', KEYS[2], ARGV[2])
+end
+return false
+"""
+
+# 每次修改 set 的时候把它的 version +1
+# add 只有 set 已经在 cache 里的时候才加进去，不在 cache 里的等下次读取的时候从数据库 load
+# 用 lua script 保证检查和写入是原子的，避免 key 恰好过期的时候写进去一个不完整的 set
+UPDATE_SET_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if ARGV[1] == 'remove' then
+    return redis.call('SREM', KEYS[1], ARGV[2])
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('SADD', KEYS[1], ARGV[2])
+"""
+
+# 从数据库 load 的期间 version 没有变过才写入 cache，否则 load 到的数据可能漏掉了这期间的修改
+# 有 KEYS[3] 的话同时写入这个 set 的附加信息 ARGV[3]
+# 逐个 SADD，members 很多的时候也不会超过 lua 的 unpack 的参数个数限制
+LOAD_SET_IF_UNCHANGED_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 4, #ARGV do
+    redis.call('SADD', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if KEYS[3] then
+    redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[2])
+end
+return 1
+"""
+
+# 只释放自己拿到的锁，避免锁过期之后把别的进程拿到的锁删掉
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class RedisHelper:
+    """
+    user_tweets 和 user_newsfeeds 这类 timeline 存在 redis 的 sorted set 里
+    score 是以 micro second 为单位的 created_at，member 是序列化之后的 object
+    这样乱序到达的 object（比如延迟执行的 fanout batch）也能插入到正确的位置
+    翻页的时候用 ZREVRANGEBYSCORE 直接定位到 cursor 的位置
+    """
+
+    @classmethod
+    def get_score(cls, created_at):
+        # 目前的 micro second 时间戳小于 2^53，存成 double 类型的 score 也不会丢失精度
+        if isinstance(created_at, datetime):
+            return datetime_to_timestamp(created_at)
+        return created_at
 
     @classmethod
     def _load_objects_to_cache(cls, key, objects, serializer):
+        mapping = {
+            serializer.serialize(obj): cls.get_score(obj.created_at)
+            for obj in objects
+        }
+        if not mapping:
+            mapping = {EMPTY_TIMELINE_PLACEHOLDER: EMPTY_TIMELINE_PLACEHOLDER_SCORE}
+        # 先删掉再写入，提前刷新的时候用新的数据整个替换掉旧的数据
         conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.delete(key)
+        pipeline.zadd(key, mapping)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
 
-        serialized_list = []
-        for obj in objects:
-            serialized_data = serializer.serialize(obj)
-            serialized_list.append(serialized_data)
+    @classmethod
+    def load_objects(cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
+        objects, _ = cls.load_objects_in_range(key, lazy_load_objects, serializer)
+        return objects
+
+    @classmethod
+    def _load_objects_in_range_from_cache(cls, key, serializer, created_at__lt, created_at__gt, limit):
+        conn = RedisClient.get_connection()
+        # 用 MULTI 保证 ZCARD 和读取到的一页数据是一致的
+        pipeline = conn.pipeline()
+        pipeline.pttl(key)
+        pipeline.zcard(key)
+        # 不读取 score 为 0 的占位 member
+        min_score = '({}'.format(EMPTY_TIMELINE_PLACEHOLDER_SCORE)
+        if created_at__gt is not None:
+            score = cls.get_score(created_at__gt)
+            pipeline.zrevrangebyscore(key, '+inf', '({}'.format(score))
+            # 看一下 cache 里有没有不比 created_at__gt 新的数据，没有的话中间可能缺了一段
+            # 空的 timeline 的占位 member 也算，说明 cache 里就是完整的
+            pipeline.zcount(key, '-inf', score)
+        else:
+            if created_at__lt is not None:
+                max_score = '({}'.format(cls.get_score(created_at__lt))
+            else:
+                max_score = '+inf'
+            if limit is None:
+                pipeline.zrevrangebyscore(key, max_score, min_score)
+            else:
+                pipeline.zrevrangebyscore(key, max_score, min_score, start=0, num=limit)
+        ttl, *results = pipeline.execute()
+
+        length, serialized_list = results[0], results[1]
+        if not length:
+            return None, False, None
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        objects = [
+            serializer.deserialize(serialized_data)
+            for serialized_data in serialized_list
+        ]
+        # 长度达到了 cache 的最大限制，说明更老的数据可能只在数据库里
+        is_truncated = length >= settings.REDIS_LIST_LENGTH_LIMIT
+        if created_at__gt is not None:
+            return objects, results[2] > 0 or not is_truncated, ttl
+        is_complete = (limit is not None and len(objects) == limit) or not is_truncated
+        return objects, is_complete, ttl
 
     @classmethod
-    def load_objects(cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
+    def _filter_objects_in_range(cls, objects, created_at__lt, created_at__gt, limit):
+        # objects 是刚从数据库里 load 出来的，已经在内存里了，直接在内存里过滤
+        is_truncated = len(objects) >= settings.REDIS_LIST_LENGTH_LIMIT
+        if created_at__gt is not None:
+            newer_objects = [obj for obj in objects if obj.created_at > created_at__gt]
+            return newer_objects, len(newer_objects) < len(objects) or not is_truncated
+
+        if created_at__lt is not None:
+            objects = [obj for obj in objects if obj.created_at < created_at__lt]
+        if limit is not None:
+            objects = objects[:limit]
+        return objects, (limit is not None and len(objects) == limit) or not is_truncated
+
+    @classmethod
+    def should_refresh_early(cls, ttl):
+        """
+        probabilistic early refresh (XFetch)：剩余的过期时间越短，越有可能提前刷新
+        ttl 是以 milli second 为单位的剩余时间，剩余 REDIS_EARLY_REFRESH_WINDOW 的时候
+        刷新的概率大约是 1/e，热门的 key 基本上会在过期之前被某一个请求刷新掉
+        """
+        if ttl is None or ttl < 0:
+            return False
+        # 1 - random() 的范围是 (0, 1]，避免 log(0)
+        threshold = -settings.REDIS_EARLY_REFRESH_WINDOW * math.log(1 - random.random())
+        return ttl / 1000 <= threshold
+
+    @classmethod
+    def get_lock_key(cls, key):
+        return '{}:lock'.format(key)
+
+    @classmethod
+    def _acquire_lock(cls, key, expire_time=None):
+        # 返回锁的 token，没有拿到锁返回 None
+        token = uuid.uuid4().hex
         conn = RedisClient.get_connection()
+        acquired = conn.set(
+            cls.get_lock_key(key),
+            token,
+            nx=True,
+            ex=expire_time or settings.REDIS_LOAD_LOCK_EXPIRE_TIME,
+        )
+        return token if acquired else None
 
-        # 如果在 cache 里存在，则直接拿出来，然后返回
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = serializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
+    @classmethod
+    def _release_lock(cls, key, token):
+        conn = RedisClient.get_connection()
+        script = conn.register_script(RELEASE_LOCK_SCRIPT)
+        script(keys=[cls.get_lock_key(key)], args=[token])
 
-        # cache miss
-        # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
-        # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
-        # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
+    @classmethod
+    def _wait_for_load(cls, key, serializer, created_at__lt, created_at__gt, limit):
+        # 别的进程正在从数据库 load，等它写完 cache 之后直接读 cache
+        deadline = time.time() + settings.REDIS_LOAD_WAIT_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(settings.REDIS_LOAD_POLL_INTERVAL)
+            objects, is_complete, _ = cls._load_objects_in_range_from_cache(
+                key,
+                serializer,
+                created_at__lt,
+                created_at__gt,
+                limit,
+            )
+            if objects is not None:
+                return objects, is_complete
+        return None
 
-        # 转换为 list 的原因是保持返回类型的统一，因为存在 redis 里的数据是 list 的形式
-        return list(objects)
+    @classmethod
+    def load_objects_in_range(
+        cls,
+        key,
+        lazy_load_objects,
+        serializer=DjangoModelSerializer,
+        created_at__lt=None,
+        created_at__gt=None,
+        limit=None,
+    ):
+        """
+        只读取并反序列化一页需要的 objects，created_at__lt 和 created_at__gt 的含义和
+        EndlessPagination 里一致
+        返回 (objects, is_complete)，is_complete 为 False 表示 cache 里的数据不够回答这次查询
+        需要去数据库里查询
+        """
+        objects, is_complete = None, False
+        try:
+            objects, is_complete, ttl = cls._load_objects_in_range_from_cache(
+                key,
+                serializer,
+                created_at__lt,
+                created_at__gt,
+                limit,
+            )
+            if objects is not None and not cls.should_refresh_early(ttl):
+                return objects, is_complete
+        except (StaleSerializedDataError, ResponseError) as e:
+            # model 的字段改变了，或者 key 还是升级之前的 list 类型
+            # cache 里的旧数据已经没法用了，删掉之后当作 cache miss 处理
+            if isinstance(e, ResponseError) and 'WRONGTYPE' not in str(e):
+                raise
+            RedisClient.get_connection().delete(key)
+
+        # cache miss 或者需要提前刷新
+        # 热门的 key 过期的时候会有大量的请求同时 miss，只让拿到锁的那一个去数据库 load
+        token = cls._acquire_lock(key)
+        if token is None:
+            # 提前刷新的时候旧的数据还没有过期，别的进程正在刷新，直接返回旧的数据就可以了
+            if objects is not None:
+                return objects, is_complete
+            result = cls._wait_for_load(key, serializer, created_at__lt, created_at__gt, limit)
+            if result is not None:
+                return result
+            # 等待超时了，直接去数据库里查，但是不写 cache，写 cache 是拿到锁的进程的事情
+            objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+            return cls._filter_objects_in_range(objects, created_at__lt, created_at__gt, limit)
+
+        try:
+            # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
+            # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
+            # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
+            objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+            cls._load_objects_to_cache(key, objects, serializer)
+        finally:
+            cls._release_lock(key, token)
+        return cls._filter_objects_in_range(objects, created_at__lt, created_at__gt, limit)
 
     @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
+    def get_serializer(cls, obj):
         if isinstance(obj, HBaseModel):
-            serializer = HBaseModelSerializer
-        else:
-            serializer = DjangoModelSerializer
+            return HBaseModelSerializer
+        return DjangoModelSerializer
 
+    @classmethod
+    def _push_if_cached(cls, key, obj, client):
+        conn = RedisClient.get_connection()
+        script = conn.register_script(PUSH_IF_CACHED_SCRIPT)
+        return script(
+            keys=[key],
+            args=[
+                cls.get_score(obj.created_at),
+                cls.get_serializer(obj).serialize(obj),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                EMPTY_TIMELINE_PLACEHOLDER_SCORE,
+            ],
+            client=client,
+        )
+
+    @classmethod
+    def push_object(cls, key, obj, lazy_load_objects):
+        # 如果在 cache 里存在，按照 created_at 插入到 sorted set 里，然后 trim 一下长度
         conn = RedisClient.get_connection()
-        # 如果在 cache 里存在，直接把 obj 放在 list 的最前面，然后 trim 一下长度
-        if conn.exists(key):
-            serialized_data = serializer.serialize(obj)
-            conn.lpush(key, serialized_data)
-            conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        if cls._push_if_cached(key, obj, conn):
             return
 
         # 如果 key 不存在，直接从数据库里 load
-        # 就不走单个 push 的方式加到 cache 里了
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
+        # 别的进程拿着锁的时候 load_objects 会等它写完 cache，那个进程可能在 obj 写入数据库之前就读完了
+        # 所以 load 完之后再 push 一次，重复 push 同一个 obj 不会产生重复的数据
+        cls.load_objects(key, lazy_load_objects, cls.get_serializer(obj))
+        cls._push_if_cached(key, obj, conn)
+
+    @classmethod
+    def push_objects_if_cached(cls, keys_and_objects):
+        """
+        批量把 (key, obj) 里的 obj 按照 created_at 插入到对应的 timeline 里
+        用 pipeline 把所有的命令一次性发给 redis，只需要一次网络往返
+        不在 cache 里的 key 直接跳过，等到下次读取的时候再 lazy load
+        避免 fanout 的时候每个 key 都去数据库 load 一次
+        """
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for key, obj in keys_and_objects:
+            cls._push_if_cached(key, obj, pipeline)
+        pipeline.execute()
+
+    @classmethod
+    def get_set_version_key(cls, key):
+        return '{}:version'.format(key)
+
+    @classmethod
+    def get_set_version(cls, key):
+        """
+        followings 和 liked objects 这类 set 从数据库 load 之前先读一下 version
+        之后用 load_set_if_unchanged 写入，load 期间有 add 或者 remove 的话就不写 cache
+        """
+        conn = RedisClient.get_connection()
+        return conn.get(cls.get_set_version_key(key)) or ''
+
+    @classmethod
+    def load_set_if_unchanged(cls, key, version, members, meta_key=None, meta_value=''):
+        # 写入成功返回 True，version 变了返回 False，下次读取的时候再重新 load
+        # meta_key 用来存放和 set 一起写入、一起过期的附加信息
+        conn = RedisClient.get_connection()
+        script = conn.register_script(LOAD_SET_IF_UNCHANGED_SCRIPT)
+        keys = [key, cls.get_set_version_key(key)]
+        if meta_key is not None:
+            keys.append(meta_key)
+        return bool(script(
+            keys=keys,
+            args=[version, settings.REDIS_KEY_EXPIRE_TIME, meta_value, *members],
+        ))
 
+    @classmethod
+    def _update_set(cls, key, action, member):
+        # version 要比任何一次 load 活得久，否则 load 期间 version 过期了会被当成没有变过
+        conn = RedisClient.get_connection()
+        script = conn.register_script(UPDATE_SET_SCRIPT)
+        return script(
+            keys=[key, cls.get_set_version_key(key)],
+            args=[action, member, settings.REDIS_KEY_EXPIRE_TIME],
+        )
+
+    @classmethod
+    def add_to_set_if_cached(cls, key, member):
+        return cls._update_set(key, 'add', member)
+
+    @classmethod
+    def remove_from_set(cls, key, member):
+        return cls._update_set(key, 'remove', member)
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
     @classmethod
-    def incr_count(cls, obj, attr):
+    def get_count_delta_field(cls, obj, attr):
+        return '{}:{}:{}'.format(obj._meta.label_lower, attr, obj.id)
+
+    @classmethod
+    def _add_count(cls, obj, attr, delta):
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.incr(key)
+        script = conn.register_script(ADD_COUNT_SCRIPT)
+        return script(
+            keys=[COUNT_DELTAS_KEY, cls.get_count_key(obj, attr)],
+            args=[cls.get_count_delta_field(obj, attr), delta],
+        )
 
-        # back fill cache from db
-        # 不执行 +1 操作，因为必须保证调用 incr_count 之前 obj.attr 已经 +1 过了
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+    @classmethod
+    def incr_count(cls, obj, attr):
+        """
+        write-behind：不直接更新数据库里的计数，而是把 +1 记在 redis 里
+        由 flush_count_deltas 定期批量写回数据库，避免热门 tweet 的那一行被频繁加锁
+        cache 里已经有计数的话直接 +1，返回 +1 之后的值，没有的话返回 None，等读取的时候再 load
+        """
+        return cls._add_count(obj, attr, 1)
 
     @classmethod
     def decr_count(cls, obj, attr):
+        return cls._add_count(obj, attr, -1)
+
+    @classmethod
+    def get_pending_count_deltas(cls, fields):
+        # 还没有写回数据库的 deltas，包括正在 flush 的那一部分
+        deltas, _ = cls._get_pending_count_deltas_and_state(fields)
+        return deltas
+
+    @classmethod
+    def _get_pending_count_deltas_and_state(cls, fields):
+        """
+        同时读取 deltas 和 flush 的状态 (是否正在 flush, generation)
+        每次 flush 或者 reconcile 释放锁之前都会把 generation +1
+        从数据库读取计数前后的状态一样并且没有在 flush，说明读到的计数和 deltas 是一致的
+        """
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.exists(cls.get_lock_key(FLUSHING_COUNT_DELTAS_KEY))
+        pipeline.get(COUNT_DELTAS_GENERATION_KEY)
+        if fields:
+            pipeline.hmget(COUNT_DELTAS_KEY, fields)
+            pipeline.hmget(FLUSHING_COUNT_DELTAS_KEY, fields)
+        is_flushing, generation, *results = pipeline.execute()
+        deltas = {}
+        if fields:
+            deltas = {
+                field: int(delta or 0) + int(flushing_delta or 0)
+                for field, delta, flushing_delta in zip(fields, *results)
+            }
+        return deltas, (bool(is_flushing), generation)
+
+    @classmethod
+    def _acquire_count_deltas_lock(cls):
+        # flush 和 reconcile 都会改数据库里的计数，用同一把锁互斥
+        return cls._acquire_lock(FLUSHING_COUNT_DELTAS_KEY, settings.COUNT_DELTAS_FLUSH_LOCK_EXPIRE_TIME)
+
+    @classmethod
+    def _release_count_deltas_lock(cls, token):
+        # 先把 generation +1 再释放锁，get_counts 据此知道读取数据库的期间计数被改过
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.decr(key)
+        conn.incr(COUNT_DELTAS_GENERATION_KEY)
+        cls._release_lock(FLUSHING_COUNT_DELTAS_KEY, token)
+
+    @classmethod
+    def flush_count_deltas(cls):
+        """
+        把 redis 里累积的计数 deltas 批量写回数据库，返回写回了多少个计数
+        先把 hash 改名，之后新的 deltas 会写到新的 hash 里，不会和正在 flush 的混在一起
+        上一次 flush 失败留下来的 hash 会在这一次重新处理
+        """
+        token = cls._acquire_count_deltas_lock()
+        if token is None:
+            return 0
+
+        conn = RedisClient.get_connection()
+        try:
+            if not conn.exists(FLUSHING_COUNT_DELTAS_KEY):
+                try:
+                    conn.rename(COUNT_DELTAS_KEY, FLUSHING_COUNT_DELTAS_KEY)
+                except ResponseError:
+                    # 没有任何 deltas
+                    return 0
+
+            # {model label: {attr: {object id: delta}}}
+            grouped_deltas = defaultdict(lambda: defaultdict(dict))
+            for field, delta in conn.hgetall(FLUSHING_COUNT_DELTAS_KEY).items():
+                label, attr, object_id = field.decode('utf-8').split(':')
+                if int(delta):
+                    grouped_deltas[label][attr][int(object_id)] = int(delta)
+
+            flushed = 0
+            with transaction.atomic():
+                for label, attr_deltas in grouped_deltas.items():
+                    model_class = apps.get_model(label)
+                    flushed += cls._bulk_update_counts(model_class, attr_deltas, relative=True)
+            conn.delete(FLUSHING_COUNT_DELTAS_KEY)
+            return flushed
+        finally:
+            cls._release_count_deltas_lock(token)
+
+    @classmethod
+    def _bulk_update_counts(cls, model_class, attr_values, relative):
+        """
+        attr_values 是 {attr: {object id: value}}
+        每 COUNT_BULK_UPDATE_BATCH_SIZE 个 objects 只需要一条 UPDATE ... SET attr = CASE ... END 语句
+        relative 为 True 的时候 value 是 delta，否则是最终的值
+        """
+        object_ids = sorted(set().union(*[values.keys() for values in attr_values.values()]))
+        batch_size = settings.COUNT_BULK_UPDATE_BATCH_SIZE
+        updated = 0
+        for start in range(0, len(object_ids), batch_size):
+            batch_ids = object_ids[start: start + batch_size]
+            updates = {}
+            for attr, values in attr_values.items():
+                whens = [
+                    When(id=object_id, then=Value(values[object_id]))
+                    for object_id in batch_ids
+                    if object_id in values
+                ]
+                if not whens:
+                    continue
+                if relative:
+                    updates[attr] = Coalesce(F(attr), 0) + Case(
+                        *whens,
+                        default=Value(0),
+                        output_field=IntegerField(),
+                    )
+                else:
+                    updates[attr] = Case(*whens, default=F(attr), output_field=IntegerField())
+                updated += len(whens)
+            model_class.objects.filter(id__in=batch_ids).update(**updates)
+        return updated
 
-        # back fill cache from db
-        # 不执行 -1 操作，因为必须保证调用 decr_count 之前 obj.attr 已经 -1 过了
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+    @classmethod
+    def reconcile_counts(cls, model_class, attr, object_ids, count_objects):
+        """
+        count_objects(object_ids) 从 Like 和 Comment 表里重新计算出 {object id: count}
+        还没有 flush 的 deltas 之后还会被加到数据库里，所以数据库里应该是 count - pending delta
+        不一致的计数会被修正，同时删掉 cache 里的计数，下次读取的时候重新 load
+        返回修正了多少个计数
+
+        整个过程拿着 flush 的锁，修正的时候不会有 flush 同时在改数据库
+        在重新计算前后各读一次 deltas，期间有新的点赞或者评论的 object 无法确定
+        重新计算的结果里有没有包含它们，这一次先跳过，下一次 reconcile 的时候再修正
+        """
+        token = cls._acquire_count_deltas_lock()
+        if token is None:
+            # 正在 flush，这一批下一次再处理
+            return 0
+
+        try:
+            fields = {
+                object_id: cls.get_count_delta_field(model_class(id=object_id), attr)
+                for object_id in object_ids
+            }
+            deltas_before = cls.get_pending_count_deltas(list(fields.values()))
+            actual_counts = count_objects(object_ids)
+            objects = list(model_class.objects.filter(id__in=object_ids).only('id', attr))
+            deltas_after = cls.get_pending_count_deltas(list(fields.values()))
+
+            fixed_counts = {}
+            for obj in objects:
+                field = fields[obj.id]
+                if deltas_before[field] != deltas_after[field]:
+                    continue
+                expected_count = actual_counts[obj.id] - deltas_after[field]
+                if getattr(obj, attr) != expected_count:
+                    fixed_counts[obj] = expected_count
+            if not fixed_counts:
+                return 0
+
+            cls._bulk_update_counts(
+                model_class,
+                {attr: {obj.id: count for obj, count in fixed_counts.items()}},
+                relative=False,
+            )
+            conn = RedisClient.get_connection()
+            conn.delete(*[cls.get_count_key(obj, attr) for obj in fixed_counts])
+            return len(fixed_counts)
+        finally:
+            cls._release_count_deltas_lock(token)
 
     @classmethod
     def get_count(cls, obj, attr):
+        return cls.get_counts([obj], [attr])[obj.id][attr]
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        """
+        批量读取一页 objects 的多个计数，所有的 key 只需要一次 MGET
+        返回 {obj.id: {attr: count}}
+        cache 里没有的用一次 values_list 查询从数据库里读取，再用一次 pipeline 写回 cache
+        """
+        objects = list(objects)
+        if not objects:
+            return {}
+
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        count = conn.get(key)
-        if count is not None:
-            return int(count)
-
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
\ No newline at end of file
+        keys = [
+            cls.get_count_key(obj, attr)
+            for obj in objects
+            for attr in attrs
+        ]
+        # 顺便读一下 flush 的状态，cache miss 的时候用来判断从数据库读到的计数能不能放心地 cache
+        *cached_counts, is_flushing, generation = conn.mget(
+            keys + [cls.get_lock_key(FLUSHING_COUNT_DELTAS_KEY), COUNT_DELTAS_GENERATION_KEY],
+        )
+        cached_counts = iter(cached_counts)
+        counts = {}
+        missing_objects = []
+        for obj in objects:
+            counts[obj.id] = {}
+            for attr in attrs:
+                count = next(cached_counts)
+                if count is None:
+                    missing_objects.append(obj)
+                else:
+                    counts[obj.id][attr] = int(count)
+        if not missing_objects:
+            return counts
+
+        # 不用 refresh_from_db，只读取需要的那几个计数字段
+        model_class = missing_objects[0].__class__
+        db_counts = {
+            row[0]: row[1:]
+            for row in model_class.objects.filter(
+                id__in={obj.id for obj in missing_objects},
+            ).values_list('id', *attrs)
+        }
+        # 数据库里的计数还没有加上没有 flush 的 deltas
+        pending_deltas, state = cls._get_pending_count_deltas_and_state([
+            cls.get_count_delta_field(obj, attr)
+            for obj in missing_objects
+            for attr in attrs
+        ])
+        # 读取数据库的期间有 flush 或者 reconcile 的话，数据库里的计数可能已经包含了
+        # 还在 flushing hash 里的 deltas，算出来的值可能多算了一遍，只 cache 很短的时间
+        if state == (False, generation) and is_flushing is None:
+            expire_time = settings.REDIS_KEY_EXPIRE_TIME
+        else:
+            expire_time = settings.COUNT_UNSTABLE_EXPIRE_TIME
+        pipeline = conn.pipeline()
+        for obj in missing_objects:
+            row = db_counts.get(obj.id, [None] * len(attrs))
+            for attr, count in zip(attrs, row):
+                if attr in counts[obj.id]:
+                    continue
+                count = (count or 0) + pending_deltas[cls.get_count_delta_field(obj, attr)]
+                pipeline.set(cls.get_count_key(obj, attr), count, ex=expire_time)
+                counts[obj.id][attr] = count
+        pipeline.execute()
+        return counts
@@ -1,20 +1,121 @@
+from datetime import date
+from django.apps import apps
 from django.core import serializers
+from django.db import DEFAULT_DB_ALIAS
 from django_hbase.models import HBaseModel
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
 
 import json
+import msgpack
+import zlib
+
+# 二进制格式的版本号，放在序列化结果的第一个字节
+# 旧的 json 格式以 '[' 或者 '{' 开头，可以和二进制格式区分开，所以升级之后旧的 cache 依然可以读取
+BINARY_FORMAT_VERSION = b'\x01'
+JSON_FORMAT_PREFIXES = (b'[', b'{')
+
+
+class StaleSerializedDataError(Exception):
+    """
+    cache 里的数据是按照旧的字段列表序列化的，model 的字段已经改变了，没法再反序列化
+    """
+    pass
+
+
+def _identity(value):
+    return value
+
+
+def _get_schema_hash(field_names):
+    # 字段列表的指纹，字段增删或者顺序改变之后，旧的 cache 数据就不能再用了
+    return zlib.crc32(','.join(field_names).encode('utf-8'))
+
+
+def _is_json_format(serialized_data):
+    if isinstance(serialized_data, str):
+        return True
+    return serialized_data[:1] in JSON_FORMAT_PREFIXES
+
+
+def _unpack_binary(serialized_data):
+    # 以后升级了二进制格式的版本号，或者数据损坏了，都当作旧的数据处理，删掉 cache 重新 load
+    if serialized_data[:1] != BINARY_FORMAT_VERSION:
+        raise StaleSerializedDataError(f'unknown binary format version {serialized_data[:1]!r}')
+    try:
+        name, schema_hash, values = msgpack.unpackb(serialized_data[1:], raw=False)
+    except (ValueError, TypeError) as e:
+        raise StaleSerializedDataError(f'corrupt serialized data: {e}')
+    return name, schema_hash, values
 
 
 class DjangoModelSerializer:
+    # model label => (field names, field codecs, schema hash)，每个 model 只需要计算一次
+    _schemas = {}
+
+    @classmethod
+    def _get_field_codecs(cls, field):
+        internal_type = field.get_internal_type()
+        if internal_type == 'DateTimeField':
+            return datetime_to_timestamp, timestamp_to_datetime
+        if internal_type == 'DateField':
+            return date.toordinal, date.fromordinal
+        if internal_type in ('DecimalField', 'UUIDField', 'DurationField', 'TimeField'):
+            return str, field.to_python
+        if internal_type in ('FileField', 'ImageField'):
+            return str, _identity
+        return _identity, _identity
+
+    @classmethod
+    def _get_schema(cls, model_class):
+        label = model_class._meta.label_lower
+        if label in cls._schemas:
+            return cls._schemas[label]
+        fields = model_class._meta.concrete_fields
+        field_names = [field.attname for field in fields]
+        codecs = [cls._get_field_codecs(field) for field in fields]
+        cls._schemas[label] = (field_names, codecs, _get_schema_hash(field_names))
+        return cls._schemas[label]
 
     @classmethod
     def serialize(cls, instance):
+        """
+        序列化为 版本号 + msgpack([model label, 字段指纹, 按照字段顺序排列的值])
+        不需要像 json 那样每个 object 都存一遍字段名，体积更小，解析也更快
+        """
+        field_names, codecs, schema_hash = cls._get_schema(instance.__class__)
+        values = []
+        for attname, (encode, _) in zip(field_names, codecs):
+            value = getattr(instance, attname)
+            values.append(None if value is None else encode(value))
+        data = [instance._meta.label_lower, schema_hash, values]
+        return BINARY_FORMAT_VERSION + msgpack.packb(data, use_bin_type=True)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if _is_json_format(serialized_data):
+            return cls.deserialize_json(serialized_data)
+
+        label, schema_hash, values = _unpack_binary(serialized_data)
+        model_class = apps.get_model(label)
+        field_names, codecs, current_schema_hash = cls._get_schema(model_class)
+        if schema_hash != current_schema_hash:
+            raise StaleSerializedDataError(f'{label} fields have changed')
+        values = [
+            None if value is None else decode(value)
+            for (_, decode), value in zip(codecs, values)
+        ]
+        # 和 ORM 从数据库里读取一行数据之后创建 instance 的方式一样
+        return model_class.from_db(DEFAULT_DB_ALIAS, field_names, values)
+
+    @classmethod
+    def serialize_json(cls, instance):
         # Django 的 serializers 默认需要一个 QuerySet 或者 list 类型的数据来进行序列化
         # 因此需要给 instance 加一个 [] 变成 list
         return serializers.serialize('json', [instance], cls=JSONEncoder)
 
     @classmethod
-    def deserialize(cls, serialized_data):
+    def deserialize_json(cls, serialized_data):
         # 需要加 .object 来得到原始的 model 类型的 object 数据，要不然得到的数据并不是一个
         # ORM 的 object，而是一个 DeserializedObject 的类型
         return list(serializers.deserialize('json', serialized_data))[0].object
@@ -31,6 +132,25 @@ class HBaseModelSerializer:
 
     @classmethod
     def serialize(cls, instance):
+        field_names = list(instance.get_field_hash())
+        values = [getattr(instance, key) for key in field_names]
+        data = [instance.__class__.__name__, _get_schema_hash(field_names), values]
+        return BINARY_FORMAT_VERSION + msgpack.packb(data, use_bin_type=True)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if _is_json_format(serialized_data):
+            return cls.deserialize_json(serialized_data)
+
+        model_class_name, schema_hash, values = _unpack_binary(serialized_data)
+        model_class = cls.get_model_class(model_class_name)
+        field_names = list(model_class.get_field_hash())
+        if schema_hash != _get_schema_hash(field_names):
+            raise StaleSerializedDataError(f'{model_class_name} fields have changed')
+        return model_class(**dict(zip(field_names, values)))
+
+    @classmethod
+    def serialize_json(cls, instance):
         json_data = {'model_class_name': instance.__class__.__name__}
         for key in instance.get_field_hash():
             value = getattr(instance, key)
@@ -38,8 +158,8 @@ class HBaseModelSerializer:
         return json.dumps(json_data)
 
     @classmethod
-    def deserialize(cls, serialized_data):
+    def deserialize_json(cls, serialized_data):
         json_data = json.loads(serialized_data)
         model_class = cls.get_model_class(json_data['model_class_name'])
         del json_data['model_class_name']
-        return model_class(**json_data)
\ No newline at end of file
+        return model_class(**json_data)
@@ -1,5 +1,14 @@
+from newsfeeds.models import HBaseNewsFeed
 from testing.testcases import TestCase
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import (
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+    StaleSerializedDataError,
+)
+
+import threading
 
 
 class UtilsTests(TestCase):
@@ -16,4 +25,210 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_push_objects_if_cached(self):
+        user = self.create_user('linghu')
+        tweet1 = self.create_tweet(user)
+        tweet2 = self.create_tweet(user)
+        conn = RedisClient.get_connection()
+        conn.zadd('cached_key', {
+            DjangoModelSerializer.serialize(tweet1): RedisHelper.get_score(tweet1.created_at),
+        })
+
+        RedisHelper.push_objects_if_cached([
+            ('cached_key', tweet2),
+            ('not_cached_key', tweet2),
+        ])
+        cached_list = conn.zrevrange('cached_key', 0, -1)
+        self.assertEqual(
+            [DjangoModelSerializer.deserialize(data) for data in cached_list],
+            [tweet2, tweet1],
+        )
+        # 不在 cache 里的 key 不会被创建
+        self.assertEqual(conn.exists('not_cached_key'), False)
+
+    def test_binary_serializers(self):
+        user = self.create_user('linghu')
+        tweet = self.create_tweet(user, 'binary content')
+        data = DjangoModelSerializer.serialize(tweet)
+        self.assertEqual(isinstance(data, bytes), True)
+        cached_tweet = DjangoModelSerializer.deserialize(data)
+        self.assertEqual(cached_tweet, tweet)
+        self.assertEqual(cached_tweet.content, 'binary content')
+        self.assertEqual(cached_tweet.created_at, tweet.created_at)
+        self.assertEqual(cached_tweet.user_id, user.id)
+
+        newsfeed = HBaseNewsFeed(user_id=user.id, created_at=1666000000000000, tweet_id=tweet.id)
+        cached_newsfeed = HBaseModelSerializer.deserialize(HBaseModelSerializer.serialize(newsfeed))
+        self.assertEqual(cached_newsfeed.user_id, user.id)
+        self.assertEqual(cached_newsfeed.created_at, 1666000000000000)
+        self.assertEqual(cached_newsfeed.tweet_id, tweet.id)
+
+        # 升级之前写入 cache 的 json 格式依然可以读取
+        json_data = DjangoModelSerializer.serialize_json(tweet).encode('utf-8')
+        self.assertEqual(DjangoModelSerializer.deserialize(json_data), tweet)
+        json_data = HBaseModelSerializer.serialize_json(newsfeed).encode('utf-8')
+        self.assertEqual(HBaseModelSerializer.deserialize(json_data).tweet_id, tweet.id)
+
+        # 不认识的版本号和损坏的数据都当作旧的数据，触发重新 load
+        for serializer, obj in [(DjangoModelSerializer, tweet), (HBaseModelSerializer, newsfeed)]:
+            data = serializer.serialize(obj)
+            with self.assertRaises(StaleSerializedDataError):
+                serializer.deserialize(b'\x02' + data[1:])
+            with self.assertRaises(StaleSerializedDataError):
+                serializer.deserialize(data[:-3])
+
+    def test_load_objects_in_range(self):
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for _ in range(5)][::-1]
+
+        def lazy_load(limit):
+            return tweets[:limit]
+
+        # cache miss
+        objects, is_complete = RedisHelper.load_objects_in_range('tweets', lazy_load, limit=2)
+        self.assertEqual(objects, tweets[:2])
+        self.assertEqual(is_complete, True)
+
+        # cache hit
+        objects, is_complete = RedisHelper.load_objects_in_range(
+            'tweets',
+            lazy_load,
+            created_at__lt=tweets[1].created_at,
+            limit=2,
+        )
+        self.assertEqual(objects, tweets[2:4])
+        objects, _ = RedisHelper.load_objects_in_range(
+            'tweets',
+            lazy_load,
+            created_at__lt=tweets[3].created_at,
+            limit=2,
+        )
+        self.assertEqual(objects, tweets[4:])
+        objects, _ = RedisHelper.load_objects_in_range(
+            'tweets',
+            lazy_load,
+            created_at__lt=tweets[4].created_at,
+            limit=2,
+        )
+        self.assertEqual(objects, [])
+        objects, _ = RedisHelper.load_objects_in_range(
+            'tweets',
+            lazy_load,
+            created_at__gt=tweets[2].created_at,
+        )
+        self.assertEqual(objects, tweets[:2])
+        objects, _ = RedisHelper.load_objects_in_range(
+            'tweets',
+            lazy_load,
+            created_at__gt=tweets[0].created_at,
+        )
+        self.assertEqual(objects, [])
+
+        # cache 被截断的时候，数据不够一页就需要去数据库查询
+        with self.settings(REDIS_LIST_LENGTH_LIMIT=5):
+            objects, is_complete = RedisHelper.load_objects_in_range(
+                'tweets',
+                lazy_load,
+                created_at__lt=tweets[2].created_at,
+                limit=3,
+            )
+            self.assertEqual(objects, tweets[3:])
+            self.assertEqual(is_complete, False)
+
+    def test_push_object_out_of_order(self):
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        RedisClient.clear()
+
+        def lazy_load(limit):
+            return [tweets[2], tweets[0]][:limit]
+
+        RedisHelper.load_objects('tweets', lazy_load)
+        # 比 cache 里最新的数据更早的 object 也会被插入到正确的位置
+        RedisHelper.push_object('tweets', tweets[1], lazy_load)
+        self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets[::-1])
+        # 重复 push 同一个 object 不会产生重复的数据
+        RedisHelper.push_objects_if_cached([('tweets', tweets[1])])
+        self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets[::-1])
+
+        # 超过最大长度的时候，最老的数据被 trim 掉
+        with self.settings(REDIS_LIST_LENGTH_LIMIT=2):
+            new_tweet = self.create_tweet(user)
+            RedisHelper.push_object('tweets', new_tweet, lazy_load)
+            self.assertEqual(
+                RedisHelper.load_objects('tweets', lazy_load),
+                [new_tweet, tweets[2]],
+            )
+
+        # 升级之前的 list 类型的 cache 会被当作 cache miss 处理
+        conn = RedisClient.get_connection()
+        conn.delete('tweets')
+        conn.rpush('tweets', DjangoModelSerializer.serialize(tweets[0]))
+        self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), [tweets[2], tweets[0]])
+
+    def test_load_objects_single_flight(self):
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for _ in range(3)][::-1]
+        RedisClient.clear()
+        load_calls = []
+
+        def lazy_load(limit):
+            load_calls.append(limit)
+            return tweets[:limit]
+
+        # 别的进程拿着锁正在 load，等待超时之后直接查数据库，但是不写 cache
+        conn = RedisClient.get_connection()
+        conn.set(RedisHelper.get_lock_key('tweets'), 'other', ex=10)
+        with self.settings(REDIS_LOAD_WAIT_TIMEOUT=0.1):
+            self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets)
+        self.assertEqual(len(load_calls), 1)
+        self.assertEqual(conn.exists('tweets'), False)
+
+        # 拿到锁的进程 load 完之后会释放锁
+        conn.delete(RedisHelper.get_lock_key('tweets'))
+        self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets)
+        self.assertEqual(len(load_calls), 2)
+        self.assertEqual(conn.exists(RedisHelper.get_lock_key('tweets')), False)
+        self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets)
+        self.assertEqual(len(load_calls), 2)
+
+        with self.settings(REDIS_EARLY_REFRESH_WINDOW=10 ** 9):
+            # 需要提前刷新，但是别的进程正在刷新，直接返回旧的数据
+            conn.set(RedisHelper.get_lock_key('tweets'), 'other', ex=10)
+            self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets)
+            self.assertEqual(len(load_calls), 2)
+            # 拿到锁之后从数据库里刷新
+            conn.delete(RedisHelper.get_lock_key('tweets'))
+            self.assertEqual(RedisHelper.load_objects('tweets', lazy_load), tweets)
+            self.assertEqual(len(load_calls), 3)
+
+    def test_push_object_while_loading(self):
+        user = self.create_user('linghu')
+        tweets = [self.create_tweet(user) for _ in range(2)]
+        new_tweet = self.create_tweet(user)
+        RedisClient.clear()
+
+        def lazy_load(limit):
+            return [new_tweet] + tweets[::-1]
+
+        # 别的进程拿着锁，并且是在 new_tweet 写入数据库之前读的数据库
+        conn = RedisClient.get_connection()
+        conn.set(RedisHelper.get_lock_key('tweets'), 'other', ex=10)
+        timer = threading.Timer(0.05, lambda: RedisHelper._load_objects_to_cache(
+            'tweets',
+            tweets[::-1],
+            DjangoModelSerializer,
+        ))
+        timer.start()
+        with self.settings(REDIS_LOAD_POLL_INTERVAL=0.05):
+            RedisHelper.push_object('tweets', new_tweet, lazy_load)
+        timer.join()
+
+        # 等别的进程写完 cache 之后再 push 一次，new_tweet 不会丢
+        conn.delete(RedisHelper.get_lock_key('tweets'))
+        self.assertEqual(
+            RedisHelper.load_objects('tweets', lambda limit: []),
+            [new_tweet] + tweets[::-1],
+        )
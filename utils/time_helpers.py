@@ -1,6 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def timestamp_to_datetime(timestamp):
+    # timestamp 是以 micro second 为单位的整数，和 Tweet.timestamp 对应
+    # 不用 datetime.fromtimestamp(timestamp / 1000000) 是为了避免浮点数的精度误差
+    return EPOCH + timedelta(microseconds=timestamp)
+
+
+def datetime_to_timestamp(value):
+    # 和 timestamp_to_datetime 互为逆运算，同样用整数运算避免浮点数的精度误差
+    return (value - EPOCH) // timedelta(microseconds=1)
\ No newline at end of file